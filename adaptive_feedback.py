@@ -5,11 +5,11 @@ import sys
 import numpy as np
 import json
 from PyQt5 import QtGui, QtCore
-from PyQt5.QtWidgets import QWidget, QMessageBox, QApplication
+from PyQt5.QtWidgets import QWidget, QMessageBox, QApplication, QLabel
 from scipy import io
 import pyqtgraph as pg
 from gui.UIadaptive_feedback import Ui_Form
-from collections import deque
+from collections import deque, namedtuple
 import time
 import os
 from threading import Thread, Event
@@ -17,6 +17,13 @@ from ocelot.cpbd.magnetic_lattice import *
 import logging
 import numbers
 from mint.devices import *
+from orbit_state import OrbitState
+from orbit_math import extract_matrix, correction_angles, SolverCache, CachedOrbitSVD, CachedMICADO
+from ring_buffer import OrbitHistory
+from objective import ObjectiveExpression
+from feedback_engine import FeedbackEngine, format_stats
+from mint.orbit_streamer import acquire_streamer, release_streamer, snapshot_indices
+from gui.invoker import GuiInvoker
 # filename="logs/afb.log",
 #logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -81,6 +88,32 @@ class ActiveSearch(Thread):
         self._stop_event.set()
 
 
+StatisticsSnapshot = namedtuple("StatisticsSnapshot", ["orbit_s", "targets", "targets_filtered",
+                                                       "delta_go", "delta_ro", "statistics_ready", "correction"])
+StatisticsSnapshot.__doc__ = """
+Data of one statistics/feedback cycle for the GUI, all arrays are copies
+
+:param orbit_s: BPM positions
+:param targets: objective function history
+:param targets_filtered: filtered objective function history
+:param delta_go: (x, y) change of the golden orbit or None if it was not recalculated
+:param delta_ro: (x, y) reference orbit relative to the golden orbit or None if there was no correction
+:param statistics_ready: True if enough statistics is collected to start the feedback
+:param correction: CorrectionStep or None if there was no correction
+"""
+
+CorrectionStep = namedtuple("CorrectionStep", ["cor_ids", "kicks_read", "kicks", "applied", "stop_reason"])
+CorrectionStep.__doc__ = """
+One correction step of the feedback, calculated in the worker thread (see UIAFeedBack.auto_correction())
+
+:param cor_ids: ids of the correctors
+:param kicks_read: array of the read kicks [mrad] or None
+:param kicks: array of the new kicks [mrad] or None if the correction was not calculated
+:param applied: True if the new kicks were written
+:param stop_reason: message if the feedback has to be stopped, None otherwise
+"""
+
+
 class UIAFeedBack(QWidget, Ui_Form):
     def __init__(self, parent=None, orbit=None):
         QWidget.__init__(self, parent)
@@ -106,17 +139,27 @@ class UIAFeedBack(QWidget, Ui_Form):
         self.pb_active_search.clicked.connect(self.start_stop_active_search)
 
         self.update_plot_counter = 0
-        self.orbits_x = []
-        self.orbits_y = []
         self.orbit_s = []
-        self.target_values = []
-        self.target_filtered = []
         self.nreadings = 100
-        self.feedback_timer = pg.QtCore.QTimer()
-        self.feedback_timer.timeout.connect(self.auto_correction)
-
-        self.statistics_timer = pg.QtCore.QTimer()
-        self.statistics_timer.timeout.connect(self.loop)
+        self.history = OrbitHistory(self.nreadings, 0, nring=self.nring)
+        # statistics and feedback run in one FeedbackEngine worker, see loop()
+        self.engine = None
+        self.feedback_on = False
+        self.next_correction = 0.
+        self.gui = GuiInvoker()
+        self.settings = {}
+        # correction setup (response matrix, solver, limits) copied at the start of the feedback
+        self.correction_setup = None
+        self.stats_file = "./logs/afb_stats.json"
+        # wildcard X/Y/CHARGE stream of the BPM frontend server, gathered onto self.orbit.bpms (see read_bpms())
+        self.streamer = None
+        self.last_train_id = None
+        self.bpm_index_src = None
+        self.bpm_indx = None
+        self.bpm_found = None
+        # p50/p99 of the cycle stages and overruns, updated with every cycle
+        self.lb_latency = QLabel(self.groupBox_4)
+        self.gridLayout_9.addWidget(self.lb_latency, 2, 1, 1, 1)
 
         self.add_orbit_plot()
         self.add_objective_func_plot()
@@ -132,6 +175,7 @@ class UIAFeedBack(QWidget, Ui_Form):
         self.le_c.textChanged.connect(self.check_address)
 
         self.bpms_name = []
+        self.orbit_state = OrbitState()
         self.counter = 0
         self.clear_hist()
         self.dev_mode = self.parent.dev_mode
@@ -172,14 +216,22 @@ class UIAFeedBack(QWidget, Ui_Form):
         kicks = [cd["value"] for cd in cor_dict_list]
         cor_dict = dict(zip(cor_names, kicks))
         print(cor_dict)
-        for cor in self.orbit.corrs:
-            if cor.id in cor_dict.keys():
-                kick_mrad = cor_dict[cor.id]
-                try:
-                    cor.mi.set_value(kick_mrad)
-                    logger.info(cor.id + " set: %s --> %s" % (cor.ui.get_value(), kick_mrad))
-                except Exception as e:
-                    logger.error(cor.id + " apply_kicks Error: " + str(e))
+        corrs = [cor for cor in self.orbit.corrs if cor.id in cor_dict.keys()]
+        kicks = [cor_dict[cor.id] for cor in corrs]
+        snapshot, errors = self.mi.get_devices_values([cor.mi for cor in corrs])
+        if len(errors) > 0:
+            logger.error("restore_correctors: could not read correctors: " + ", ".join(errors.keys()))
+            self.parent.error_box("Could not read correctors. Nothing is restored")
+            return
+        ok, report = self.mi.set_devices_transaction([cor.mi for cor in corrs], kicks, snapshot=snapshot, verify=True)
+        for cor, kick_mrad in zip(corrs, kicks):
+            res = report[cor.mi.id]
+            if res["error"] is not None:
+                logger.error(cor.id + " restore_correctors Error: " + res["error"])
+            elif ok:
+                logger.info(cor.id + " set: %s --> %s" % (cor.ui.get_value(), kick_mrad))
+        if not ok:
+            self.parent.error_box("Error during restoring of correctors. Written correctors are rolled back")
 
     def tab_changed(self):
         if self.tabWidget.currentIndex() == 1:
@@ -338,25 +390,116 @@ class UIAFeedBack(QWidget, Ui_Form):
         self.orbit_class.correct()
         self.orbit_class.golden_orbit.set_golden_orbit()
 
-    def loop(self):
+    def read_settings(self):
+        """
+        Method copies the spin box values used by the worker (GUI thread)
+        """
+        self.settings = {"time_delay": self.sb_time_delay.value(),
+                         "go_recalc_delay": self.sb_go_recalc_delay.value(),
+                         "averaging": self.sb_averaging.value(),
+                         "ref_orbit_nread": int(self.sb_ref_orbit_nread.value()),
+                         "feedback_rep": self.sb_feedback_rep.value(),
+                         "update_display": self.cb_update_display.isChecked()}
+
+    def loop(self, engine):
+        """
+        One cycle of the statistics (FeedbackEngine worker thread) with period sb_time_delay:
+        read BPMs and objective function -> filter -> golden orbit and every sb_feedback_rep seconds
+        (if feedback is on) correct -> apply.
+
+        :param engine: FeedbackEngine
+        :return: StatisticsSnapshot
+        """
+        budget = engine.budget
         self.counter += 1
-        beam_on = self.read_data()
+        with budget.stage("read"):
+            beam_on = self.read_data()
+        if beam_on is None:
+            engine.stop("Wrong Objective Function")
+            return None
         if not beam_on:
             self.counter -= 1
             logger.debug(" loop: beam OFF. counter -= 1")
-        bpm_delay = self.sb_time_delay.value()
-        go_delay = self.sb_go_recalc_delay.value()
+        bpm_delay = self.settings["time_delay"]
+        go_delay = self.settings["go_recalc_delay"]
+        delta_go = None
+        statistics_ready = False
         if self.counter % int(go_delay/bpm_delay) == int(go_delay/bpm_delay)-1:
-            go_x, go_y = self.calc_golden_orbit()
+            with budget.stage("estimate"):
+                go_x, go_y, delta_go = self.calc_golden_orbit()
             if self.counter == int(go_delay/bpm_delay)*3-1:
                 self.first_go_x = go_x
                 self.first_go_y = go_y
+                statistics_ready = True
+
+        delta_ro = None
+        correction = None
+        now = time.monotonic()
+        if self.feedback_on and now >= self.next_correction:
+            period = self.settings["feedback_rep"]
+            self.next_correction += period
+            if self.next_correction < now:
+                self.next_correction = now + period
+            delta_ro, correction = self.auto_correction(engine)
+
+        # plot update is optional, it is skipped if the cycle is about to overrun
+        if not statistics_ready and correction is None and not budget.allows("plot"):
+            return None
+        with budget.stage("plot"):
+            snapshot = StatisticsSnapshot(orbit_s=np.array(self.orbit_s),
+                                          targets=self.history.targets.ordered()[:, 0].copy(),
+                                          targets_filtered=self.history.targets_filtered.ordered()[:, 0].copy(),
+                                          delta_go=delta_go, delta_ro=delta_ro, statistics_ready=statistics_ready,
+                                          correction=correction)
+        return snapshot
+
+    def update_gui(self, snapshot):
+        """
+        Slot for FeedbackEngine.signals.cycle_done (GUI thread)
 
-                self.pb_start_feedback.setStyleSheet("color: rgb(85, 255, 127);")
-                self.pb_start_feedback.setText("Start Feedback")
+        :param snapshot: CycleSnapshot with StatisticsSnapshot data
+        :return:
+        """
+        data = snapshot.data
+        self.read_settings()
+        self.lb_latency.setText(format_stats(snapshot.stats))
+        self.update_obj_plot(data.targets, data.targets_filtered)
+        # if tab is active
+        if data.delta_go is not None and self.tabWidget.currentIndex() == 2:
+            self.orb_x_ref.setData(x=data.orbit_s, y=data.delta_go[0]*1000)
+            self.orb_y_ref.setData(x=data.orbit_s, y=data.delta_go[1]*1000)
+        if data.delta_ro is not None and self.tabWidget.currentIndex() == 1:
+            self.orb_y.setData(x=data.orbit_s, y=data.delta_ro[0]*1000)
+            self.orb_x.setData(x=data.orbit_s, y=data.delta_ro[1]*1000)
+        if data.correction is not None:
+            self.show_correction(data.correction)
+        if data.statistics_ready and self.pb_start_feedback.text() == "Statistics collection":
+            self.pb_start_feedback.setStyleSheet("color: rgb(85, 255, 127);")
+            self.pb_start_feedback.setText("Start Feedback")
+
+    def show_warning(self, text):
+        """
+        Method shows a warning in le_warn, can be called from the worker thread
+
+        :param text: message, empty string clears the line
+        :return:
+        """
+        def show():
+            self.le_warn.clear()
+            if text:
+                self.le_warn.setText(text)
+                self.le_warn.setStyleSheet("color: red")
+        self.gui.post(show)
+
+    def engine_stopped(self, reason):
+        """
+        Slot for FeedbackEngine.signals.stopped (GUI thread)
+        """
+        if reason != "stopped":
+            self.error_box(reason)
+        self.stop_statistics()
 
     def closeEvent(self, QCloseEvent):
-        self.stop_feedback()
         self.stop_statistics()
 
     def start_stop_active_search(self):
@@ -388,10 +531,9 @@ class UIAFeedBack(QWidget, Ui_Form):
 
     def start_stop_statistics(self):
         """
-        Method to start/stop feedback timer.
-        sb_feedback_sec - spinBox - set seconds for timer
-        pb_feedback - pushBatton Off/On
-        feedback_timer - timer
+        Method to start/stop statistics collection.
+        sb_time_delay - spinBox - period of the FeedbackEngine worker
+        pb_start_statistics - pushBatton Off/On
         :return:
         """
 
@@ -399,7 +541,7 @@ class UIAFeedBack(QWidget, Ui_Form):
         self.pb_start_feedback.setStyleSheet("color: yellow")
 
         self.counter = 0
-        delay = self.sb_time_delay.value()*1000
+        delay = self.sb_time_delay.value()
 
         self.orbit_class.read_orbit()
 
@@ -420,34 +562,37 @@ class UIAFeedBack(QWidget, Ui_Form):
         else:
             self.clear_hist()
             self.nreadings = self.sb_array_len.value()
-            self.target_values = []
-            self.target_filtered = []
-            self.orbits_x = []
-            self.orbits_y = []
+            self.history = OrbitHistory(self.nreadings, len(self.orbit.bpms), nring=self.nring)
             self.orbit_s = []
+            self.orbit_state.load(bpms=self.orbit.bpms, corrs=self.orbit.corrs)
             self.objective_func = self.set_obj_fun()
             if self.objective_func is None:
                 self.stop_statistics()
                 logger.debug("objective function = None")
                 return None
 
-            self.statistics_timer.start(delay)
+            self.read_settings()
+            self.start_streamer()
+            self.engine = FeedbackEngine(cycle=self.loop, period=delay, name="Adaptive Feedback",
+                                         stats_file=self.stats_file)
+            self.engine.signals.cycle_done.connect(self.update_gui)
+            self.engine.signals.stopped.connect(self.engine_stopped)
+            self.engine.start()
             logger.info("Start Statistics")
             self.pb_start_statistics.setText("Statistics Accum Off")
             self.pb_start_statistics.setStyleSheet("color: red")
 
     def stop_feedback(self):
-        self.feedback_timer.stop()
+        self.feedback_on = False
         logger.info("Stop Feedback")
         self.pb_start_feedback.setStyleSheet("color: rgb(85, 255, 127);")
         self.pb_start_feedback.setText("Start Feedback")
 
     def start_stop_feedback(self):
         """
-        Method to start/stop feedback timer.
-        sb_feedback_sec - spinBox - set seconds for timer
-        pb_feedback - pushBatton Off/On
-        feedback_timer - timer
+        Method to start/stop feedback. The correction runs in the statistics worker (see loop()).
+        sb_feedback_rep - spinBox - repetition period of the correction
+        pb_start_feedback - pushBatton Off/On
         :return:
         """
 
@@ -458,11 +603,17 @@ class UIAFeedBack(QWidget, Ui_Form):
             logger.info("start_stop_feedback: St.FB is running")
             return 0
 
-        delay = self.sb_feedback_rep.value()*1000
         if self.pb_start_feedback.text() == "Stop Feedback":
             self.stop_feedback()
         elif self.pb_start_feedback.text() == "Start Feedback":
-            self.feedback_timer.start(delay)
+            if not self.orbit_class.is_rm_ok(self.orbit):
+                logger.error(" start_stop_feedback: Calculate Response Matrix")
+                self.error_box("Calculate Response Matrix")
+                return 0
+            self.read_settings()
+            self.correction_setup = self.read_correction_setup()
+            self.next_correction = time.monotonic()
+            self.feedback_on = True
             logger.info("Start Feedback")
             self.pb_start_feedback.setText("Stop Feedback")
             self.pb_start_feedback.setStyleSheet("color: red")
@@ -470,14 +621,15 @@ class UIAFeedBack(QWidget, Ui_Form):
             logger.warning("start_stop_feedback: To early")
 
 
-    def auto_correction(self):
+    def auto_correction(self, engine):
         """
-        Method repeats correction in a loop.
-        repetition rate is defined by spinBox - sb_feedback_sec
-        feedback_timer - QTimer to repats correction oin different thread
+        One correction step, called from loop() in the worker thread.
+        repetition rate is defined by spinBox - sb_feedback_rep
 
-        :return:
+        :param engine: FeedbackEngine
+        :return: (x, y) reference orbit relative to the golden orbit or None
         """
+        budget = engine.budget
 
         if self.mi_standard_fb is not None:
             try: 
@@ -488,182 +640,232 @@ class UIAFeedBack(QWidget, Ui_Form):
             
         if self.mi_standard_fb is not None and is_st_fb_running:
             logger.info("auto_correction: St.FB is running. Stop Ad. FB")
-            self.stop_feedback()
-            return 0
-        
-        is_nan = self.ref_orbit_calc()
-        if is_nan:
-            logger.warning("auto_correction: nan in the ref orbit. Pause 1 sec")
-            time.sleep(1)
-            return
+            self.feedback_on = False
+            return None, CorrectionStep(cor_ids=(), kicks_read=None, kicks=None, applied=False,
+                                        stop_reason="Standard FeedBack is running!")
+
+        with budget.stage("estimate"):
+            delta_ro = self.ref_orbit_calc()
+        if delta_ro is None:
+            logger.warning("auto_correction: nan in the ref orbit. Skip correction")
+            return None, None
+
+        with budget.stage("solve"):
+            step = self.correct()
+        if step.kicks is not None and step.stop_reason is None:
+            with budget.stage("write"):
+                step = self.apply_kicks(step)
+            # history for the browser is optional, it is skipped if the cycle is about to overrun
+            if step.applied and budget.allows("history", reserve=("plot",)):
+                with budget.stage("history"):
+                    self.capture_history([{"corrector": cor_id, "value": kick_mrad}
+                                          for cor_id, kick_mrad in zip(step.cor_ids, step.kicks)])
+        if step.stop_reason is not None:
+            self.feedback_on = False
+        return delta_ro, step
+
+    def read_correction_setup(self):
+        """
+        Method copies everything the worker needs for the correction (GUI thread): response matrix of
+        self.orbit in the order of self.orbit.corrs and self.orbit.bpms, a solver with its own cache,
+        corrector limits and the close orbit option.
 
-        start = time.time()
-        stop_flag = self.correct()
-        print("correct: ", time.time() - start)
-        time.sleep(0.01)
-        if not stop_flag:
-            start = time.time()
-            self.apply_kicks()
-            print("apply_kicks: ", time.time() - start)
-            self.sase_hist.append(self.target_filtered[-1])
-            self.le_warn.clear()
+        :return: dict
+        """
+        rm = self.orbit.response_matrix
+        cor_ids = [cor.id for cor in self.orbit.corrs]
+        if self.parent.solver_name == "SVD":
+            solver = CachedOrbitSVD(epsilon_x=self.parent.svd_epsilon_x, epsilon_y=self.parent.svd_epsilon_y,
+                                    cache=SolverCache())
         else:
-            logger.warning("auto_correction: stop_flag = True. Pause 1 sec")
-            self.le_warn.clear()
-            self.le_warn.setText("Stop flag. Kicks are not applied")
-            self.le_warn.setStyleSheet("color: red")
-
-            time.sleep(1)
+            solver = CachedMICADO(epsilon_x=self.parent.svd_epsilon_x, epsilon_y=self.parent.svd_epsilon_y,
+                                  epsilon_ksi=self.parent.epsilon_ksi, cache=SolverCache())
+        solver.set_devices(self.orbit.bpms, self.orbit.corrs)
+        close_orbit = self.orbit_class.ui.cb_close_orbit.isChecked()
+        if close_orbit and len(self.orbit.bpms) < 10:
+            self.orbit_class.ui.cb_close_orbit.setChecked(False)
+            close_orbit = False
+        return {"cor_ids": tuple(cor_ids),
+                "rm": extract_matrix(rm.matrix, rm.cor_names, rm.bpm_names, cor_ids, self.bpms_name),
+                "solver": solver,
+                "weights": np.array([getattr(bpm, "weight", 1.) for bpm in self.orbit.bpms]),
+                "lims": np.array([cor.lims for cor in self.orbit.corrs], dtype=float),
+                "close_orbit": close_orbit,
+                "co_nlast_bpms": self.parent.co_nlast_bpms,
+                "apply_fraction": self.sb_afeed_fraction.value()}
 
     def correct(self):
         """
-        Method to the Orbit correctiion. Method calculate correctors strengths (kicks)
-        and call function to calculate (self.calc_orbit()) and draw orbit on the plot
-        but does not send it to the DOOCS server.
+        Method calculates the correctors strengths (kicks) for the reference orbit in self.orbit_state
+        (worker thread). Nothing is written to the elements or the GUI, see show_correction().
 
-        :return:
+        :return: CorrectionStep
         """
-        stop_flag = False
-        self.orbit_class.online_calc = False
-        # read orbit devs
+        setup = self.correction_setup
+        cor_ids = setup["cor_ids"]
+        values, errors = self.mi.get_devices_values([elem.mi for elem in self.orbit.corrs])
         for elem in self.orbit.corrs:
-            try:
-                elem.kick_mrad = elem.mi.get_value()
-            except Exception as e:
-                stop_flag = True
-                logger.warning(elem.id + " reading error: " + str(e))
-                return stop_flag
-                
-            elem.angle_read = elem.kick_mrad*1e-3
-            elem.i_kick = elem.kick_mrad
-            elem.ui.set_init_value(elem.kick_mrad)
-            elem.ui.set_value(elem.kick_mrad)
-            elem.transfer_map = self.parent.lat.method.create_tm(elem)
-            if elem.ui.alarm:
-                stop_flag = True
-                logger.warning("correct - STOP: corrector shows alarm: " + elem.id)
-
-
-        #self.parent.lat.update_transfer_maps()
-
-        for elem in self.orbit.bpms:
-            if elem.id not in self.new_ref_orbit.keys():
-                logger.warning("correct - STOP: BPM is not in new ref orbit: " + elem.id)
-                stop_flag = True
-                return stop_flag
-            elem.x = self.new_ref_orbit[elem.id][0]
-            elem.y = self.new_ref_orbit[elem.id][1]
-            elem.ui.set_value((elem.x*1000., elem.y*1000.))
-            if elem.ui.alarm:
-                logger.warning("correct - STOP: BPM shows alarm: " + elem.id)
-                stop_flag = True
-        if stop_flag:
-            return stop_flag
-        self.orbit_class.online_calc = True
-
-
-        if not self.orbit_class.is_rm_ok(self.orbit):
-            logger.error(" correct: Calculate Response Matrix")
-            self.parent.error_box("Calculate Response Matrix")
-            return 0
-
-        self.orbit_class.golden_orbit.dict2golden_orbit()
-
-        if self.orbit_class.ui.cb_close_orbit.isChecked():
-            self.orbit_class.close_orbit()
-
-        self.calc_correction = {}
-        for cor in self.orbit.corrs:
-            cor.angle = 0.
-            self.calc_correction[cor.id] = cor.angle
-
-        alpha = 0.
-
-        self.orbit.correction(alpha=alpha, p_init=None, beta=0, print_log=False)
-        for cor in self.orbit.corrs:
-            self.calc_correction[cor.id] = cor.angle
-
-        self.set_values2correctors()
-        return stop_flag
+            if elem.mi.id in errors:
+                logger.warning(elem.id + " reading error: " + str(errors[elem.mi.id]))
+                return CorrectionStep(cor_ids=cor_ids, kicks_read=None, kicks=None, applied=False,
+                                      stop_reason="Corrector reading error: " + elem.id)
+        kicks_read = np.array(values, dtype=float)
+        self.orbit_state.set_kicks(kicks_read, init=True)
+        step = CorrectionStep(cor_ids=cor_ids, kicks_read=kicks_read, kicks=None, applied=False, stop_reason=None)
+
+        lims = setup["lims"]
+        alarm = (kicks_read < lims[:, 0]) | (kicks_read > lims[:, 1])
+        if np.any(alarm):
+            logger.warning("correct - STOP: corrector shows alarm: " + cor_ids[np.argmax(alarm)])
+            return step._replace(stop_reason="Stop flag. Corrector " + cor_ids[np.argmax(alarm)] + " is out of limits")
+
+        state = self.orbit_state
+        if not np.all(state.active):
+            missing = np.array(state.bpm_names)[~state.active]
+            logger.warning("correct - STOP: BPMs are not in new ref orbit: " + str(list(missing)))
+            return step._replace(stop_reason="Stop flag. BPMs are not in new ref orbit")
+        for bpm, x, y in zip(self.orbit.bpms, state.x, state.y):
+            if bpm.ui.is_alarm((x*1000., y*1000.)):
+                logger.warning("correct - STOP: BPM shows alarm: " + bpm.id)
+                return step._replace(stop_reason="Stop flag. BPM " + bpm.id + " shows alarm")
+
+        x_ref = state.x_ref.copy()
+        y_ref = state.y_ref.copy()
+        if setup["close_orbit"]:
+            x_ref[-setup["co_nlast_bpms"]:] = state.x[-setup["co_nlast_bpms"]:]
+            y_ref[-setup["co_nlast_bpms"]:] = state.y[-setup["co_nlast_bpms"]:]
+        orbit = np.append(state.x - x_ref, state.y - y_ref)
+        angles = correction_angles(setup["rm"], orbit, setup["solver"], alpha=0., beta=0.,
+                                   weights=setup["weights"])
+        kicks = kicks_read + angles*1000*setup["apply_fraction"]
+        state.set_kicks(kicks)
+        return step._replace(kicks=kicks)
+
+    def apply_kicks(self, step):
+        """
+        Method sends correctors kicks to DOOCS (worker thread), if strengths below the limits,
+        otherwise the feedback is stopped
 
-    def apply_kicks(self):
+        :param step: CorrectionStep with the new kicks
+        :return: CorrectionStep
+        """
+        lims = self.correction_setup["lims"]
+        if np.any((step.kicks < lims[:, 0]) | (step.kicks > lims[:, 1])):
+            logger.info("apply_kicks: kick exceeds limits. Try 'Uncheck Red' and recalculate correction")
+            return step._replace(stop_reason="kick exceeds limits. Try 'Uncheck Red' and recalculate correction")
+        ok, report = self.mi.set_devices_transaction([cor.mi for cor in self.orbit.corrs], step.kicks,
+                                                     snapshot=step.kicks_read)
+        for cor, kick_mrad, kick_init in zip(self.orbit.corrs, step.kicks, step.kicks_read):
+            logger.debug(cor.id + " set: %s --> %s" % (kick_init, kick_mrad))
+            if report[cor.mi.id]["error"] is not None:
+                logger.error(cor.id + " apply_kicks Error: " + report[cor.mi.id]["error"])
+        if not ok:
+            logger.error("apply_kicks: correction step is rolled back")
+        return step._replace(applied=ok)
+
+    def capture_history(self, kick_table):
         """
-        Method sends correctors kicks to DOOCS, if strengths below the limits,
-        otherwise error box will appear
+        Method saves a correction step for the history browser: kicks, reference orbit and objective function
 
+        :param kick_table: list of {"corrector", "value"}
         :return:
         """
-
-
-        for cor in self.orbit.corrs:
-            if cor.ui.alarm:
-                self.stop_feedback()
-                logger.info("apply_kicks: kick exceeds limits. Try 'Uncheck Red' and recalculate correction")
-                self.error_box("kick exceeds limits. Try 'Uncheck Red' and recalculate correction")
-                return 0
-        kick_table = []
-        for cor in self.orbit.corrs:
-            kick_mrad = cor.ui.get_value()
-            logger.debug(cor.id + " set: %s --> %s" % (cor.ui.get_init_value(), kick_mrad))
-            try:
-                cor.mi.set_value(kick_mrad)
-                kick_table.append({"corrector": cor.id, "value": kick_mrad})
-            except Exception as e:
-                logger.error(cor.id + " apply_kicks Error: " + str(e))
         self.cor_hist.append(kick_table)
+        self.x_hist.append(self.ref_aver_x)
+        self.y_hist.append(self.ref_aver_y)
+        self.sase_hist.append(self.history.targets_filtered.last()[0])
 
-    def set_values2correctors(self):
-
-        apply_fraction = self.sb_afeed_fraction.value()
-        self.orbit_class.online_calc = False
-        for cor in self.orbit.corrs:
-            kick_mrad_old = cor.ui.get_init_value()
-            if cor.id in self.calc_correction.keys():
-                cor.angle = self.calc_correction[cor.id]
+    def show_correction(self, step):
+        """
+        Method shows a correction step of the worker in the correctors table (GUI thread)
+        and stops the feedback if the step has a stop reason
 
-            delta_kick_mrad = cor.angle*1000*apply_fraction
-            new_kick_mrad = kick_mrad_old + delta_kick_mrad
-            cor.kick_mrad = new_kick_mrad
-            cor.ui.set_value(cor.kick_mrad)
-            warn = (np.abs(new_kick_mrad) - np.abs(kick_mrad_old)) > 0.5
+        :param step: CorrectionStep
+        :return:
+        """
+        if step.kicks_read is not None:
+            corrs = {cor.id: cor for cor in self.orbit.corrs}
+            self.orbit_class.online_calc = False
+            for i, cor_id in enumerate(step.cor_ids):
+                cor = corrs[cor_id]
+                kick_mrad_old = step.kicks_read[i]
+                cor.kick_mrad = kick_mrad_old if step.kicks is None else step.kicks[i]
+                cor.i_kick = kick_mrad_old
+                cor.angle_read = kick_mrad_old*1e-3
+                cor.ui.set_init_value(kick_mrad_old)
+                cor.ui.set_value(cor.kick_mrad)
+                warn = (np.abs(cor.kick_mrad) - np.abs(kick_mrad_old)) > 0.5
+                cor.ui.check_values(cor.kick_mrad, cor.lims, warn)
+            self.orbit_class.online_calc = True
+            if self.settings.get("update_display", self.cb_update_display.isChecked()):
+                self.orbit_class.calc_orbit()
+        if step.stop_reason is None:
+            self.le_warn.clear()
+            return
+        logger.warning("show_correction: " + step.stop_reason + ". Kicks are not applied")
+        self.stop_feedback()
+        if step.stop_reason.startswith("Stop flag"):
+            self.le_warn.setText(step.stop_reason)
+            self.le_warn.setStyleSheet("color: red")
+        else:
+            self.error_box(step.stop_reason)
 
-            cor.ui.check_values(cor.kick_mrad, cor.lims, warn)
-        self.orbit_class.online_calc = True
-        if self.cb_update_display.isChecked():
-            self.orbit_class.calc_orbit()
+    def start_streamer(self):
+        """
+        Method starts (or joins) the OrbitStreamer of the BPM frontend server for the statistics
+        """
+        if self.streamer is not None:
+            release_streamer(self.streamer)
+        mi_orbit = self.orbit_class.mi_orbit
+        frontend = mi_orbit.__class__(server=mi_orbit.server, subtrain=mi_orbit.subtrain)
+        frontend.bpm_server = "BPM"
+        frontend.mi = mi_orbit.mi
+        self.streamer = acquire_streamer(frontend)
+        self.last_train_id = None
+        self.bpm_index_src = None
+        self.bpms_name = [elem.id for elem in self.orbit.bpms]
+        self.orbit_s = np.array([elem.s for elem in self.orbit.bpms])
 
     def read_bpms(self):
+        """
+        Method takes the next train of the OrbitStreamer (one wildcard read of X, Y and CHARGE for all BPMs)
+        and gathers it onto self.orbit.bpms with an index which is rebuilt only if the BPM list of the stream changes.
+        stop_statistics() releases the streamer from the GUI thread, the worker keeps its own reference to it.
+
+        :return: beam_on, orbit_x [m], orbit_y [m], orbit_s
+        """
         charge_thresh = 0.005
-        beam_on = True
-        orbit_x = []
-        orbit_y = []
-        orbit_s = []
-        self.bpms_name = []
+        nbpms = len(self.orbit.bpms)
+        streamer = self.streamer
+        if streamer is None:
+            return False, np.full(nbpms, np.nan), np.full(nbpms, np.nan), self.orbit_s
+        snapshot = streamer.wait_next(after=self.last_train_id, timeout=max(self.settings["time_delay"], 0.5))
+        if snapshot is None:
+            if self.streamer is streamer:
+                self.show_warning("beam OFF")
+            return False, np.full(nbpms, np.nan), np.full(nbpms, np.nan), self.orbit_s
+        self.last_train_id = snapshot.train_id
+        if snapshot.index is not self.bpm_index_src:
+            self.bpm_indx, self.bpm_found = snapshot_indices(snapshot, self.bpms_name)
+            self.bpm_index_src = snapshot.index
+        orbit_x = snapshot.x[self.bpm_indx] / 1000.
+        orbit_y = snapshot.y[self.bpm_indx] / 1000.
+        charge = snapshot.charge[self.bpm_indx]
+        orbit_x[~self.bpm_found] = np.nan
+        orbit_y[~self.bpm_found] = np.nan
 
-        for elem in self.orbit.bpms:
-            try:
-
-                x_mm, y_mm = elem.mi.get_pos_frontend()
-                charge = elem.mi.get_charge()
-                if not self.dev_mode and charge < charge_thresh:
-                    # TODO: add a checking for beam on/off
-                    if self.orbit_class.xfel_mps.is_orbit_on():
-                        logger.info("charge < charge_thresh: " + str(charge < charge_thresh))
-                    self.le_warn.clear()
-                    self.le_warn.setText(elem.id + " charge < charge_thresh")
-                    self.le_warn.setStyleSheet("color: red")
-                    beam_on = False
-                x = x_mm / 1000.
-                y = y_mm / 1000.
-                orbit_x.append(x) #[elem.s, x, y])
-                orbit_y.append(y)
-                orbit_s.append(elem.s)
-                self.bpms_name.append(elem.id)
-            except:
-                self.le_warn.clear()
-                self.le_warn.setText("beam OFF")
-                beam_on = False
-        return beam_on, np.array(orbit_x), np.array(orbit_y), np.array(orbit_s)
+        beam_on = True
+        if not self.bpm_found.all():
+            self.show_warning("beam OFF: " + self.bpms_name[np.argmin(self.bpm_found)] + " is not in the orbit")
+            beam_on = False
+        low_charge = ~(charge >= charge_thresh)
+        if not self.dev_mode and np.any(low_charge & self.bpm_found):
+            # TODO: add a checking for beam on/off
+            if self.orbit_class.xfel_mps.is_orbit_on():
+                logger.info("charge < charge_thresh: " + str(np.count_nonzero(low_charge)) + " BPMs")
+            self.show_warning(self.bpms_name[np.argmax(low_charge & self.bpm_found)] + " charge < charge_thresh")
+            beam_on = False
+        return beam_on, orbit_x, orbit_y, self.orbit_s
 
     def read_data(self):
         beam_on, orbit_x, orbit_y, orbit_s = self.read_bpms()
@@ -671,44 +873,22 @@ class UIAFeedBack(QWidget, Ui_Form):
             return beam_on
         target = self.read_objective_function()
         if target is None:
-            self.stop_statistics()
             return None
 
         if not isinstance(target, numbers.Number) or np.isnan(target) or np.isinf(target):
             logger.warning("read data: target is not number/NaN/inf: " + str(target))
             return False
 
-        if len(self.target_values) >= self.nreadings:
-            self.target_values = self.target_values[1:]
-
-            self.orbits_x = self.orbits_x[1:]
-            self.orbits_y = self.orbits_y[1:]
-        self.target_values = np.append(self.target_values, target)
-        self.orbits_x.append(orbit_x)
-        self.orbits_y.append(orbit_y)
+        self.history.append(orbit_x, orbit_y, target)
 
         self.orbit_s = orbit_s
-        self.filter_target_func()
 
         self.update_plot_counter += 1
-        self.update_obj_plot()
         return beam_on
 
-    def filter_target_func(self):
-        if len(self.target_values) <= self.nring:
-            y_nring = np.mean(self.target_values)
-        else:
-            y_nring = np.mean(self.target_values[-self.nring:])
-        if len(self.target_filtered) >= self.nreadings:
-            self.target_filtered = self.target_filtered[1:]
-        self.target_filtered = np.append(self.target_filtered, y_nring)
-
-
-    def update_obj_plot(self, ):
-
-        self.obj_curve.setData(x=np.arange(len(self.target_values)), y=np.array(self.target_values))
-
-        self.obj_curve_filtered.setData(x=np.arange(len(self.target_filtered)), y=np.array(self.target_filtered))
+    def update_obj_plot(self, targets, targets_filtered):
+        self.obj_curve.setData(x=np.arange(len(targets)), y=targets)
+        self.obj_curve_filtered.setData(x=np.arange(len(targets_filtered)), y=targets_filtered)
 
     def update_orb_plot(self):
         self.orb_y.setData(x=self.orbit_s, y= self.ref_aver_x)
@@ -717,7 +897,11 @@ class UIAFeedBack(QWidget, Ui_Form):
 
     def stop_statistics(self):
         self.stop_feedback()
-        self.statistics_timer.stop()
+        if self.engine is not None:
+            self.engine.stop()
+        if self.streamer is not None:
+            release_streamer(self.streamer)
+            self.streamer = None
         logger.info("Stop Statistics")
         self.pb_start_statistics.setStyleSheet("color: rgb(85, 255, 127);")
         self.pb_start_statistics.setText("Statistics Accum On")
@@ -727,31 +911,13 @@ class UIAFeedBack(QWidget, Ui_Form):
             val = self.objective_func()
         except:
             logger.error("read_objective_function: Wrong Objective Function")
-            self.error_box("Wrong Objective Function")
             return None
         return val
 
     def calc_golden_orbit(self):
-        targets = np.array(self.target_values)
-        indx = np.argsort(targets)
-        orbits_x = np.array(self.orbits_x)
-        orbits_y = np.array(self.orbits_y)
-        n_orbits = len(orbits_x)
-        num_good_obits = int(n_orbits*self.sb_averaging.value()*0.01)
-        if num_good_obits<1:
-            num_good_obits = 1
-        best_orbits_x = orbits_x[indx[-num_good_obits:]]
-        best_orbits_y = orbits_y[indx[-num_good_obits:]]
-        if len(best_orbits_x) ==1:
-            aver_x = best_orbits_x[0]
-            aver_y = best_orbits_y[0]
-        else:
-            aver_x = np.mean(best_orbits_x, axis=0)
-            aver_y = np.mean(best_orbits_y, axis=0)
-        new_golden_orbit = {}
-
-        for i, name in enumerate(self.bpms_name):
-            new_golden_orbit[name] = [aver_x[i], aver_y[i]]
+        aver_x, aver_y = self.history.best_orbits(fraction=self.settings["averaging"]*0.01)
+        new_golden_orbit = {name: [x, y] for name, x, y in zip(self.bpms_name, aver_x, aver_y)}
+        self.orbit_state.set_reference(new_golden_orbit)
         self.orbit_class.golden_orbit.update_golden_orbit(new_golden_orbit)
 
         if len(self.first_go_x) != len(aver_x) or len(self.first_go_y) != len(aver_y):
@@ -760,42 +926,31 @@ class UIAFeedBack(QWidget, Ui_Form):
         else:
             delta_go_x = aver_x - self.first_go_x
             delta_go_y = aver_y - self.first_go_y
-        # if tab is active
-        if self.tabWidget.currentIndex() == 2:
-            self.orb_x_ref.setData(x=self.orbit_s, y=delta_go_x*1000)
-            self.orb_y_ref.setData(x=self.orbit_s, y=delta_go_y*1000)
 
         self.cur_go_x = aver_x
         self.cur_go_y = aver_y
-        return aver_x, aver_y
+        return aver_x, aver_y, (delta_go_x, delta_go_y)
 
     def ref_orbit_calc(self):
-        # ********* reference orbit ***********
-
-        nlast_readings = int(self.sb_ref_orbit_nread.value())
-
-        orbits_x = np.array(self.orbits_x)
-        orbits_y = np.array(self.orbits_y)
-        n_orbits = len(orbits_x)
-
-        if n_orbits < nlast_readings:
-            nlast_readings = n_orbits - 1
-
-        num_bad_orbits = int(n_orbits*0.2) # 20% bad orbits
+        """
+        Reference orbit: mean of the last sb_ref_orbit_nread orbits
 
-        ref_orbits_x = orbits_x[-nlast_readings:]
-        ref_orbits_y = orbits_y[-nlast_readings:]
+        :return: (x, y) reference orbit relative to the golden orbit or None if there is NaN in the reference orbit
+        """
+        nlast_readings = self.settings["ref_orbit_nread"]
 
-        self.ref_aver_x = np.mean(ref_orbits_x, axis=0)
-        self.ref_aver_y = np.mean(ref_orbits_y, axis=0)
+        # running means of the last nlast_readings orbits, copied because they are kept in x_hist/y_hist
+        aver_x, aver_y = self.history.ref_orbit(nlast_readings)
+        self.ref_aver_x = aver_x.copy()
+        self.ref_aver_y = aver_y.copy()
         x_nan_check = len(np.where(np.isnan(self.ref_aver_x) == True)[0])
         y_nan_check = len(np.where(np.isnan(self.ref_aver_y) == True)[0])
 
         if x_nan_check > 0 or y_nan_check > 0:
-            return True
-        self.new_ref_orbit = {}
-        for i, name in enumerate(self.bpms_name):
-            self.new_ref_orbit[name] = [self.ref_aver_x[i], self.ref_aver_y[i]]
+            return None
+        self.orbit_state.active[:] = True
+        self.orbit_state.set_orbit(self.bpms_name, self.ref_aver_x*1000., self.ref_aver_y*1000.)
+        self.new_ref_orbit = self.orbit_state.orbit_dict()
 
         if len(self.cur_go_x) != len(self.ref_aver_x ) or len(self.cur_go_y) != len(self.ref_aver_y ):
             delta_ro_x = self.ref_aver_x
@@ -803,16 +958,7 @@ class UIAFeedBack(QWidget, Ui_Form):
         else:
             delta_ro_x = self.ref_aver_x - self.cur_go_x
             delta_ro_y = self.ref_aver_y - self.cur_go_y
-
-        # save to history
-        self.x_hist.append(self.ref_aver_x)
-        self.y_hist.append(self.ref_aver_y)
-
-        # if tab is active
-        if self.tabWidget.currentIndex() == 1:
-            self.orb_y.setData(x=self.orbit_s, y=delta_ro_x*1000)
-            self.orb_x.setData(x=self.orbit_s, y=delta_ro_y*1000)
-        return False
+        return delta_ro_x, delta_ro_y
 
 
     def set_obj_fun(self):
@@ -830,20 +976,24 @@ class UIAFeedBack(QWidget, Ui_Form):
         state_b = self.is_le_addr_ok(self.le_b)
         c_str = str(self.le_c.text())
         state_c = self.is_le_addr_ok(self.le_c)
-        func = str(self.le_of.text())
+        try:
+            expression = ObjectiveExpression(str(self.le_of.text()))
+        except ValueError as e:
+            logger.error("set_obj_fun: " + str(e))
+            self.error_box(str(e))
+            return None
+        # only channels which are valid and used in the expression are read, in one bulk request
+        channels = {name: ch for name, ch, state in zip(("A", "B", "C"), (a_str, b_str, c_str),
+                                                        (state_a, state_b, state_c))
+                    if state and name in expression.used_channels}
+        names = list(channels.keys())
+        addresses = list(channels.values())
+
         def get_value_exp():
-            A = 0.
-            B = 0.
-            C = 0.
-            if state_a:
-                A = self.mi.get_value(a_str)
-            if state_b:
-                B = self.mi.get_value(b_str)
-            if state_c:
-                C = self.mi.get_value(c_str)
-            if func == "":
-                return 0
-            return eval(func)
+            values, errors = self.mi.get_values(addresses)
+            if errors:
+                raise IOError("objective function: could not read " + ", ".join(errors.keys()))
+            return expression.evaluate(**{name: expression.channel_value(name, val) for name, val in zip(names, values)})
 
         self.objective_func = get_value_exp
 
@@ -25,6 +25,7 @@ import time
 import pyqtgraph as pg
 from gui.uicorrelation import *
 from mint.xfel_interface import *
+from mint.wildcard import decode_wildcard
 
 
 class ManulInterfaceWindow(QMainWindow, Ui_MainWindow):
@@ -135,8 +136,8 @@ class ManulInterfaceWindow(QMainWindow, Ui_MainWindow):
             return False 
         self.sase_array[i] = sase
         self.energy_array[i] = energy_ch
-        values_x = np.array([data[1] for data in orbit_x["data"]])
-        values_y = np.array([data[1] for data in orbit_y["data"]])
+        values_x = decode_wildcard(orbit_x["data"])["value"]
+        values_y = decode_wildcard(orbit_y["data"])["value"]
         #names = [data["str"] for data in orbit["data"]]
         self.bpms_x[:,i] = values_x[:]
         self.bpms_y[:,i] = values_y[:]
@@ -234,8 +235,9 @@ class ManulInterfaceWindow(QMainWindow, Ui_MainWindow):
         self.n_real_readings = 0
         #delay = self.sb_update_rate.value()*1000
         orbit = pydoocs.read("XFEL.DIAG/ORBIT/*/X.ALL")
-        values = np.array([data[1] for data in orbit["data"]])
-        names = [data[4] for data in orbit["data"]]
+        rec = decode_wildcard(orbit["data"])
+        values = rec["value"]
+        names = rec["name"].tolist()
 
         indx_bpma_2591 = names.index("BPMA.2591.T4")
         self.bpm_index = indx_bpma_2591
@@ -3,6 +3,7 @@ Sergey Tomin, XFEL/DESY, 2017
 """
 import numpy as np
 from mint.devices import *
+from orbit_state import OrbitState
 import time
 import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore
@@ -87,7 +88,8 @@ class DispersionInterface:
         bpms = self.parent.orbit.bpms
         bpms = self.parent.orbit.get_dev_from_cb_state(bpms)
 
-        s_bpm = np.array([bpm.s for bpm in bpms])
+        orbit_state = OrbitState(bpms=bpms)
+        s_bpm = orbit_state.s
 
         #x_mean_i, y_mean_i, x_std_i, y_std_i = self.get_orbit(bpms)
 
@@ -101,9 +103,9 @@ class DispersionInterface:
             print("set Voltage: ",  v)
             time.sleep(time_delay)
             bpm_names, x_mean, y_mean, mean_charge = self.parent.orbit.mi_orbit.read_and_average(n_readings+1, n_readings)
-            self.parent.orbit.mi_orbit.get_bpms(bpms)
-            x_mean = np.array([bpm.x for bpm in bpms])
-            y_mean = np.array([bpm.y for bpm in bpms])
+            self.parent.orbit.mi_orbit.get_bpms(bpms, state=orbit_state)
+            x_mean = orbit_state.x.copy()
+            y_mean = orbit_state.y.copy()
             X_mean.append(x_mean)
             Y_mean.append(y_mean)
             
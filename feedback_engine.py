@@ -0,0 +1,273 @@
+"""
+Worker thread for the Orbit Keeper and the adaptive feedback.
+The machine I/O, waits and number crunching of a feedback cycle run in the worker, the GUI gets
+immutable snapshots through Qt signals and Qt widgets are only touched in the GUI thread (see GuiInvoker).
+
+Every cycle has a budget: it has to be finished before the next scheduled start. The stages of the cycle
+(read, estimate, solve, write, settle, ...) are timed with engine.budget.stage(name) into latency histograms,
+optional stages (plot update, history capture) are skipped if engine.budget.allows(name) says that the
+cycle would overrun.
+"""
+import os
+import json
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from threading import Thread, Event
+import numpy as np
+from PyQt5 import QtCore
+from gui.invoker import GuiInvoker
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CycleSnapshot = namedtuple("CycleSnapshot", ["ncycle", "start", "duration", "overruns", "data", "stats"])
+CycleSnapshot.__doc__ = """
+Immutable result of one feedback cycle
+
+:param ncycle: number of the cycle
+:param start: start of the cycle, time.monotonic() [sec]
+:param duration: duration of the cycle [sec]
+:param overruns: number of cycles which took longer than the period
+:param data: result of the cycle function (should be immutable too, e.g. namedtuple or tuple of copied arrays)
+:param stats: dictionary with latency statistics (see FeedbackEngine.get_stats())
+"""
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with log spaced bins, preallocated (adding a value does not allocate memory)
+
+    :param t_min: lower edge of the first bin [sec]
+    :param t_max: upper edge of the last bin [sec]
+    :param nbins: number of bins
+    """
+    def __init__(self, t_min=1e-5, t_max=100., nbins=140):
+        self.edges = np.logspace(np.log10(t_min), np.log10(t_max), nbins + 1)
+        # counts[0] - underflow, counts[-1] - overflow
+        self.counts = np.zeros(nbins + 2, dtype=np.int64)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, dt):
+        self.counts[np.searchsorted(self.edges, dt, side="right")] += 1
+        self.n += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def percentile(self, q):
+        """
+        :param q: quantile [0, 1]
+        :return: upper edge of the bin with the q-quantile [sec], 0 if the histogram is empty
+        """
+        if self.n == 0:
+            return 0.
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.n, side="left"))
+        if i == 0:
+            return self.edges[0]
+        if i > len(self.edges) - 1:
+            return self.max
+        return min(self.edges[i], self.max)
+
+    def as_dict(self):
+        return {"n": self.n, "mean": self.total / self.n if self.n else 0., "max": self.max,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99)}
+
+
+class LatencyStats:
+    """
+    Latency histograms of the cycle stages and counters of the skipped optional stages
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.skipped = OrderedDict()
+
+    def add(self, stage, dt):
+        if stage not in self.stages:
+            self.stages[stage] = LatencyHistogram()
+        self.stages[stage].add(dt)
+
+    def percentile(self, stage, q):
+        if stage not in self.stages:
+            return 0.
+        return self.stages[stage].percentile(q)
+
+    def skip(self, stage):
+        self.skipped[stage] = self.skipped.get(stage, 0) + 1
+
+    def as_dict(self):
+        return {"stages": {name: hist.as_dict() for name, hist in self.stages.items()},
+                "skipped": dict(self.skipped)}
+
+
+class CycleBudget:
+    """
+    Time budget of one cycle: from the start of the cycle to the next scheduled start
+
+    :param stats: LatencyStats
+    :param deadline: time.monotonic() of the next scheduled start
+    """
+    def __init__(self, stats, deadline):
+        self.stats = stats
+        self.deadline = deadline
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager which adds the duration of the block to the histogram of the stage
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stats.add(name, time.monotonic() - start)
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def allows(self, stage, reserve=()):
+        """
+        Method decides if an optional stage can be done without overrun of the cycle.
+        Expected duration is the p99 of the stage plus p99 of the stages which still have to be done (reserve).
+        A skipped stage is counted in LatencyStats.skipped.
+
+        :param stage: name of the optional stage
+        :param reserve: names of the stages which follow the optional one
+        :return: True if the stage can be done
+        """
+        expected = self.stats.percentile(stage, 0.99) + sum(self.stats.percentile(name, 0.99) for name in reserve)
+        if self.remaining() > expected:
+            return True
+        self.stats.skip(stage)
+        return False
+
+
+class EngineSignals(QtCore.QObject):
+    cycle_done = QtCore.pyqtSignal(object)      # CycleSnapshot
+    stopped = QtCore.pyqtSignal(str)            # reason
+
+
+class FeedbackEngine(Thread):
+    """
+    Runs cycle(engine) at a fixed repetition rate. The schedule is kept on time.monotonic():
+    the next cycle starts at start + n*period independently of the cycle duration, missed slots are skipped
+    (counted in self.overruns) and the phase is preserved.
+
+    Must be created in the GUI thread, engine.gui.call(func, *args) runs func in the GUI thread.
+
+    :param cycle: function(engine) -> data or None. data is sent with signals.cycle_done,
+                  the cycle can stop the engine with engine.stop(reason)
+    :param period: repetition period [sec]
+    :param name: name for logging
+    :param stats_file: JSON file where get_stats() is written every stats_interval seconds, None - no file
+    :param stats_interval: [sec]
+    """
+    def __init__(self, cycle, period, name="feedback", stats_file=None, stats_interval=1.):
+        super(FeedbackEngine, self).__init__(name=name)
+        self.daemon = True
+        self.cycle = cycle
+        self.period = period
+        self._stop_event = Event()
+        self.signals = EngineSignals()
+        self.gui = GuiInvoker()
+        self.reason = "stopped"
+        self.ncycles = 0
+        self.overruns = 0
+        self.errors = 0
+        self.stats = LatencyStats()
+        self.budget = CycleBudget(self.stats, time.monotonic() + period)
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self._stats_written = 0.
+
+    def run(self):
+        logger.info(" FeedbackEngine: " + self.name + " started. period = " + str(self.period) + " sec")
+        next_start = time.monotonic()
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            self.budget = CycleBudget(self.stats, next_start + self.period)
+            try:
+                data = self.cycle(self)
+            except Exception as e:
+                self.errors += 1
+                logger.error(" FeedbackEngine: " + self.name + " cycle error: " + str(e))
+                data = None
+            stop = time.monotonic()
+            self.stats.add("cycle", stop - start)
+            self.ncycles += 1
+            next_start += self.period
+            if stop > next_start:
+                missed = int((stop - next_start) // self.period) + 1
+                self.overruns += 1
+                logger.debug(" FeedbackEngine: " + self.name + " overrun: cycle = " + str(stop - start) + " sec")
+                next_start += missed * self.period
+            if data is not None:
+                self.signals.cycle_done.emit(CycleSnapshot(self.ncycles, start, stop - start, self.overruns, data,
+                                                           self.get_stats()))
+            if self.stats_file is not None and stop - self._stats_written > self.stats_interval:
+                self.write_stats()
+                self._stats_written = stop
+            self._stop_event.wait(max(0., next_start - time.monotonic()))
+        if self.stats_file is not None:
+            self.write_stats()
+        logger.info(" FeedbackEngine: " + self.name + " stopped: " + self.reason)
+        self.signals.stopped.emit(self.reason)
+
+    def get_stats(self):
+        """
+        Machine-readable statistics of the engine
+
+        :return: dictionary {"name", "period", "ncycles", "overruns", "errors",
+                 "stages": {stage: {"n", "mean", "max", "p50", "p99"}}, "skipped": {stage: n}}, times in [sec]
+        """
+        stats = {"name": self.name, "period": self.period, "ncycles": self.ncycles,
+                 "overruns": self.overruns, "errors": self.errors}
+        stats.update(self.stats.as_dict())
+        return stats
+
+    def write_stats(self):
+        tmp_file = self.stats_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self.get_stats(), f, indent=1)
+            os.replace(tmp_file, self.stats_file)
+        except Exception as e:
+            logger.warning(" FeedbackEngine: write_stats: " + str(e))
+
+    def sleep(self, delay):
+        """
+        Interruptible time.sleep() for the cycle function
+
+        :param delay: [sec]
+        :return: False if the engine was stopped during the sleep
+        """
+        return not self._stop_event.wait(delay)
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def stop(self, reason="stopped"):
+        self.reason = reason
+        self._stop_event.set()
+
+
+def format_stats(stats, stages=("read", "estimate", "solve", "write", "settle", "plot", "history", "cycle")):
+    """
+    Short text with p50/p99 of the stages in [ms] and the overrun counter, e.g. for a QLabel
+
+    :param stats: dictionary from FeedbackEngine.get_stats()
+    :param stages: stages to show
+    :return: str
+    """
+    parts = []
+    for name in stages:
+        if name in stats["stages"]:
+            st = stats["stages"][name]
+            parts.append("%s %.0f/%.0f" % (name, st["p50"] * 1000, st["p99"] * 1000))
+    text = "p50/p99 [ms]: " + ", ".join(parts) + " | overruns: " + str(stats["overruns"]) + "/" + str(stats["ncycles"])
+    if stats["skipped"]:
+        text += " | skipped: " + ", ".join(name + " " + str(n) for name, n in stats["skipped"].items())
+    return text
@@ -0,0 +1,75 @@
+"""
+Running functions in the GUI thread from worker threads.
+"""
+from PyQt5 import QtCore
+from threading import Event
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc = None
+        self.done = Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.exc = e
+        self.done.set()
+
+
+class GuiInvoker(QtCore.QObject):
+    """
+    Queues functions into the event loop of the thread the object was created in (the GUI thread).
+    Must be created in the GUI thread. Signals emitted from other threads are delivered as queued connections.
+    """
+    invoke = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super(GuiInvoker, self).__init__(parent)
+        self.invoke.connect(self._run)
+
+    @QtCore.pyqtSlot(object)
+    def _run(self, job):
+        if isinstance(job, _Job):
+            job.run()
+        else:
+            job()
+
+    def in_gui_thread(self):
+        return QtCore.QThread.currentThread() == self.thread()
+
+    def post(self, func):
+        """
+        Method runs func() in the GUI thread at the next event loop iteration and returns immediately
+
+        :param func: function without arguments
+        :return:
+        """
+        self.invoke.emit(func)
+
+    def call(self, func, *args, timeout=None):
+        """
+        Method runs func(*args) in the GUI thread and waits for the result.
+        Called from the GUI thread the function is executed directly.
+
+        :param func: function
+        :param args: arguments
+        :param timeout: timeout in [sec], None - wait forever
+        :return: result of func
+        """
+        if self.in_gui_thread():
+            return func(*args)
+        job = _Job(func, args)
+        self.invoke.emit(job)
+        if not job.done.wait(timeout):
+            raise TimeoutError("GuiInvoker: " + getattr(func, "__name__", str(func)) + " timeout")
+        if job.exc is not None:
+            raise job.exc
+        return job.result
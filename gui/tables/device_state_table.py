@@ -0,0 +1,198 @@
+"""
+Qt views on top of mint.devices.DeviceStateModel.
+The model is the source of truth for the numbers, the widgets are repainted in batches of changed rows.
+"""
+from PyQt5 import QtGui, QtCore
+import numpy as np
+import logging
+from gui.invoker import GuiInvoker
+
+logger = logging.getLogger(__name__)
+
+
+class TableWidgetSync:
+    """
+    Keeps an existing QTableWidget (columns: id, init value, setpoint spin box, checkbox)
+    in sync with a DeviceStateModel.
+
+    Model -> widget: changed rows are collected and repainted once per event loop iteration.
+    Widget -> model: spin box edits and checkbox clicks are written into the model arrays.
+
+    :param model: DeviceStateModel
+    :param table: QTableWidget
+    :param on_change: function without arguments called after a value is edited by the user in a spin box.
+                      Repaints of the model changes do not call it.
+    """
+    def __init__(self, model, table, on_change=None, init_col=1, value_col=2, check_col=3, diff_tol=0.01):
+        self.model = model
+        self.table = table
+        self.on_change = on_change
+        self.init_col = init_col
+        self.value_col = value_col
+        self.check_col = check_col
+        self.diff_tol = diff_tol
+        # flushes are posted to the GUI thread, the model can be changed from the feedback worker threads
+        self.invoker = GuiInvoker()
+        self.model.scheduler = self.invoker.post
+        self.model.add_listener(self.repaint_rows)
+        self.table.itemChanged.connect(self.item_changed)
+
+    def detach(self):
+        """
+        Disconnect from the table, e.g. before the table is refilled for a new lattice section
+        """
+        try:
+            self.table.itemChanged.disconnect(self.item_changed)
+        except TypeError:
+            pass
+        self.model.listeners.remove(self.repaint_rows)
+        self.model.scheduler = None
+
+    def connect_spin_box(self, row, spin_box):
+        spin_box.valueChanged.connect(lambda val, row=row: self.value_edited(row, val))
+
+    def value_edited(self, row, val):
+        self.model.set_value(row, val, notify=False)
+        if self.on_change is not None:
+            self.on_change()
+
+    def item_changed(self, item):
+        if item.column() != self.check_col:
+            return
+        self.model.set_active(item.row(), item.checkState() == QtCore.Qt.Checked, notify=False)
+
+    def repaint_rows(self, rows):
+        self.table.blockSignals(True)
+        try:
+            for row in rows:
+                spin_box = self.table.cellWidget(row, self.value_col)
+                if spin_box is not None:
+                    spin_box.blockSignals(True)
+                    spin_box.setValue(self.model.values[row])
+                    spin_box.blockSignals(False)
+
+                item = self.table.item(row, self.init_col)
+                if item is not None:
+                    item.setText(str(np.round(self.model.init_values[row], 4)))
+                    diff = np.abs(self.model.values[row] - self.model.init_values[row])
+                    if diff > self.diff_tol:
+                        item.setForeground(QtGui.QColor(255, 101, 101))  # red
+                    else:
+                        item.setForeground(QtGui.QColor(255, 255, 255))  # white
+
+                item = self.table.item(row, self.check_col)
+                if item is not None:
+                    item.setCheckState(QtCore.Qt.Checked if self.model.active[row] else QtCore.Qt.Unchecked)
+
+                item = self.table.item(row, 0)
+                if item is not None:
+                    if self.model.alarm[row]:
+                        item.setBackground(QtGui.QColor(255, 0, 0))  # red
+                    elif self.model.warn[row]:
+                        item.setBackground(QtGui.QColor(255, 255, 0))  # yellow
+                    else:
+                        item.setBackground(QtGui.QColor(89, 89, 89))  # grey
+        finally:
+            self.table.blockSignals(False)
+
+
+class BPMTableSync(TableWidgetSync):
+    """
+    TableWidgetSync for the BPM table (columns: id, x, y, checkbox) backed by a DeviceStateModel with width=2.
+    """
+    def __init__(self, model, table, on_change=None, check_col=3):
+        super(BPMTableSync, self).__init__(model, table, on_change=on_change, init_col=None, value_col=None,
+                                           check_col=check_col)
+
+    def repaint_rows(self, rows):
+        self.table.blockSignals(True)
+        try:
+            for row in rows:
+                if self.model.alarm[row]:
+                    color = QtGui.QColor(255, 0, 0)  # red
+                else:
+                    color = QtGui.QColor(89, 89, 89)  # grey
+                for col, val in zip([1, 2], self.model.values[row]):
+                    item = self.table.item(row, col)
+                    if item is not None:
+                        item.setText(str(np.round(val, 4)))
+                        item.setBackground(color)
+
+                item = self.table.item(row, self.check_col)
+                if item is not None:
+                    item.setCheckState(QtCore.Qt.Checked if self.model.active[row] else QtCore.Qt.Unchecked)
+        finally:
+            self.table.blockSignals(False)
+
+
+class DeviceStateTableModel(QtCore.QAbstractTableModel):
+    """
+    QAbstractTableModel for QTableView. Columns: id, init value, setpoint, active.
+    On every flush of the DeviceStateModel one dataChanged signal is emitted for the changed row range.
+    """
+    h_headers = ["id", "init", "value", "active"]
+
+    def __init__(self, model, parent=None):
+        super(DeviceStateTableModel, self).__init__(parent)
+        self.model = model
+        self.invoker = GuiInvoker()
+        self.model.scheduler = self.invoker.post
+        self.model.add_listener(self.rows_changed)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return len(self.model)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.h_headers)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.h_headers[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if role == QtCore.Qt.DisplayRole:
+            if col == 0:
+                return self.model.ids[row]
+            elif col == 1:
+                return str(np.round(self.model.init_values[row], 4))
+            elif col == 2:
+                return str(np.round(self.model.values[row], 4))
+        elif role == QtCore.Qt.CheckStateRole and col == 3:
+            return QtCore.Qt.Checked if self.model.active[row] else QtCore.Qt.Unchecked
+        elif role == QtCore.Qt.BackgroundRole and col == 0:
+            if self.model.alarm[row]:
+                return QtGui.QColor(255, 0, 0)
+            if self.model.warn[row]:
+                return QtGui.QColor(255, 255, 0)
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        row, col = index.row(), index.column()
+        if role == QtCore.Qt.CheckStateRole and col == 3:
+            self.model.set_active(row, value == QtCore.Qt.Checked, notify=False)
+        elif role == QtCore.Qt.EditRole and col == 2:
+            try:
+                self.model.set_value(row, float(value), notify=False)
+            except ValueError:
+                return False
+        else:
+            return False
+        self.dataChanged.emit(index, index)
+        return True
+
+    def flags(self, index):
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 2:
+            flags |= QtCore.Qt.ItemIsEditable
+        elif index.column() == 3:
+            flags |= QtCore.Qt.ItemIsUserCheckable
+        return flags
+
+    def rows_changed(self, rows):
+        top_left = self.index(rows[0], 0)
+        bottom_right = self.index(rows[-1], self.columnCount() - 1)
+        self.dataChanged.emit(top_left, bottom_right)
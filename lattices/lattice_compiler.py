@@ -0,0 +1,318 @@
+"""
+Compiled lattice sections.
+
+A section module (e.g. lattices.phase_advance_5pi_sase2.l3) is imported once, then its elements are stored in a
+compact binary form: per element type a structured array of the constructor parameters (one typed field per
+parameter) and the ps_id links, the cell as an index array into the unique elements and the module-level names
+of the elements. The file is tagged with a hash of the module source, so an edited lattice file is compiled again.
+
+CompiledSection is a stand-in of the module with the same attributes (cell, tws, element names). Elements are
+rebuilt through their constructors only on the first access, so sections which are not used cost neither import
+nor memory.
+"""
+import os
+import sys
+import pickle
+import hashlib
+import inspect
+import numbers
+import importlib
+import importlib.util
+import numpy as np
+import logging
+from ocelot import *
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+# attributes which are set in the lattice files after the constructor
+EXTRA_ATTRS = ("ps_id",)
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".compiled")
+
+
+def flatten_cell(cell):
+    """
+    :param cell: cell of a section module, can be nested
+    :return: list of elements
+    """
+    seq = []
+    for item in cell:
+        if isinstance(item, (list, tuple)):
+            seq.extend(flatten_cell(item))
+        else:
+            seq.append(item)
+    return seq
+
+
+def source_hash(module_name):
+    """
+    Hash of the module source, the cache version and the ocelot version
+
+    :param module_name: e.g. "lattices.phase_advance_5pi_sase2.l3"
+    :return: str or None if the source is not found
+    """
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or spec.origin is None or not os.path.isfile(spec.origin):
+        return None
+    md5 = hashlib.md5()
+    with open(spec.origin, "rb") as f:
+        md5.update(f.read())
+    md5.update(str(CACHE_VERSION).encode())
+    md5.update(str(getattr(sys.modules.get("ocelot"), "__version__", "")).encode())
+    return md5.hexdigest()
+
+
+def constructor_args(cls):
+    """
+    :param cls: element class
+    :return: list of the keyword parameters of the constructor
+    """
+    params = inspect.signature(cls.__init__).parameters.values()
+    return [p.name for p in params if p.name != "self" and p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
+
+
+def field_dtype(values):
+    """
+    :param values: list of values of one parameter
+    :return: numpy dtype of the field
+    """
+    if all(isinstance(val, (bool, np.bool_)) for val in values):
+        return np.bool_
+    if any(isinstance(val, (bool, np.bool_)) for val in values):
+        return object
+    if all(isinstance(val, numbers.Integral) for val in values):
+        return np.int64
+    if all(isinstance(val, numbers.Real) for val in values):
+        return np.float64
+    if all(isinstance(val, numbers.Complex) for val in values):
+        return np.complex128
+    return object
+
+
+def param_table(cls, elements):
+    """
+    Constructor parameters of the elements of one type as a structured array. Parameters which are not attributes
+    of the elements are not stored (constructor defaults), "eid" is the element id. EXTRA_ATTRS are None for
+    elements without them.
+
+    :param cls: element class
+    :param elements: list of elements of the class
+    :return: structured array
+    """
+    columns = {}
+    for name in constructor_args(cls):
+        attr = "id" if name == "eid" else name
+        if all(hasattr(elem, attr) for elem in elements):
+            columns[name] = [getattr(elem, attr) for elem in elements]
+    for name in EXTRA_ATTRS:
+        if any(hasattr(elem, name) for elem in elements):
+            columns[name] = [getattr(elem, name, None) for elem in elements]
+    table = np.zeros(len(elements), dtype=[(name, field_dtype(values)) for name, values in columns.items()])
+    for name, values in columns.items():
+        table[name] = values
+    return table
+
+
+def build_element(cls, record):
+    """
+    :param cls: element class
+    :param record: row of param_table()
+    :return: element
+    """
+    names = record.dtype.names
+    values = {name: record[name].item() if isinstance(record[name], np.generic) else record[name] for name in names}
+    elem = cls(**{name: val for name, val in values.items() if name not in EXTRA_ATTRS})
+    for name in EXTRA_ATTRS:
+        if values.get(name) is not None:
+            setattr(elem, name, values[name])
+    return elem
+
+
+def simple_attrs(elem):
+    return {name: val for name, val in vars(elem).items()
+            if val is None or isinstance(val, (str, numbers.Number, np.generic))}
+
+
+def section_layout(module):
+    """
+    Unique elements, cell and names of a section module
+
+    :param module: imported section module with attribute "cell"
+    :return: list of unique elements, dictionary {"ids": list, "cell": array,
+             "names": {attribute: element index}, "twiss": {attribute: Twiss}}
+    """
+    seq = flatten_cell(module.cell)
+    # elements can appear several times in the cell (e.g. drifts), they are stored once
+    index = {}
+    elements = []
+    cell = np.zeros(len(seq), dtype=np.int32)
+    for i, elem in enumerate(seq):
+        if id(elem) not in index:
+            index[id(elem)] = len(elements)
+            elements.append(elem)
+        cell[i] = index[id(elem)]
+
+    names = {}
+    twiss_objects = {}
+    for name, value in vars(module).items():
+        if name.startswith("_"):
+            continue
+        if id(value) in index and value is elements[index[id(value)]]:
+            names[name] = index[id(value)]
+        elif isinstance(value, Twiss):
+            twiss_objects[name] = value
+    return elements, {"ids": [elem.id for elem in elements], "cell": cell, "names": names, "twiss": twiss_objects}
+
+
+def compile_module(module):
+    """
+    Compact form of the elements of a section module
+
+    :param module: imported section module with attribute "cell"
+    :return: dictionary of section_layout() with "classes": [(module, class name)],
+             "tables": [structured array per class], "codes": array, "rows": array (row of every element in its table)
+    :raise ValueError: if an element can not be rebuilt through its constructor with the same attributes
+    """
+    elements, data = section_layout(module)
+    classes = []
+    class_codes = {}
+    members = []
+    codes = np.zeros(len(elements), dtype=np.int16)
+    rows = np.zeros(len(elements), dtype=np.int32)
+    for i, elem in enumerate(elements):
+        cls = elem.__class__
+        if cls not in class_codes:
+            class_codes[cls] = len(classes)
+            classes.append((cls.__module__, cls.__name__))
+            members.append([])
+        codes[i] = class_codes[cls]
+        rows[i] = len(members[codes[i]])
+        members[codes[i]].append(elem)
+
+    tables = []
+    for (_, cls_name), elems in zip(classes, members):
+        cls = elems[0].__class__
+        table = param_table(cls, elems)
+        for elem, record in zip(elems, table):
+            if simple_attrs(build_element(cls, record)) != simple_attrs(elem):
+                raise ValueError(cls_name + " " + str(elem.id) + " differs after rebuild through the constructor")
+        tables.append(table)
+    data.update({"classes": classes, "tables": tables, "codes": codes, "rows": rows})
+    return data
+
+
+class CompiledSection:
+    """
+    Lazy stand-in of a section module
+
+    :param module_name: e.g. "lattices.phase_advance_5pi_sase2.l3"
+    :param cache_dir: folder for compiled sections, None - no cache (the module is imported)
+    """
+    def __init__(self, module_name, cache_dir=DEFAULT_CACHE_DIR):
+        self.__dict__["_module_name"] = module_name
+        self.__dict__["_cache_dir"] = cache_dir
+        self.__dict__["_data"] = None
+        self.__dict__["_elements"] = None
+        self.__dict__["_module"] = None
+        self.__dict__["_cell"] = None
+
+    def __repr__(self):
+        return "<compiled section " + self._module_name + ">"
+
+    def cache_file(self):
+        return os.path.join(self._cache_dir, self._module_name + ".pkl")
+
+    def load(self):
+        """
+        Method loads the compiled section from the cache or compiles the module
+
+        :return: dictionary, see compile_module()
+        """
+        if self._data is not None:
+            return self._data
+        key = source_hash(self._module_name) if self._cache_dir is not None else None
+        if key is not None:
+            try:
+                with open(self.cache_file(), "rb") as f:
+                    cached = pickle.load(f)
+                if cached["key"] == key:
+                    self.__dict__["_data"] = cached["data"]
+                    logger.debug(" CompiledSection: " + self._module_name + " is loaded from the cache")
+                    return self._data
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(" CompiledSection: cache of " + self._module_name + " is not readable: " + str(e))
+        module = self.import_module()
+        try:
+            data = compile_module(module)
+        except ValueError as e:
+            # the module is used as it is and the section is not saved to the cache
+            logger.warning(" CompiledSection: " + self._module_name + " is not compiled: " + str(e))
+            data = section_layout(module)[1]
+            key = None
+        # elements of the imported module are used as they are
+        self.__dict__["_elements"] = [None] * len(data["ids"])
+        for i, elem in zip(data["cell"], flatten_cell(module.cell)):
+            self._elements[i] = elem
+        self.__dict__["_data"] = data
+        if key is not None:
+            self.save(key, data)
+        return data
+
+    def save(self, key, data):
+        tmp_file = self.cache_file() + ".tmp"
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                pickle.dump({"key": key, "data": data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file())
+            logger.info(" CompiledSection: " + self._module_name + " is compiled")
+        except Exception as e:
+            logger.warning(" CompiledSection: could not save " + self._module_name + ": " + str(e))
+
+    def import_module(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._module_name)
+        return self._module
+
+    def elements(self):
+        """
+        :return: list of unique elements of the section, rebuilt from the compiled parameters on the first call
+        """
+        data = self.load()
+        if self._elements is None:
+            classes = [getattr(importlib.import_module(module), name) for module, name in data["classes"]]
+            tables = data["tables"]
+            elements = [build_element(classes[code], tables[code][row]) for code, row in zip(data["codes"], data["rows"])]
+            self.__dict__["_elements"] = elements
+        return self._elements
+
+    @property
+    def cell(self):
+        if self._cell is None:
+            elements = self.elements()
+            self.__dict__["_cell"] = tuple(elements[i] for i in self._data["cell"])
+        return self._cell
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        data = self.load()
+        if name in data["names"]:
+            return self.elements()[data["names"][name]]
+        if name in data["twiss"]:
+            return data["twiss"][name]
+        raise AttributeError("compiled section " + self._module_name + " has no element or Twiss " + name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("compiled section " + self._module_name + " is read only")
+
+
+def load_section(module_name, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    :param module_name: e.g. "lattices.phase_advance_5pi_sase2.l3"
+    :param cache_dir: folder for compiled sections, None - no cache, the module is imported on the first access
+    :return: CompiledSection
+    """
+    return CompiledSection(module_name, cache_dir=cache_dir)
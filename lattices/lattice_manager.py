@@ -1,13 +1,28 @@
-import importlib
 import logging
 import numpy as np
 from copy import deepcopy, copy
 from ocelot import *
 from ocelot.cpbd.magnetic_lattice import *
+from lattices.lattice_compiler import load_section, DEFAULT_CACHE_DIR
+from lattices.sequence_index import SequenceIndex
+from lattices.twiss_checkpoints import section_checkpoints
+from lattices.linear_optics import LinearOptics, to_twiss
 #logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+def element_id(elem):
+    """
+    :param elem: element or element id
+    :return: element id
+    """
+    return elem if isinstance(elem, str) else elem.id
+
+
 class LatSection:
+    """
+    Section of the lattice. start and stop are element ids (or elements) of the first/last element, they are
+    resolved in the section modules only when the sequence is built the first time (Lattice.get_sequence())
+    """
     def __init__(self, name, str_cells, start=None, stop=None, z0=23.2, tw=None, load_all=True):
         self.name = name
         self.str_cells = str_cells
@@ -16,10 +31,19 @@ class LatSection:
         self.z0 = z0
         self.tw = tw
         self.load_all = load_all
+        # memoized sequence, its SequenceIndex and TwissCheckpoints
+        self.seq = None
+        self.index = None
+        self.checkpoints = None
 
 
 class Lattice:
-    def __init__(self, path="lattices.phase_advance_5pi_sase2"):
+    def __init__(self, path="lattices.phase_advance_5pi_sase2", cache_dir=DEFAULT_CACHE_DIR):
+        """
+        :param path: package with the section modules
+        :param cache_dir: folder for compiled sections (see lattice_compiler), None - no cache
+        """
+        self.cache_dir = cache_dir
         self.lat_zi = 23.2 # start position of the lattice in [m]
         self.default_section = "T4D"
         self.config = {"I1":       path + ".i1",
@@ -102,18 +126,18 @@ class Lattice:
                                                "SASE2", "T3", "T5", "T5D"], load_all=False),
             LatSection("TLD+", str_cells=["I1", "L1", "L2", "L3", "CL", "TLD"], load_all=False),
 
-            LatSection("60 - 450", str_cells=["L1", "L2"], stop=self.lats["L2"].otrb_450_b2, z0=62.089),
-            LatSection("400 - 900", str_cells=["L2", "L3"], start=self.lats["L2"].otra_392_b2,
-                       stop=self.lats["L3"].bpmc_902_l3, z0=392.03, tw=tws_400),
-            LatSection("800 - 1600", str_cells=["L3", "CL"], start=self.lats["L3"].bpmc_794_l3,
-                       stop=self.lats["L3"].otrbw_1597_l3, z0=794.786, tw=tws_794),
-            LatSection("1460 - 1930", str_cells=["L3", "CL"], start=self.lats["L3"].tora_1459_l3,
-                       stop=self.lats["CL"].otrbw_1929_tl, z0=1459.58, tw=tws_1460),
-            LatSection("SASE1", str_cells=["SASE1", "T4"], stop=self.lats["T4"].stsub_2583_t4, z0=2025.38),
+            LatSection("60 - 450", str_cells=["L1", "L2"], stop="OTRB.450.B2", z0=62.089),
+            LatSection("400 - 900", str_cells=["L2", "L3"], start="OTRA.392.B2",
+                       stop="BPMC.902.L3", z0=392.03, tw=tws_400),
+            LatSection("800 - 1600", str_cells=["L3", "CL"], start="BPMC.794.L3",
+                       stop="OTRBW.1597.L3", z0=794.786, tw=tws_794),
+            LatSection("1460 - 1930", str_cells=["L3", "CL"], start="TORA.1459.L3",
+                       stop="OTRBW.1929.TL", z0=1459.58, tw=tws_1460),
+            LatSection("SASE1", str_cells=["SASE1", "T4"], stop="STSUB.2583.T4", z0=2025.38),
 
             LatSection("T4", str_cells=["T4"], z0=2438.517 + 23.2),
             #
-            LatSection("SASE3", str_cells=["T4", "SASE3"], start=self.lats["T4"].stsub_2583_t4,
+            LatSection("SASE3", str_cells=["T4", "SASE3"], start="STSUB.2583.T4",
                        z0=2560.45 + 23.2, tw=tws_sase3),
 
             LatSection("SASE2", str_cells=["T1", "SASE2", "T3"], z0=2025.385823000017),
@@ -156,7 +180,8 @@ class Lattice:
     def load(self):
         self.lats = {}
         for sec in self.config.keys():
-            self.lats[sec] = importlib.import_module(self.config[sec])
+            # sections are compiled/rebuilt on the first access
+            self.lats[sec] = load_section(self.config[sec], cache_dir=self.cache_dir)
             logger.debug(self.lats[sec])
 
     def get_slice_sequence(self, seq, start=None, stop=None):
@@ -164,11 +189,11 @@ class Lattice:
         names = [elem.id for elem in seq]
         try:
             if start != None:
-                id1 = names.index(start.id)
+                id1 = names.index(element_id(start))
             else:
                 id1 = 0
             if stop != None:
-                id2 = names.index(stop.id) + 1
+                id2 = names.index(element_id(stop)) + 1
                 new_seq = seq[id1:id2]
             else:
                 new_seq= seq[id1:]
@@ -213,17 +238,42 @@ class Lattice:
 
     def get_sequence(self, section):
         #[print(sec_name) for sec_name in section.str_cells]
-        cells = [self.lats[sec_name].cell for sec_name in section.str_cells]
+        """
+        Sequence of the section, the section modules are loaded and the sequence is built on the first call
 
-        section.seq = self.get_slice_sequence(cells, start=section.start, stop=section.stop)
+        :param section: LatSection
+        :return: list of elements
+        """
+        if section.seq is None:
+            cells = [self.lats[sec_name].cell for sec_name in section.str_cells]
+            section.seq = self.get_slice_sequence(cells, start=section.start, stop=section.stop)
+            section.index = SequenceIndex(section.seq, s0=section.z0)
         return section.seq
 
-    def get_correct_init_twiss(self, sequence, stop_element, tws_i):
+    def get_index(self, section):
+        """
+        :param section: LatSection
+        :return: SequenceIndex of the section sequence
+        """
+        self.get_sequence(section)
+        return section.index
+
+    def get_correct_init_twiss(self, sequence, stop_element, tws_i, section=None):
+        """
+        :param sequence: sequence or cells
+        :param stop_element: element up to which twiss is propagated, None - tws_i is returned
+        :param tws_i: Twiss at the beginning of the sequence
+        :param section: LatSection of the sequence or None. If given, the Twiss is taken from the cumulative maps
+                        of the section (TwissCheckpoints), which are calculated once per optics state
+        :return: Twiss
+        """
         if stop_element == None:
             return tws_i
+        if section is not None:
+            return section_checkpoints(self, section).twiss_at(stop_element, tws_i)
         seq = [copy(elem) for elem in self.get_slice_sequence(sequence, stop=stop_element)]
-        tws = twiss(MagneticLattice(seq[:-1]), tws_i)
-        return tws[-1]
+        lat = MagneticLattice(seq[:-1])
+        return to_twiss(LinearOptics(lat, tws_i.E).twiss(tws_i)[-1], tws_i)
 
 
     def return_lat_section(self, current_lat_section, start=None, stop=None): #qt_currentIndex=None, start=None, stop=None):
@@ -242,13 +292,14 @@ class Lattice:
         section.seq = self.get_sequence(section)
 
         section.tws_des = self.return_twiss_des(section)
-        section.tws_des = self.get_correct_init_twiss(section.seq, stop_element=start, tws_i=section.tws_des)
+        section.tws_des = self.get_correct_init_twiss(section.seq, stop_element=start, tws_i=section.tws_des,
+                                                      section=section)
 
         logger.debug("len(section.seq) = " + str(len(section.seq)))
 
         method = MethodTM()
         method.global_method = TransferMap
-        section.lat = MagneticLattice(self.get_slice_sequence(section.seq, start=start, stop=stop), method=method)
+        section.lat = MagneticLattice(section.index.slice(start=start, stop=stop), method=method)
         return section
 
 
@@ -0,0 +1,136 @@
+"""
+Linear optics kernel.
+
+The first order maps of all elements are stacked into one (n_elem, 6, 6) array per lattice state. Cumulative maps
+are calculated with a prefix scan of batched matmuls and the Twiss functions, dispersion and the trajectory at all
+element exits are propagated with array operations. The results are structured arrays (one field per function)
+which go directly to pyqtgraph, e.g. plot.setData(x=tws["s"], y=tws["beta_x"]).
+"""
+import numpy as np
+import logging
+from copy import copy
+from ocelot import *
+from orbit_math import element_rmatrices, prefix_matmul, linear_trajectory, is_linear_sequence
+from lattices.twiss_checkpoints import normalized_maps, cumulative_maps, transport_twiss, phase_advance, TWISS_ATTRS
+
+logger = logging.getLogger(__name__)
+
+TWISS_DTYPE = np.dtype([(attr, float) for attr in ("s", "beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp",
+                                                   "Dy", "Dyp", "mux", "muy", "E")])
+TRAJECTORY_DTYPE = np.dtype([(attr, float) for attr in ("s", "x", "px", "y", "py", "tau", "p")])
+
+
+def twiss_table(Cx, Cy, Mx, My, s, E, tws0):
+    """
+    Twiss functions at the entrance and all element exits
+
+    :param Cx: array (n + 1, 3, 3) of cumulative maps, see normalized_maps()
+    :param Cy: array (n + 1, 3, 3)
+    :param Mx: array (n, 3, 3) of element maps
+    :param My: array (n, 3, 3)
+    :param s: array (n + 1) of positions relative to the entrance [m]
+    :param E: array (n + 1) of energies [GeV]
+    :param tws0: Twiss at the entrance
+    :return: structured array with TWISS_DTYPE
+    """
+    tws = np.zeros(len(s), dtype=TWISS_DTYPE)
+    for plane, C, M in (("x", Cx, Mx), ("y", Cy, My)):
+        beta, alpha, D, Dp = transport_twiss(C, getattr(tws0, "beta_" + plane), getattr(tws0, "alpha_" + plane),
+                                             getattr(tws0, "D" + plane), getattr(tws0, "D" + plane + "p"))
+        tws["beta_" + plane], tws["alpha_" + plane] = beta, alpha
+        tws["D" + plane], tws["D" + plane + "p"] = D, Dp
+        tws["mu" + plane][0] = getattr(tws0, "mu" + plane, 0.)
+        tws["mu" + plane][1:] = tws["mu" + plane][0] + np.cumsum(phase_advance(M, beta[:-1], alpha[:-1]))
+    tws["s"] = tws0.s + s
+    tws["E"] = E
+    return tws
+
+
+def to_twiss(row, tws0=None):
+    """
+    :param row: one element of a structured array with TWISS_DTYPE
+    :param tws0: Twiss to take the other attributes from (emittances, ...) or None
+    :return: Twiss
+    """
+    tws = Twiss() if tws0 is None else copy(tws0)
+    for attr in TWISS_ATTRS:
+        setattr(tws, attr, float(row[attr]))
+    tws.gamma_x = (1. + tws.alpha_x**2) / tws.beta_x
+    tws.gamma_y = (1. + tws.alpha_y**2) / tws.beta_y
+    return tws
+
+
+class LinearOptics:
+    """
+    Stacked first order maps of a lattice and their cumulative products. Must be created again after
+    lat.update_transfer_maps().
+
+    :param lat: MagneticLattice with up to date transfer maps
+    :param energy: beam energy at the lattice entrance [GeV]
+    """
+    def __init__(self, lat, energy):
+        self.lat = lat
+        self.energy = energy
+        R, E, s = element_rmatrices(lat.sequence, energy)
+        self.R = R
+        self.E = np.append(energy, E)
+        self.s = np.append(0., s)
+        self.R_cum = np.append(np.eye(6)[np.newaxis], prefix_matmul(R), axis=0)
+        self.Mx, self.My = normalized_maps(R, self.E[:-1], self.E[1:])
+        self.Cx = cumulative_maps(self.Mx)
+        self.Cy = cumulative_maps(self.My)
+
+    def twiss(self, tws0):
+        """
+        Twiss functions at the lattice entrance and all element exits (the same points as twiss(lat, tws0))
+
+        :param tws0: Twiss at the entrance
+        :return: structured array with TWISS_DTYPE
+        """
+        return twiss_table(self.Cx, self.Cy, self.Mx, self.My, self.s, self.E, tws0)
+
+    def periodic_twiss(self):
+        """
+        Periodic solution of the one turn map
+
+        :return: Twiss at the entrance or None if the motion is not stable
+        """
+        tws = Twiss()
+        for plane, C in (("x", self.Cx[-1]), ("y", self.Cy[-1])):
+            cos_mu = (C[0, 0] + C[1, 1]) / 2.
+            if abs(cos_mu) >= 1.:
+                logger.warning(" LinearOptics: periodic_twiss: unstable motion in " + plane)
+                return None
+            sin_mu = np.sign(C[0, 1]) * np.sqrt(1. - cos_mu**2)
+            beta = C[0, 1] / sin_mu
+            alpha = (C[0, 0] - C[1, 1]) / (2. * sin_mu)
+            D, Dp = np.linalg.solve(np.eye(2) - C[:2, :2], C[:2, 2])
+            setattr(tws, "beta_" + plane, float(beta))
+            setattr(tws, "alpha_" + plane, float(alpha))
+            setattr(tws, "gamma_" + plane, (1. + float(alpha)**2) / float(beta))
+            setattr(tws, "D" + plane, float(D))
+            setattr(tws, "D" + plane + "p", float(Dp))
+        tws.E = self.energy
+        tws.s = 0.
+        return tws
+
+    def is_linear(self):
+        """
+        :return: True if trajectory() is equivalent to lattice_track() with first order maps
+        """
+        return is_linear_sequence(self.lat.sequence)
+
+    def trajectory(self, X0=None, s0=0.):
+        """
+        First order trajectory with the current corrector angles
+
+        :param X0: initial coordinates (x, px, y, py, tau, p) or None
+        :param s0: position of the lattice entrance [m]
+        :return: structured array with TRAJECTORY_DTYPE at the entrance and all element exits
+        """
+        X = linear_trajectory(self.lat.sequence, self.R_cum, X0)
+        traj = np.zeros(len(X), dtype=TRAJECTORY_DTYPE)
+        traj["s"] = s0 + self.s
+        for i, attr in enumerate(TRAJECTORY_DTYPE.names[1:]):
+            traj[attr] = X[:, i]
+        return traj
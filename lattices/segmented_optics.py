@@ -0,0 +1,106 @@
+"""
+Optics of the current lattice for interactive quadrupole changes.
+
+The normalized first order maps of all elements and their cumulative products are kept between
+quadrupole edits. A changed quadrupole gets a new transfer map (only this element), the cumulative maps downstream
+of it are corrected with one batched 3x3 product and the Twiss functions are transported from the entrance
+with vectorized operations. The lattice is multiplied out again only after many edits (to limit round-off) or if
+the optics state changed otherwise (lattice, cavities, entrance energy).
+"""
+import numpy as np
+import logging
+from ocelot import *
+from orbit_math import element_rmatrices
+from lattices.twiss_checkpoints import normalized_maps, cumulative_maps, invert_map
+from lattices.linear_optics import twiss_table
+
+logger = logging.getLogger(__name__)
+
+
+def update_element_map(lat, elem):
+    """
+    New transfer map of one element after a change of its parameters, the same as lat.update_transfer_maps()
+    does for every element
+
+    :param lat: MagneticLattice
+    :param elem: element of lat.sequence
+    :return: False if the lattice method can not create single maps (the whole lattice has to be updated)
+    """
+    create_tm = getattr(getattr(lat, "method", None), "create_tm", None)
+    if create_tm is None:
+        return False
+    elem.transfer_map = create_tm(elem)
+    return True
+
+
+class SegmentedOptics:
+    """
+    :param lat: MagneticLattice with up to date transfer maps
+    :param energy: beam energy at the lattice entrance [GeV]
+    :param max_updates: number of quadrupole updates after which the cumulative maps are recalculated
+    """
+    def __init__(self, lat, energy, max_updates=200):
+        self.lat = lat
+        self.energy = energy
+        self.max_updates = max_updates
+        self.quads = [(i, elem) for i, elem in enumerate(lat.sequence) if elem.__class__ == Quadrupole]
+        self.rebuild()
+
+    def rebuild(self):
+        R, E, s = element_rmatrices(self.lat.sequence, self.energy)
+        self.E = np.append(self.energy, E)
+        self.s = np.append(0., s)
+        self.Mx, self.My = normalized_maps(R, self.E[:-1], self.E[1:])
+        self.Cx = cumulative_maps(self.Mx)
+        self.Cy = cumulative_maps(self.My)
+        self.k1 = np.array([elem.k1 for i, elem in self.quads])
+        self.nupdates = 0
+
+    def set_quad(self, i, elem):
+        """
+        Method updates the map of the quadrupole and the cumulative maps downstream of it
+
+        :param i: position of the quadrupole in lat.sequence
+        :param elem: Quadrupole
+        :return: False if the transfer map could not be updated
+        """
+        if not update_element_map(self.lat, elem):
+            return False
+        R = elem.transfer_map.R(self.E[i])[np.newaxis]
+        Mx, My = normalized_maps(R, self.E[i:i + 1], self.E[i + 1:i + 2])
+        for M, C, M_new in ((self.Mx, self.Cx, Mx[0]), (self.My, self.Cy, My[0])):
+            # C[j] = P(i+1 -> j) M[i] C[i], only M[i] changes
+            X = np.dot(invert_map(C[i + 1]), np.dot(M_new, C[i]))
+            C[i + 1:] = np.matmul(C[i + 1:], X)
+            M[i] = M_new
+        self.nupdates += 1
+        return True
+
+    def update(self):
+        """
+        Method finds quadrupoles with changed k1 and updates the maps
+
+        :return: list of changed quadrupoles or None if the whole lattice had to be updated
+        """
+        k1 = np.array([elem.k1 for i, elem in self.quads])
+        changed = np.flatnonzero(k1 != self.k1)
+        if len(changed) == 0:
+            return []
+        quads = [self.quads[n] for n in changed]
+        if self.nupdates + len(changed) > self.max_updates or \
+                not all(self.set_quad(i, elem) for i, elem in quads):
+            logger.debug(" SegmentedOptics: full update")
+            self.lat.update_transfer_maps()
+            self.rebuild()
+            return None
+        self.k1 = k1
+        return [elem for i, elem in quads]
+
+    def twiss(self, tws0):
+        """
+        Twiss functions at the lattice entrance and all element exits (the same points as twiss(lat, tws0))
+
+        :param tws0: Twiss at the entrance
+        :return: structured array with TWISS_DTYPE (see lattices.linear_optics)
+        """
+        return twiss_table(self.Cx, self.Cy, self.Mx, self.My, self.s, self.E, tws0)
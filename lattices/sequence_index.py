@@ -0,0 +1,92 @@
+"""
+Index of a lattice sequence for fast slicing by element and lookup by position.
+"""
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def nearest(values, value):
+    """
+    Index of the nearest value in a sorted array, O(log n)
+
+    :param values: sorted 1D array
+    :param value: float
+    :return: int
+    """
+    i = int(np.searchsorted(values, value))
+    if i == 0:
+        return 0
+    if i == len(values):
+        return len(values) - 1
+    return i if values[i] - value < value - values[i - 1] else i - 1
+
+
+class SequenceIndex:
+    """
+    Element id -> position dictionary, cumulative s and positions of every element type of a flat sequence.
+    Built once per section sequence (see Lattice.get_sequence()).
+
+    :param seq: list of elements
+    :param s0: longitudinal position of the beginning of the sequence [m]
+    """
+    def __init__(self, seq, s0=0.):
+        self.seq = seq
+        self.s0 = s0
+        # first occurrence of the id (drifts can appear several times)
+        self.positions = {}
+        self.types = {}
+        for i, elem in enumerate(seq):
+            self.positions.setdefault(elem.id, i)
+            self.types.setdefault(elem.__class__, []).append(i)
+        self.types = {cls: np.array(pos, dtype=int) for cls, pos in self.types.items()}
+        self.lengths = np.array([elem.l for elem in seq], dtype=float)
+        # end of every element relative to the beginning of the sequence
+        self.s_end = np.cumsum(self.lengths)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def position(self, elem):
+        """
+        :param elem: element or element id
+        :return: position of the element in the sequence
+        :raise ValueError: if the element is not in the sequence
+        """
+        eid = elem if isinstance(elem, str) else elem.id
+        try:
+            return self.positions[eid]
+        except KeyError:
+            raise ValueError(str(eid) + " is not in the sequence")
+
+    def of_types(self, *classes):
+        """
+        :param classes: element classes, e.g. Hcor, Vcor
+        :return: sorted array of positions of the elements of these classes
+        """
+        pos = [self.types[cls] for cls in classes if cls in self.types]
+        if len(pos) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(pos))
+
+    def s_center(self, positions, s0=None):
+        """
+        :param positions: array of positions in the sequence
+        :param s0: position of the beginning of the sequence, None - self.s0
+        :return: array of longitudinal positions of the element centers [m]
+        """
+        s0 = self.s0 if s0 is None else s0
+        return s0 + self.s_end[positions] - self.lengths[positions] / 2.
+
+    def slice(self, start=None, stop=None):
+        """
+        Part of the sequence from start to stop (both included), equivalent to Lattice.get_slice_sequence()
+
+        :param start: element, element id or None - from the beginning
+        :param stop: element, element id or None - to the end
+        :return: list of elements
+        """
+        id1 = 0 if start is None else self.position(start)
+        id2 = len(self.seq) if stop is None else self.position(stop) + 1
+        return self.seq[id1:id2]
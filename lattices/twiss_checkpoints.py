@@ -0,0 +1,228 @@
+"""
+Twiss checkpoints of a lattice section.
+
+The first order maps of the section are multiplied out once per optics state (element parameters of
+rm_cache.OPTICS_ATTRS and the entrance energy). Afterwards the Twiss parameters at any element boundary
+(correctors, BPMs, markers, ...) for a given initial Twiss are a lookup in the cumulative maps, and the Twiss at the section entrance is found
+from a Twiss measured downstream by inverting the cumulative map: no copied elements, no reversed lattices
+and no flipped cavity phases.
+"""
+import numpy as np
+import logging
+from ocelot import *
+from orbit_math import element_rmatrices, prefix_matmul
+from rm_cache import optics_fingerprint
+
+logger = logging.getLogger(__name__)
+
+TWISS_ATTRS = ("beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp", "Dy", "Dyp", "mux", "muy", "E", "s")
+
+
+def normalized_maps(R, E_in, E_out):
+    """
+    Maps of (x, x', 1) and (y, y', 1) of every element as they are used in ocelot twiss(): the betatron part is
+    scaled with sqrt(E_out/E_in), the dispersion column is not
+
+    :param R: array (n, 6, 6) of first order maps
+    :param E_in: array of energies at the element entrances [GeV]
+    :param E_out: array of energies at the element exits [GeV]
+    :return: Mx, My - arrays (n, 3, 3)
+    """
+    k = np.sqrt(E_out / E_in)[:, np.newaxis, np.newaxis]
+    maps = []
+    for i in (0, 2):
+        M = np.zeros((len(R), 3, 3))
+        M[:, :2, :2] = R[:, i:i + 2, i:i + 2] * k
+        M[:, :2, 2] = R[:, i:i + 2, 5]
+        M[:, 2, 2] = 1.
+        maps.append(M)
+    return maps
+
+
+def cumulative_maps(M):
+    """
+    :param M: array (n, 3, 3) of element maps
+    :return: array (n + 1, 3, 3), C[j] is the map from the entrance to the boundary j (C[0] is unit matrix)
+    """
+    return np.append(np.eye(3)[np.newaxis], prefix_matmul(M), axis=0)
+
+
+def transport_twiss(C, beta, alpha, D, Dp):
+    """
+    Twiss functions after the maps C
+
+    :param C: array (n, 3, 3) or (3, 3)
+    :param beta: initial beta [m]
+    :param alpha: initial alpha
+    :param D: initial dispersion [m]
+    :param Dp: initial dispersion derivative
+    :return: beta, alpha, D, Dp
+    """
+    gamma = (1. + alpha**2) / beta
+    a, b = C[..., 0, 0], C[..., 0, 1]
+    c, d = C[..., 1, 0], C[..., 1, 1]
+    beta_1 = a * a * beta - 2. * a * b * alpha + b * b * gamma
+    alpha_1 = -a * c * beta + (a * d + b * c) * alpha - b * d * gamma
+    D_1 = a * D + b * Dp + C[..., 0, 2]
+    Dp_1 = c * D + d * Dp + C[..., 1, 2]
+    return beta_1, alpha_1, D_1, Dp_1
+
+
+def phase_advance(M, beta, alpha):
+    """
+    Phase advance of every element, the same rule as in ocelot twiss()
+
+    :param M: array (n, 3, 3) of element maps
+    :param beta: array of beta at the element entrances
+    :param alpha: array of alpha at the element entrances
+    :return: array of phase advances [rad]
+    """
+    m11 = M[:, 0, 1]
+    denom = M[:, 0, 0] * beta - m11 * alpha
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dmu = np.where(denom == 0., np.pi / 2. * np.sign(m11), np.arctan(m11 / denom))
+    dmu[dmu < 0] += np.pi
+    return dmu
+
+
+def invert_map(C):
+    """
+    :param C: (3, 3) map with the 2x2 block of determinant 1 and last row (0, 0, 1)
+    :return: inverse map
+    """
+    a, b, c, d = C[0, 0], C[0, 1], C[1, 0], C[1, 1]
+    det = a * d - b * c
+    Ci = np.eye(3)
+    Ci[:2, :2] = np.array([[d, -b], [-c, a]]) / det
+    Ci[:2, 2] = -np.dot(Ci[:2, :2], C[:2, 2])
+    return Ci
+
+
+class TwissCheckpoints:
+    """
+    Cumulative maps of a section sequence and the Twiss functions at all element boundaries
+
+    :param sequence: list of elements of the section (LatSection.seq)
+    """
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.key = None
+        self.positions = {}
+        self._tws_key = None
+        self._tws = None
+
+    def update(self, energy):
+        """
+        Method recalculates the maps if the optics or the entrance energy has changed
+
+        :param energy: beam energy at the section entrance [GeV]
+        :return: True if the maps were recalculated
+        """
+        key = optics_fingerprint(self.sequence, energy=energy)
+        if key == self.key:
+            return False
+        method = MethodTM()
+        method.global_method = TransferMap
+        lat = MagneticLattice(self.sequence, method=method)
+        R, E, s = element_rmatrices(lat.sequence, energy)
+        self.E = np.append(energy, E)
+        self.s = np.append(0., s)
+        self.Mx, self.My = normalized_maps(R, self.E[:-1], self.E[1:])
+        self.Cx = cumulative_maps(self.Mx)
+        self.Cy = cumulative_maps(self.My)
+        # boundary at the entrance of an element, the first occurrence of the id
+        self.positions = {}
+        for i, elem in enumerate(lat.sequence):
+            self.positions.setdefault(elem.id, i)
+        self.key = key
+        self._tws_key = None
+        logger.debug(" TwissCheckpoints: update: n elements = " + str(len(lat.sequence)))
+        return True
+
+    def position(self, elem):
+        eid = elem if isinstance(elem, str) else elem.id
+        try:
+            return self.positions[eid]
+        except KeyError:
+            raise ValueError(str(eid) + " is not in the sequence")
+
+    def propagate(self, tws0):
+        """
+        Twiss functions at all element boundaries (memoized for the last tws0)
+
+        :param tws0: Twiss at the section entrance
+        :return: dictionary {attribute: array}, see TWISS_ATTRS
+        """
+        tws_key = tuple(getattr(tws0, attr, 0.) for attr in TWISS_ATTRS)
+        if self._tws_key == tws_key:
+            return self._tws
+        tws = {}
+        for plane, C, M in (("x", self.Cx, self.Mx), ("y", self.Cy, self.My)):
+            beta, alpha, D, Dp = transport_twiss(C, getattr(tws0, "beta_" + plane), getattr(tws0, "alpha_" + plane),
+                                                 getattr(tws0, "D" + plane), getattr(tws0, "D" + plane + "p"))
+            dmu = phase_advance(M, beta[:-1], alpha[:-1])
+            tws["beta_" + plane], tws["alpha_" + plane] = beta, alpha
+            tws["D" + plane], tws["D" + plane + "p"] = D, Dp
+            tws["mu" + plane] = getattr(tws0, "mu" + plane) + np.append(0., np.cumsum(dmu))
+        tws["E"] = self.E
+        tws["s"] = tws0.s + self.s
+        self._tws_key = tws_key
+        self._tws = tws
+        return tws
+
+    def twiss_at(self, elem, tws0):
+        """
+        Twiss at the entrance of the element, equal to the last Twiss of twiss() of the sequence up to the element
+
+        :param elem: element or element id
+        :param tws0: Twiss at the section entrance
+        :return: Twiss
+        """
+        j = self.position(elem)
+        tws = self.propagate(tws0)
+        result = Twiss()
+        for attr in TWISS_ATTRS:
+            setattr(result, attr, float(tws[attr][j]))
+        result.gamma_x = (1. + result.alpha_x**2) / result.beta_x
+        result.gamma_y = (1. + result.alpha_y**2) / result.beta_y
+        return result
+
+    def twiss_upstream(self, tws, elem):
+        """
+        Twiss at the section entrance from the Twiss at the exit of the element (e.g. measured at an OTR station)
+
+        :param tws: Twiss at the exit of elem
+        :param elem: element or element id
+        :return: Twiss
+        """
+        j = self.position(elem) + 1
+        result = Twiss()
+        for plane, C in (("x", self.Cx[j]), ("y", self.Cy[j])):
+            beta, alpha, D, Dp = transport_twiss(invert_map(C), getattr(tws, "beta_" + plane),
+                                                 getattr(tws, "alpha_" + plane), getattr(tws, "D" + plane),
+                                                 getattr(tws, "D" + plane + "p"))
+            setattr(result, "beta_" + plane, float(beta))
+            setattr(result, "alpha_" + plane, float(alpha))
+            setattr(result, "gamma_" + plane, (1. + float(alpha)**2) / float(beta))
+            setattr(result, "D" + plane, float(D))
+            setattr(result, "D" + plane + "p", float(Dp))
+        result.E = tws.E - (self.E[j] - self.E[0])
+        result.s = 0.
+        return result
+
+
+def section_checkpoints(lattice, section):
+    """
+    TwissCheckpoints of the section for the current optics, kept in section.checkpoints
+
+    :param lattice: lattice manager (Lattice)
+    :param section: LatSection
+    :return: TwissCheckpoints
+    """
+    seq = lattice.get_sequence(section)
+    checkpoints = getattr(section, "checkpoints", None)
+    if checkpoints is None or checkpoints.sequence is not seq:
+        checkpoints = TwissCheckpoints(seq)
+        section.checkpoints = checkpoints
+    checkpoints.update(lattice.return_twiss_des(section).E)
+    return checkpoints
@@ -25,6 +25,10 @@ sys.path.append(path[:indx] + "ocelot")
 #from ocelot.gui.accelerator import *
 from ocelot.cpbd.track import *
 import correction_analysis as ca
+from lattices.sequence_index import SequenceIndex, nearest
+from lattices.twiss_checkpoints import section_checkpoints
+from lattices.segmented_optics import SegmentedOptics
+from lattices.linear_optics import LinearOptics
 from mint.xfel_interface import *
 from mint.bessy_interface import *
 from mint.flash_interface import *
@@ -33,6 +37,8 @@ from orbit import OrbitInterface
 from dispersion import *
 from gui.gui_main import *
 from gui.settings_gui import *
+from gui.tables.device_state_table import TableWidgetSync
+from mint.devices import DeviceStateModel, DeviceUI
 from ml.adviser_gui import *
 
 
@@ -136,6 +142,7 @@ class ManulInterfaceWindow(QMainWindow):
             return
 
         self.online_calc = True
+        self.segmented_optics = None
         self.multiPvTimer = QtCore.QTimer()
 
         self.add_plot()
@@ -143,8 +150,6 @@ class ManulInterfaceWindow(QMainWindow):
         self.timer_live = pg.QtCore.QTimer()
         self.timer_live.timeout.connect(self.orbit.live_orbit)
 
-        self.feedback_timer = pg.QtCore.QTimer()
-        self.feedback_timer.timeout.connect(self.orbit.auto_correction)
         self.cor_analysis = None
         self.load_lattice_files()
         self.lat = self.return_lat()
@@ -176,6 +181,8 @@ class ManulInterfaceWindow(QMainWindow):
         return False
 
     def closeEvent(self, event):
+        self.orbit.stop_orbit_keeper(stop_remote=False)
+        self.orbit.stop_live_streamer()
         if self.orbit.adaptive_feedback is not None:
             self.orbit.adaptive_feedback.close()
         if self.ui.cb_freeze_bpms.isChecked():
@@ -229,7 +236,8 @@ class ManulInterfaceWindow(QMainWindow):
         current_lat = self.ui.cb_lattice.currentText()
         section = self.xfel_lattice.get_section(current_lat)
         self.big_sequence = self.xfel_lattice.get_sequence(section)
-        self.get_cor_bpm_lists(seq=self.big_sequence, start_pos=self.xfel_lattice.lat_zi, energy=130)
+        self.get_cor_bpm_lists(seq=self.big_sequence, start_pos=self.xfel_lattice.lat_zi, energy=130,
+                               index=getattr(section, "index", None))
 
     def run_settings_window(self):
         if self.settings is None:
@@ -333,65 +341,74 @@ class ManulInterfaceWindow(QMainWindow):
 
     def update_table(self):
         for quad in self.quads:
+            # the quad is set outside of calc_twiss(), it has to be repainted
+            quad.painted_kick = None
             quad.ui.set_init_value(quad.kick_mrad)
             quad.ui.set_value(quad.kick_mrad)
+        # set_value() writes the model only, on_change is not called for programmatic values
+        self.calc_twiss()
 
     def reset_quads(self):
         for quad in self.quads:
             #print(quad.i_kick)
             quad.ui.set_value(quad.i_kick)
-        #self.calc()
+        self.calc_twiss()
 
-    def get_cor_bpm_lists(self, seq, start_pos=23.2, energy=130.):
+    def get_cor_bpm_lists(self, seq, start_pos=23.2, energy=130., index=None):
         """
         Function to get from sequence correctors and bpms with their posstions and beam energy
 
         :param seq: MagneticLattice.sequence
         :param start_pos: starting position
         :param energy: starting energy
+        :param index: SequenceIndex of seq or None
         :return: list of correctors
         """
+        if index is None or index.seq is not seq:
+            index = SequenceIndex(seq, s0=start_pos)
+        cor_pos = index.of_types(Hcor, Vcor)
+        bpm_pos = index.of_types(Monitor)
+        cav_pos = index.of_types(Cavity)
+        # energy gain of the cavities, the energy at an element includes all cavities upstream of it
+        gain = np.cumsum([0.] + [seq[i].v*np.cos(seq[i].phi*np.pi/180.) for i in cav_pos])
+        self.corr_s = index.s_center(cor_pos, s0=start_pos)
+        self.bpm_s = index.s_center(bpm_pos, s0=start_pos)
         self.corr_list = []
         self.bpm_list = []
-        L = start_pos
-        E = energy
-        for elem in seq:
-            L += elem.l
-            if elem.__class__ in [Hcor, Vcor]:
-                elem.s_pos = L - elem.l/2.
-                elem.E = E
-                self.corr_list.append(elem)
-            if elem.__class__ in [Monitor]:
-                elem.s_pos = L - elem.l/2.
+        for positions, s_pos, devs in [(cor_pos, self.corr_s, self.corr_list), (bpm_pos, self.bpm_s, self.bpm_list)]:
+            energies = energy + gain[np.searchsorted(cav_pos, positions)]
+            for i, s, E in zip(positions, s_pos, energies):
+                elem = seq[i]
+                elem.s_pos = s
                 elem.E = E
-                self.bpm_list.append(elem)
-            if elem.__class__ == Cavity:
-                E += elem.v*np.cos(elem.phi*np.pi/180.)
+                devs.append(elem)
         return self.corr_list
 
     def read_quads(self):
 
         self.online_calc = False
-        for elem in self.quads:
-            elem.kick_mrad = elem.mi.get_value()
+        values, errors = self.mi.get_devices_values([elem.mi for elem in self.quads])
+        if len(errors) > 0:
+            raise list(errors.values())[0]
+        for elem, value in zip(self.quads, values):
+            elem.kick_mrad = value
             k1 = elem.kick_mrad/elem.l*1e-3
             logger.debug("Quad."+elem.id + " updated. k1 = "+str(k1)+ " /  diff = " + str(k1 - elem.k1))
             elem.k1 = k1
             elem.i_kick = elem.kick_mrad
+            elem.painted_kick = None
             #print(elem.i_kick)
             #elem.ui.set_init_value(elem.kick_mrad)
             elem.ui.set_value(elem.kick_mrad)
             elem.ui.check_diff()
 
-        for cav in self.cavs:
-            try:
-                v = cav.mi.get_value()
-            except:
+        volts = self.mi.bulk_call(lambda cav: cav.mi.get_value(), [(cav,) for cav in self.cavs])
+        phases = self.mi.bulk_call(lambda cav: cav.mi.get_phase(), [(cav,) for cav in self.cavs])
+        for cav, (v, v_exc), (phi, phi_exc) in zip(self.cavs, volts, phases):
+            if v_exc is not None:
                 v = 0.
                 logger.warning("Could not read cavity voltage: " +cav.id)
-            try:
-                phi = cav.mi.get_phase()
-            except:
+            if phi_exc is not None:
                 phi = 0.
                 logger.warning("Could not read cavity phase: " +cav.id)
             logger.debug("Cavity: " + cav.id + " updated. v [GeV] = " + str(v) + " / diff [MeV] = " + str(v -  cav.v*1000))
@@ -402,27 +419,28 @@ class ManulInterfaceWindow(QMainWindow):
             
         self.online_calc = True
         self.lat.update_transfer_maps()
+        self.segmented_optics = None
+        self.orbit.invalidate_trajectory()
         self.tws0 = self.back_tracking()
         self.tws0.s = 0
         logger.debug("back_tracking result: " + str(self.tws0))
-        tws = twiss(self.lat, self.tws0)
-        beta_x = [tw.beta_x for tw in tws]
-        beta_y = [tw.beta_y for tw in tws]
-        dx = [tw.Dx for tw in tws]
-        dy = [tw.Dy for tw in tws]
-        s = [tw.s for tw in tws]
-
-        self.update_plot(s, beta_x, beta_y, dx, dy)
+        self.segmented_optics = SegmentedOptics(self.lat, self.tws0.E)
+        tws = self.segmented_optics.twiss(self.tws0)
+        self.update_plot(tws["s"], tws["beta_x"], tws["beta_y"], tws["Dx"], tws["Dy"])
         update = self.question_box("Recalculate Orbit Response Matrix?")
         if update:
             self.orbit.calc_response_matrix(do_DRM_calc=False)
 
     def back_tracking(self):
+        """
+        Twiss at the beginning of the section from the Twiss measured at the OTR station. The measured Twiss is
+        propagated upstream with the inverted cumulative map of the section (see TwissCheckpoints)
+
+        :return: Twiss
+        """
         logger.debug("back_tracking: ... ")
         tws0 = self.read_twiss()
         current_lat = self.ui.cb_lattice.currentText()
-        section = self.xfel_lattice.return_lat_section(current_lat)
-        cell_back_track = section.seq
 
         if self.ui.cb_design_tws.isChecked():
             return self.tws_des
@@ -436,33 +454,15 @@ class ManulInterfaceWindow(QMainWindow):
         else:
             stop = 'OTRC.55.I1'
 
-        stop_elem = cell_back_track[[elem.id for elem in cell_back_track].index(stop)]
-
-        lat_tmp = MagneticLattice(cell_back_track, stop=stop_elem)
-        lat_tmp = MagneticLattice(lat_tmp.sequence[::-1])
-        for elem in lat_tmp.sequence:
-            if elem.__class__  == Cavity:
-                elem.phi -= 180
-                #print(elem.v, elem.phi)
-        lat_tmp.update_transfer_maps()
-
-        tws0.alpha_x = -tws0.alpha_x
-        tws0.alpha_y = -tws0.alpha_y
-        #print("start", tws0)
-        tws = twiss(lat_tmp, tws0)
-        #plot_opt_func(lat_tmp, tws)
-        #plt.show()
+        section = self.xfel_lattice.get_section(current_lat)
+        tws = section_checkpoints(self.xfel_lattice, section).twiss_upstream(tws0, stop)
         self.tws0 = Twiss()
-        self.tws0.beta_x = tws[-1].beta_x
-        self.tws0.beta_y = tws[-1].beta_y
-        self.tws0.alpha_x = -tws[-1].alpha_x
-        self.tws0.alpha_y = -tws[-1].alpha_y
+        self.tws0.beta_x = tws.beta_x
+        self.tws0.beta_y = tws.beta_y
+        self.tws0.alpha_x = tws.alpha_x
+        self.tws0.alpha_y = tws.alpha_y
         self.tws0.s = 0
-        self.tws0.E = tws[-1].E
-        for elem in lat_tmp.sequence:
-            if elem.__class__  == Cavity:
-                elem.phi += 180
-        lat_tmp.update_transfer_maps()
+        self.tws0.E = tws.E
         logger.debug("back_tracking: ... OK")
         return self.tws0
 
@@ -520,7 +520,9 @@ class ManulInterfaceWindow(QMainWindow):
         for i, quad in enumerate(quads):
             quad.kick_mrad = res[i]
             quad.k1 = res[i]/quad.l/1000.
+            quad.painted_kick = None
             quad.ui.set_value(quad.kick_mrad)
+        self.calc_twiss()
 
     def apply_coupler_kick(self):
         logger.debug("apply_coupler_kick: checkbox:" +str(self.ui.cb_coupler_kick.isChecked()))
@@ -541,6 +543,7 @@ class ManulInterfaceWindow(QMainWindow):
                 if elem.__class__ == Cavity and not(".AH1." in elem.id):# and not(".A1." in elem.id):
                     elem.coupler_kick = False
         self.lat.update_transfer_maps()
+        self.segmented_optics = None
         self.calc_twiss()
 
         # calc orbit
@@ -555,6 +558,7 @@ class ManulInterfaceWindow(QMainWindow):
         else:
             method.global_method = SecondTM# TransferMap
         self.lat = MagneticLattice(self.lat.sequence, method=method)
+        self.orbit.invalidate_trajectory()
 
         # calc orbit
         self.orbit.calc_orbit()
@@ -569,10 +573,8 @@ class ManulInterfaceWindow(QMainWindow):
 
         lat_from = self.ui.sb_lat_from.value()
         lat_to = self.ui.sb_lat_to.value()
-        s_poss = np.array([cor.s_pos for cor in self.corr_list])
-        s_poss_end = np.array([bpm.s_pos for bpm in self.bpm_list])
-        idx_frm = (np.abs(s_poss - lat_from)).argmin()
-        idx_to = (np.abs(s_poss_end - lat_to)).argmin()
+        idx_frm = nearest(self.corr_s, lat_from)
+        idx_to = nearest(self.bpm_s, lat_to)
         if idx_frm == idx_to:
             idx_to += 1
             self.ui.sb_lat_to.setValue(self.bpm_list[idx_to].s_pos)
@@ -606,11 +608,13 @@ class ManulInterfaceWindow(QMainWindow):
             raise
 
         self.seq = section.seq
-        total_len = np.sum([elem.l for elem in section.seq])
+        index = getattr(section, "index", None)
+        total_len = index.s_end[-1] if index is not None else np.sum([elem.l for elem in section.seq])
         self.lat_zi = section.z0
         self.tws_des = section.tws_des
 
-        self.corr_list = self.get_cor_bpm_lists(seq=self.seq, start_pos=self.lat_zi, energy=self.tws_des.E)
+        self.corr_list = self.get_cor_bpm_lists(seq=self.seq, start_pos=self.lat_zi, energy=self.tws_des.E,
+                                                index=index)
         self.ui.sb_lat_from.setMinimum(self.lat_zi)
         self.ui.sb_lat_from.setMaximum(self.lat_zi + total_len - 30)
         self.ui.sb_lat_to.setMaximum(self.lat_zi + total_len)
@@ -668,6 +672,7 @@ class ManulInterfaceWindow(QMainWindow):
                 elem.k1_th = elem.k1
                 elem.kick_mrad = elem.k1 * elem.l * 1000.
                 elem.i_kick = elem.kick_mrad
+                elem.painted_kick = None
                 devices.append(elem)
                 mi_dev = Device(eid=self.server + ".MAGNETS/MAGNET.ML/" + elem.id + "/KICK_MRAD.SP")
                 mi_dev.mi = self.mi
@@ -689,7 +694,7 @@ class ManulInterfaceWindow(QMainWindow):
         self.quads = self.load_devices(types=[Quadrupole])
         self.cavs = self.load_cavs()
 
-        self.add_devs2table(self.quads, w_table=self.ui.tableWidget, calc_obj=self.calc_twiss)
+        self.quad_model = self.add_devs2table(self.quads, w_table=self.ui.tableWidget, calc_obj=self.calc_twiss)
 
         self.quad_ampl = np.max(np.abs(np.array([q.kick_mrad for q in self.quads])))
         # for orbit
@@ -702,23 +707,33 @@ class ManulInterfaceWindow(QMainWindow):
 
 
     def plot_design_twiss(self):
-        tws = twiss(self.lat, self.tws_des)
+        tws = LinearOptics(self.lat, self.tws_des.E).twiss(self.tws_des)
         dz = self.lat_zi - self.tws_des.s
-        s = np.array([tw.s for tw in tws]) + dz
-        bx = np.array([tw.beta_x for tw in tws])
-        by = np.array([tw.beta_y for tw in tws])
-        self.beta_x_des.setData(x=s, y=bx)
-        self.beta_y_des.setData(x=s, y=by)
+        self.beta_x_des.setData(x=tws["s"] + dz, y=tws["beta_x"])
+        self.beta_y_des.setData(x=tws["s"] + dz, y=tws["beta_y"])
     #    self.r_items = self.plot_lat(plot_wdg=self.plot2, types=[Quadrupole])
 
     def calc_twiss(self, calc=True):
+        """
+        Optics update after quadrupole edits. Only the changed quadrupoles get new transfer maps and are repainted,
+        the Twiss functions are propagated with the cumulative maps of SegmentedOptics.
+        elem.painted_kick is the kick of the last repaint, code which sets a quad outside of calc_twiss()
+        (read_quads(), match(), ...) resets it to None.
+        """
         #lat = MagneticLattice(cell)
         if self.online_calc == False:
             return
+        optics = self.segmented_optics
+        if optics is None or optics.lat is not self.lat or optics.energy != self.tws0.E:
+            optics = None
         # L = 0
         for elem in self.lat.sequence:
             if elem.__class__ in [Quadrupole]:
-                elem.kick_mrad = elem.ui.get_value()
+                kick_mrad = elem.ui.get_value()
+                if optics is not None and kick_mrad == getattr(elem, "painted_kick", None):
+                    continue
+                elem.painted_kick = kick_mrad
+                elem.kick_mrad = kick_mrad
                 elem.k1 = elem.kick_mrad/elem.l/1000 if elem.l != 0 else 0
                 if np.abs(np.abs(elem.kick_mrad) - np.abs(elem.i_kick))> 1:
                     self.r_items[elem.ui.row].setBrush(pg.mkBrush("r"))
@@ -730,24 +745,42 @@ class ManulInterfaceWindow(QMainWindow):
                 sizes = r.init_params
                 sizes[3] = 10*elem.kick_mrad/self.quad_ampl
                 r.setRect(sizes[0], sizes[1], sizes[2], sizes[3])
-        self.lat.update_transfer_maps()
         self.tws0.s = 0
-        if self.mi.twiss_periodic is True:
-            tws = twiss(self.lat, None)
-        else:
-            tws = twiss(self.lat, self.tws0)
-        beta_x = [tw.beta_x for tw in tws]
-        beta_y = [tw.beta_y for tw in tws]
-        dx = [tw.Dx for tw in tws]
-        dy = [tw.Dy for tw in tws]
-        s = [tw.s for tw in tws]
-        self.update_plot(s, beta_x, beta_y, dx, dy)
+        if self.mi.twiss_periodic is not True:
+            if optics is None:
+                self.lat.update_transfer_maps()
+                optics = SegmentedOptics(self.lat, self.tws0.E)
+                self.segmented_optics = optics
+            else:
+                optics.update()
+            self.orbit.invalidate_trajectory()
+            tws = optics.twiss(self.tws0)
+            self.update_plot(tws["s"], tws["beta_x"], tws["beta_y"], tws["Dx"], tws["Dy"])
+            return
+        self.lat.update_transfer_maps()
+        self.orbit.invalidate_trajectory()
+        optics = LinearOptics(self.lat, self.tws0.E)
+        tws0 = optics.periodic_twiss()
+        if tws0 is None:
+            return
+        tws = optics.twiss(tws0)
+        self.update_plot(tws["s"], tws["beta_x"], tws["beta_y"], tws["Dx"], tws["Dy"])
 
     def add_devs2table(self, devs, w_table, calc_obj, spin_params=[-5000, 5000, 5], check_box=False):
-        """ Initialize the UI table object """
+        """
+        Initialize the UI table object.
+        Numbers live in a DeviceStateModel (returned), the table is only a view on it.
+        """
         #spin_boxes = [QtGui.QDoubleSpinBox()]*
         self.spin_boxes = []
+        if getattr(w_table, "state_sync", None) is not None:
+            w_table.state_sync.detach()
+        w_table.state_sync = None
+        model = DeviceStateModel(ids=[dev.id for dev in devs])
+        model.set_values([dev.kick_mrad for dev in devs], init=True)
+        model.dirty = set()
         w_table.setRowCount(0)
+        sync = TableWidgetSync(model, w_table, on_change=calc_obj)
         for row in range(len(devs)):
             eng = QtCore.QLocale(QtCore.QLocale.English, QtCore.QLocale.UnitedStates)
             w_table.setRowCount(row + 1)
@@ -766,7 +799,7 @@ class ManulInterfaceWindow(QMainWindow):
             spin_box.setSingleStep(spin_params[2])
             spin_box.setValue(devs[row].kick_mrad)
             spin_box.setAccelerated(True)
-            spin_box.valueChanged.connect(calc_obj)
+            sync.connect_spin_box(row, spin_box)
             # spin_box.setFixedWidth(50)
             w_table.setCellWidget(row, 2, spin_box)
             #w_table.resizeColumnsToContents()
@@ -786,10 +819,13 @@ class ManulInterfaceWindow(QMainWindow):
 
             ui = DeviceUI()
             ui.tableWidget = w_table
+            ui.model = model
             ui.row = row
             ui.col = 2
             devs[row].ui = ui
+        w_table.state_sync = sync
         #w_table.repaint()
+        return model
 
 
     def plot_lat(self, plot_wdg, types, x_scale=1):
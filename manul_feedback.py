@@ -0,0 +1,478 @@
+"""
+Headless Orbit Keeper daemon.
+
+The feedback loop runs in its own process, independent of the Manul GUI, and is controlled over a local
+Unix-domain socket with JSON-RPC 2.0 (one request per line):
+
+    python manul_feedback.py serve [--socket PATH] [--devmode] [MachineInterface options]
+    python manul_feedback.py call status
+    python manul_feedback.py call load_job '{"job": {...}}'
+    python manul_feedback.py call start
+
+Methods: load_job, start, stop, status, set_golden_orbit, stats.
+The job (see FeedbackJob) is exported by the GUI with OrbitInterface.feedback_job(): BPMs, correctors, golden orbit,
+solver settings and a reference to the response matrix in the RM cache. The daemon reads the orbit with the shared
+OrbitStreamer, solves with orbit_math.correction_angles() (the same solve as the Orbit Keeper of the GUI) and writes
+the kicks with MachineInterface.set_devices_transaction(). Any number of consoles can watch the same loop with
+"status"/"stats".
+
+Limits compared to the Orbit Keeper of the GUI: orbit correction only (no dispersion correction, alpha = 0),
+no close orbit, no check of the corrector hardware status and no uncheck of BPMs with low charge relative to
+the bunch charge (BPMs below charge_thresh are skipped in a cycle). The GUI starts it only if
+"Run in feedback daemon" is checked.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import stat
+import argparse
+import socketserver
+from threading import Lock
+import numpy as np
+import logging
+
+from mint.xfel_interface import XFELMachineInterface, TestMachineInterface
+from mint.flash_interface import FLASHMachineInterface
+from mint.orbit_streamer import acquire_streamer, release_streamer, snapshot_indices
+from orbit_math import correction_angles, matrix_fingerprint, SolverCache, CachedOrbitSVD, CachedMICADO
+from rm_cache import ResponseMatrixCache
+from feedback_engine import FeedbackEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".manul_feedback.sock")
+
+MACHINE_INTERFACES = {"XFELMachineInterface": XFELMachineInterface,
+                      "TestMachineInterface": TestMachineInterface,
+                      "FLASHMachineInterface": FLASHMachineInterface}
+
+
+class FeedbackJob:
+    """
+    Description of an Orbit Keeper loop
+
+    :param job: dictionary with
+        "name" - name for status and logs,
+        "server", "subtrain", "bpm_server" - as in the GUI settings,
+        "bpms" - list of BPM ids, "corrs" - list of corrector ids (columns of the RM),
+        "golden_orbit" - {bpm_id: [x, y]} in [m], missing BPMs have reference 0,
+        "rm" - {"cache_dir", "key"} of the RM cache or {"matrix", "cor_names", "bpm_names"},
+               rows of the matrix are x of all BPMs and then y of all BPMs, [m/rad],
+        "corrs" must be horizontal and then vertical correctors as in the GUI,
+        "solver" - "SVD" or "MICADO" (default "SVD"),
+        "epsilon_x", "epsilon_y", "epsilon_ksi" - solver parameters (default "epsilon" or 0.001, 1e-5),
+        "beta" - weight for suppression of large kicks (default 0.), "weights" - {bpm_id: weight} (default 1.),
+        "gain" - fraction of the correction (default 1.),
+        "period" - repetition period [sec] (default 1.), "settle" - wait after writing [sec] (default 0.5),
+        "charge_thresh" - minimum charge [nC] (default 0.005)
+    """
+    def __init__(self, job):
+        self.job = dict(job)
+        self.name = job.get("name", "Orbit Keeper")
+        self.server = job.get("server", "XFEL")
+        self.subtrain = job.get("subtrain", "SA1")
+        self.bpm_server = job.get("bpm_server", "ORBIT")
+        self.bpms = list(job["bpms"])
+        self.corrs = list(job["corrs"])
+        self.golden_orbit = dict(job.get("golden_orbit", {}))
+        epsilon = float(job.get("epsilon", 0.001))
+        self.solver = job.get("solver", "SVD")
+        if self.solver not in ("SVD", "MICADO"):
+            raise ValueError("unknown solver: " + str(self.solver))
+        self.epsilon_x = float(job.get("epsilon_x", epsilon))
+        self.epsilon_y = float(job.get("epsilon_y", epsilon))
+        self.epsilon_ksi = float(job.get("epsilon_ksi", 1e-5))
+        self.beta = float(job.get("beta", 0.))
+        weights = job.get("weights", {})
+        self.weights = np.array([float(weights.get(name, 1.)) for name in self.bpms])
+        self.gain = float(job.get("gain", 1.))
+        self.period = float(job.get("period", 1.))
+        self.settle = float(job.get("settle", 0.5))
+        self.charge_thresh = float(job.get("charge_thresh", 0.005))
+        self.matrix = self.load_matrix(job["rm"])
+
+    def load_matrix(self, rm):
+        """
+        :return: response matrix with rows x(bpms), y(bpms) and columns corrs
+        """
+        if "key" in rm:
+            cached = ResponseMatrixCache(rm["cache_dir"]).get(rm["key"], kind="RM", cor_names=self.corrs,
+                                                              bpm_names=self.bpms)
+            if cached is None:
+                raise ValueError("RM " + rm["key"] + " is not in the cache or does not have all devices")
+            matrix, cor_names, bpm_names = cached
+        else:
+            matrix, cor_names, bpm_names = rm["matrix"], rm["cor_names"], rm["bpm_names"]
+        matrix = np.asarray(matrix, dtype=float)
+        row_pos = {name: i for i, name in enumerate(bpm_names)}
+        col_pos = {name: i for i, name in enumerate(cor_names)}
+        missing = [name for name in self.bpms if name not in row_pos] + \
+                  [name for name in self.corrs if name not in col_pos]
+        if len(missing) > 0:
+            raise ValueError("devices are not in the RM: " + str(missing))
+        nbpms = len(bpm_names)
+        rows = [row_pos[name] for name in self.bpms] + [row_pos[name] + nbpms for name in self.bpms]
+        return matrix[np.ix_(rows, [col_pos[name] for name in self.corrs])]
+
+
+class OrbitKeeperLoop:
+    """
+    Orbit Keeper cycle without GUI: read -> estimate -> solve -> write -> settle
+
+    :param mi: MachineInterface
+    :param job: FeedbackJob
+    """
+    def __init__(self, mi, job):
+        self.mi = mi
+        self.job = job
+        mi_orbit = mi.devices.MIOrbit(server=job.server, subtrain=job.subtrain)
+        mi_orbit.bpm_server = job.bpm_server
+        mi_orbit.mi = mi
+        self.streamer = acquire_streamer(mi_orbit)
+        self.cors = []
+        for name in job.corrs:
+            cor = mi.devices.Corrector(eid=name, server=job.server, subtrain=job.subtrain)
+            cor.mi = mi
+            self.cors.append(cor)
+        if hasattr(mi.devices, "MICorrectorBank"):
+            self.cor_bank = mi.devices.MICorrectorBank(server=job.server, subtrain=job.subtrain)
+            self.cor_bank.mi = mi
+        else:
+            self.cor_bank = None
+        self.x_ref = np.zeros(len(job.bpms))
+        self.y_ref = np.zeros(len(job.bpms))
+        self.set_golden_orbit(job.golden_orbit)
+        if job.solver == "SVD":
+            self.solver = CachedOrbitSVD(epsilon_x=job.epsilon_x, epsilon_y=job.epsilon_y, cache=SolverCache())
+        else:
+            self.solver = CachedMICADO(epsilon_x=job.epsilon_x, epsilon_y=job.epsilon_y,
+                                       epsilon_ksi=job.epsilon_ksi, cache=SolverCache())
+        # the RM of a job does not change, it is hashed once and not in every cycle
+        self.solver.set_matrix_key(matrix_fingerprint(job.matrix))
+        self.last_train_id = None
+        self.last = {}
+
+    def set_golden_orbit(self, orbit):
+        """
+        :param orbit: {bpm_id: [x, y]} in [m]
+        :return: number of BPMs of the job which got a reference
+        """
+        n = 0
+        for i, name in enumerate(self.job.bpms):
+            if name in orbit:
+                self.x_ref[i], self.y_ref[i] = orbit[name]
+                n += 1
+        return n
+
+    def read_kicks(self):
+        if self.cor_bank is not None:
+            values, errors = self.cor_bank.get_values(self.cors)
+        else:
+            values, errors = self.mi.get_devices_values(self.cors)
+        if errors:
+            raise IOError("could not read correctors: " + ", ".join(errors.keys()))
+        return np.array(values, dtype=float)
+
+    def read_limits(self):
+        if self.cor_bank is not None:
+            limits, errors = self.cor_bank.get_limits(self.cors)
+            if errors:
+                raise IOError("could not read corrector limits: " + ", ".join(errors.keys()))
+            return np.array(limits, dtype=float)
+        return np.array([cor.get_limits() for cor in self.cors], dtype=float)
+
+    def cycle(self, engine):
+        budget = engine.budget
+        job = self.job
+        with budget.stage("read"):
+            snapshot = self.streamer.wait_next(after=self.last_train_id, timeout=max(1., job.period))
+            kicks = self.read_kicks()
+        if snapshot is None:
+            self.last = {"beam_on": False, "time": time.time()}
+            return None
+        self.last_train_id = snapshot.train_id
+
+        with budget.stage("estimate"):
+            indx, found = snapshot_indices(snapshot, job.bpms)
+            x = snapshot.x[indx] / 1000.
+            y = snapshot.y[indx] / 1000.
+            charge = snapshot.charge[indx]
+            active = found & np.isfinite(x) & np.isfinite(y) & (charge >= job.charge_thresh)
+            if not np.any(active):
+                self.last = {"beam_on": False, "train_id": snapshot.train_id, "time": time.time()}
+                return None
+            dx = x[active] - self.x_ref[active]
+            dy = y[active] - self.y_ref[active]
+
+        with budget.stage("solve"):
+            rows = np.append(np.flatnonzero(active), np.flatnonzero(active) + len(job.bpms))
+            self.solver.set_device_ids([name for name, ok in zip(job.bpms, active) if ok], job.corrs)
+            angles = correction_angles(job.matrix[rows], np.append(dx, dy), self.solver, beta=job.beta,
+                                       weights=job.weights[active])
+            # angles [rad] -> kicks [mrad]
+            new_kicks = kicks + job.gain * angles * 1000.
+            limits = self.read_limits()
+            out = (new_kicks < limits[:, 0]) | (new_kicks > limits[:, 1])
+        if np.any(out):
+            engine.stop("kick exceeds limits: " + ", ".join(np.array(job.corrs)[out]))
+            return None
+
+        with budget.stage("write"):
+            ok, report = self.mi.set_devices_transaction(self.cors, new_kicks.tolist(), snapshot=kicks.tolist(),
+                                                         verify=True)
+        if not ok:
+            errors = {name: r["error"] for name, r in report.items() if r["error"] is not None}
+            engine.stop("kicks were not applied: " + json.dumps(errors))
+            return None
+        self.last = {"beam_on": True, "train_id": snapshot.train_id, "time": time.time(),
+                     "nbpms": int(np.count_nonzero(active)),
+                     "rms_x": float(np.sqrt(np.mean(dx**2))), "rms_y": float(np.sqrt(np.mean(dy**2))),
+                     "max_delta_kick": float(np.max(np.abs(new_kicks - kicks))) if len(kicks) else 0.}
+        with budget.stage("settle"):
+            engine.sleep(job.settle)
+        return self.last
+
+    def close(self):
+        release_streamer(self.streamer)
+
+
+class FeedbackDaemon:
+    """
+    State of the daemon and the RPC methods
+
+    :param mi: MachineInterface
+    :param stats_file: JSON file for FeedbackEngine statistics
+    """
+    def __init__(self, mi, stats_file="./logs/feedback_daemon_stats.json"):
+        self.mi = mi
+        self.stats_file = stats_file
+        self.lock = Lock()
+        self.job = None
+        self.loop = None
+        self.engine = None
+        self.reason = ""
+        self.methods = {"load_job": self.load_job, "start": self.start, "stop": self.stop, "status": self.status,
+                        "set_golden_orbit": self.set_golden_orbit, "stats": self.stats}
+
+    def load_job(self, job):
+        with self.lock:
+            if self.is_running():
+                raise RuntimeError("feedback is running, stop it first")
+            new_job = FeedbackJob(job)
+            if self.loop is not None:
+                self.loop.close()
+            self.loop = OrbitKeeperLoop(self.mi, new_job)
+            self.job = new_job
+            logger.info(" FeedbackDaemon: job " + new_job.name + " is loaded: nbpms = " + str(len(new_job.bpms)) +
+                        " ncorrs = " + str(len(new_job.corrs)))
+            return self.status()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                raise RuntimeError("no job is loaded")
+            if not self.is_running():
+                self.engine = FeedbackEngine(cycle=self.loop.cycle, period=self.job.period, name=self.job.name,
+                                             stats_file=self.stats_file)
+                self.reason = ""
+                self.engine.start()
+            return self.status()
+
+    def stop(self, reason="stopped"):
+        with self.lock:
+            if self.is_running():
+                self.engine.stop(reason)
+                self.engine.join(timeout=10.)
+            return self.status()
+
+    def is_running(self):
+        return self.engine is not None and self.engine.is_alive()
+
+    def status(self):
+        status = {"running": self.is_running(), "job": None if self.job is None else self.job.name}
+        if self.engine is not None:
+            status["reason"] = self.engine.reason if not self.is_running() else ""
+            status["ncycles"] = self.engine.ncycles
+            status["overruns"] = self.engine.overruns
+        if self.loop is not None:
+            status["last_cycle"] = self.loop.last
+        return status
+
+    def set_golden_orbit(self, orbit):
+        with self.lock:
+            if self.loop is None:
+                raise RuntimeError("no job is loaded")
+            return {"nbpms": self.loop.set_golden_orbit(orbit)}
+
+    def stats(self):
+        if self.engine is None:
+            return {}
+        return self.engine.get_stats()
+
+    def dispatch(self, request):
+        """
+        :param request: JSON-RPC 2.0 request (dictionary)
+        :return: JSON-RPC 2.0 response (dictionary)
+        """
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        method = self.methods.get(request.get("method"))
+        if method is None:
+            response["error"] = {"code": -32601, "message": "Method not found: " + str(request.get("method"))}
+            return response
+        params = request.get("params", {})
+        try:
+            response["result"] = method(**params) if isinstance(params, dict) else method(*params)
+        except Exception as e:
+            logger.warning(" FeedbackDaemon: " + str(request.get("method")) + ": " + str(e))
+            response["error"] = {"code": -32000, "message": str(e)}
+        return response
+
+
+class RPCHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+            except ValueError as e:
+                response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": str(e)}}
+            else:
+                response = self.server.daemon.dispatch(request)
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class RPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            self.remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path, RPCHandler)
+        os.chmod(path, 0o600)
+        self.daemon = daemon
+
+    @staticmethod
+    def remove_stale_socket(path):
+        """
+        Method removes the socket of a daemon which was not shut down cleanly
+
+        :raise RuntimeError: if path is not a socket or another daemon answers on it
+        """
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise RuntimeError(path + " exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1.)
+            try:
+                sock.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                logger.info(" RPCServer: remove stale socket " + path)
+                os.remove(path)
+                return
+        raise RuntimeError("another feedback daemon is listening on " + path)
+
+
+class FeedbackClient:
+    """
+    Client of the feedback daemon
+
+    :param path: path of the Unix socket
+    :param timeout: [sec]
+    """
+    def __init__(self, path=DEFAULT_SOCKET, timeout=15.):
+        self.path = path
+        self.timeout = timeout
+        self._id = 0
+
+    def is_available(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            self.call("status")
+        except Exception:
+            return False
+        return True
+
+    def call(self, method, **params):
+        """
+        :param method: name of the method
+        :param params: parameters
+        :return: result
+        :raise RuntimeError: if the daemon returns an error
+        """
+        self._id += 1
+        request = {"jsonrpc": "2.0", "id": self._id, "method": method, "params": params}
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall((json.dumps(request) + "\n").encode())
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline().decode())
+        if "error" in response:
+            raise RuntimeError(response["error"]["message"])
+        return response["result"]
+
+    def load_job(self, job):
+        return self.call("load_job", job=job)
+
+    def start(self):
+        return self.call("start")
+
+    def stop(self):
+        return self.call("stop")
+
+    def status(self):
+        return self.call("status")
+
+    def set_golden_orbit(self, orbit):
+        return self.call("set_golden_orbit", orbit=orbit)
+
+    def stats(self):
+        return self.call("stats")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless Orbit Keeper daemon")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path of the Unix socket")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the daemon")
+    serve.add_argument("--mi", default="XFELMachineInterface", choices=sorted(MACHINE_INTERFACES.keys()))
+    serve.add_argument("--devmode", action="store_true", default=False, help="use TestMachineInterface")
+    serve.add_argument("--job", default=None, help="JSON file with a job to load at start")
+    call = commands.add_parser("call", help="call a method of a running daemon")
+    call.add_argument("method")
+    call.add_argument("params", nargs="?", default="{}", help="JSON object with parameters")
+    args, others = parser.parse_known_args(argv)
+
+    if args.command == "call":
+        print(json.dumps(FeedbackClient(args.socket).call(args.method, **json.loads(args.params)), indent=1))
+        return
+    if args.command != "serve":
+        parser.print_help()
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    mi_class = TestMachineInterface if args.devmode else MACHINE_INTERFACES[args.mi]
+    mi = mi_class(vars(args))
+    daemon = FeedbackDaemon(mi)
+    if args.job is not None:
+        with open(args.job, "r") as f:
+            daemon.load_job(json.load(f))
+    server = RPCServer(args.socket, daemon)
+    logger.info(" FeedbackDaemon: listening on " + args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop("daemon shutdown")
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -190,6 +190,18 @@ class BESSYMachineInterface(MachineInterface):
         epics.PV(channel).put(val)
         return
 
+    def get_values(self, channels):
+        """
+        Bulk getter with one Channel Access request for all channels (epics.caget_many)
+
+        :param channels: list of channels
+        :return: (values, errors) - list of values in the order of channels (None if reading failed)
+                 and dictionary {channel: exception} of the failed channels
+        """
+        values = epics.caget_many(channels)
+        errors = {ch: IOError("could not read " + ch) for ch, val in zip(channels, values) if val is None}
+        return values, errors
+
     def get_raw_value(self, channel):
         """
         Getter function for XFEL.
@@ -271,6 +283,9 @@ class BESSYTestInterface(BESSYMachineInterface):
         self.data += np.sqrt(val ** 2)
         return 0.0
 
+    def get_values(self, channels):
+        return MachineInterface.get_values(self, channels)
+
     def get_bpms_xy(self, bpms):
         """
         Testing method for getting bmps data
@@ -2,10 +2,12 @@
 Sergey Tomin, XFEL/DESY, 2017
 """
 from mint.interface import Device
+from mint.wildcard import WildcardDecoder
+from mint.orbit_streamer import running_streamer, snapshot_indices
 from PyQt5 import QtGui, QtCore
 import numpy as np
 import time
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,27 +19,54 @@ class Corrector(Device):
         self.subtrain = subtrain
         self.server = server
 
+    def get_value_channel(self):
+        return self.server + ".MAGNETS/MAGNET.ML/" + self.eid + "/KICK_MRAD.SP"
+
+    def set_value_channel(self):
+        return self.server + ".MAGNETS/MAGNET.ML/" + self.eid + "/KICK_MRAD.SP"
+
+    def get_readback_channel(self):
+        return self.server + ".MAGNETS/MAGNET.ML/" + self.eid + "/KICK_MRAD.RBV"
+
+    def get_limit_channels(self):
+        return [self.server + ".MAGNETS/MAGNET.ML/" + self.id + "/MIN_KICK",
+                self.server + ".MAGNETS/MAGNET.ML/" + self.id + "/MAX_KICK"]
+
+    def get_status_channel(self):
+        return self.server + ".MAGNETS/MAGNET.ML/" + self.id + "/COMBINED_STATUS"
+
     def set_value(self, val):
         #self.values.append(val)
         #self.times.append(time.time())
-        ch = self.server + ".MAGNETS/MAGNET.ML/" + self.eid + "/KICK_MRAD.SP"
+        ch = self.set_value_channel()
         self.mi.set_value(ch, val)
 
     def get_value(self):
-        ch = self.server + ".MAGNETS/MAGNET.ML/" + self.eid + "/KICK_MRAD.SP"
+        ch = self.get_value_channel()
         val = self.mi.get_value(ch)
         return val
 
     def get_limits(self):
-        ch_min = self.server+ ".MAGNETS/MAGNET.ML/" + self.id + "/MIN_KICK"
+        ch_min, ch_max = self.get_limit_channels()
         min_kick = self.mi.get_value(ch_min)
-        ch_max = self.server + ".MAGNETS/MAGNET.ML/" + self.id + "/MAX_KICK"
         max_kick = self.mi.get_value(ch_max)
+        return self.limits2mrad(min_kick, max_kick)
+
+    @staticmethod
+    def limits2mrad(min_kick, max_kick):
         return [min_kick*1000, max_kick*1000]
-    
+
     def is_ok(self):
-        ch = self.server+ ".MAGNETS/MAGNET.ML/" + self.id + "/COMBINED_STATUS"
-        status = int(self.mi.get_value(ch))
+        ch = self.get_status_channel()
+        return self.status2ok(self.mi.get_value(ch))
+
+    @staticmethod
+    def status2ok(status):
+        """
+        :param status: value of COMBINED_STATUS
+        :return: True if the power bit is set
+        """
+        status = int(status)
         power_bit = '{0:08b}'.format(status)[-2]
         busy_bit = '{0:08b}'.format(status)[-4]
         
@@ -47,6 +76,73 @@ class Corrector(Device):
             return False
 
 
+class MICorrectorBank(Device):
+    """
+    Reads setpoints, limits and status of all magnets with one wildcard request per property
+    (MAGNET.ML/*/KICK_MRAD.SP, MIN_KICK, MAX_KICK, COMBINED_STATUS) and maps the reply to Corrector devices
+    through a permutation which is rebuilt only when the wildcard name vector changes (see WildcardDecoder).
+    """
+    def __init__(self, eid=None, server="XFEL", subtrain="SA1"):
+        super(MICorrectorBank, self).__init__(eid=eid)
+        self.subtrain = subtrain
+        self.server = server
+        self.decoders = {}
+
+    def wildcard_channel(self, prop):
+        return self.server + ".MAGNETS/MAGNET.ML/*/" + prop
+
+    def read(self, prop, names):
+        """
+        Method reads a property of all magnets with one wildcard request and returns values for names
+
+        :param prop: property, e.g. "KICK_MRAD.SP"
+        :param names: list of magnet names
+        :return: (values, errors) - array of values (NaN if magnet is not in the reply) and dictionary {name: exception}
+        """
+        if prop not in self.decoders:
+            self.decoders[prop] = WildcardDecoder()
+        channel = self.wildcard_channel(prop)
+        values, missing = self.decoders[prop].gather(self.mi.get_value(channel), names)
+        errors = {name: KeyError(name + " is not in " + channel) for name in missing}
+        return values, errors
+
+    def get_values(self, devs):
+        """
+        Bulk version of Corrector.get_value()
+
+        :param devs: list of Correctors
+        :return: (values, errors) - values in [mrad] and dictionary {dev.id: exception}
+        """
+        values, errors = self.read("KICK_MRAD.SP", [dev.eid for dev in devs])
+        errors = {dev.id: errors[dev.eid] for dev in devs if dev.eid in errors}
+        return values.tolist(), errors
+
+    def get_limits(self, devs):
+        """
+        Bulk version of Corrector.get_limits()
+
+        :param devs: list of Correctors
+        :return: (limits, errors) - list of [min, max] in [mrad] and dictionary {dev.id: exception}
+        """
+        names = [dev.id for dev in devs]
+        min_kicks, min_errors = self.read("MIN_KICK", names)
+        max_kicks, max_errors = self.read("MAX_KICK", names)
+        min_errors.update(max_errors)
+        limits = [Corrector.limits2mrad(min_kick, max_kick) for min_kick, max_kick in zip(min_kicks, max_kicks)]
+        return limits, min_errors
+
+    def get_status(self, devs):
+        """
+        Bulk version of Corrector.is_ok()
+
+        :param devs: list of Correctors
+        :return: (status, errors) - list of bool and dictionary {dev.id: exception}
+        """
+        values, errors = self.read("COMBINED_STATUS", [dev.id for dev in devs])
+        status = [False if dev.id in errors else Corrector.status2ok(val) for dev, val in zip(devs, values)]
+        return status, errors
+
+
 class MITwiss(Device):
     def __init__(self, eid=None, server="XFEL", subtrain="SA1"):
         super(MITwiss, self).__init__(eid=eid)
@@ -109,20 +205,149 @@ class CavityA1(Device):
 
 
 
+class DeviceStateModel:
+    """
+    Headless storage of the table state of devices (BPMs or correctors/quadrupoles):
+    active flags, init (read) values and setpoints in arrays.
+    Correction, feedback and undo work on this object and never touch Qt.
+    GUI tables subscribe with add_listener() and get a list of changed rows on flush().
+
+    :param ids: list of device ids (table rows)
+    :param width: number of values per row, e.g. 1 for correctors and 2 (x, y) for BPMs
+    """
+    def __init__(self, ids=None, width=1):
+        self.width = width
+        self.listeners = []
+        self.scheduler = None
+        # rows can be marked from a feedback worker thread while the GUI thread flushes
+        self.lock = Lock()
+        self.reset(ids if ids is not None else [])
+
+    def reset(self, ids):
+        self.ids = list(ids)
+        self.index = {eid: i for i, eid in enumerate(self.ids)}
+        shape = (len(self.ids),) if self.width == 1 else (len(self.ids), self.width)
+        self.values = np.zeros(shape)
+        self.init_values = np.zeros(shape)
+        self.active = np.ones(len(self.ids), dtype=bool)
+        self.alarm = np.zeros(len(self.ids), dtype=bool)
+        self.warn = np.zeros(len(self.ids), dtype=bool)
+        self.hidden = np.zeros(len(self.ids), dtype=bool)
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_listener(self, callback):
+        """
+        :param callback: function(rows) which is called on flush() with a sorted list of changed rows
+        """
+        self.listeners.append(callback)
+
+    def mark(self, row):
+        self.mark_rows([row])
+
+    def mark_rows(self, rows):
+        with self.lock:
+            schedule = not self.dirty
+            self.dirty.update(rows)
+        if schedule and self.scheduler is not None:
+            self.scheduler(self.flush)
+
+    def flush(self):
+        """
+        Method notifies listeners about all rows changed since the last flush (one batch)
+
+        :return: list of changed rows
+        """
+        with self.lock:
+            rows = sorted(self.dirty)
+            self.dirty = set()
+        if rows:
+            for callback in self.listeners:
+                callback(rows)
+        return rows
+
+    def set_value(self, row, val, notify=True):
+        self.values[row] = val
+        if notify:
+            self.mark(row)
+
+    def set_init_value(self, row, val, notify=True):
+        self.init_values[row] = val
+        if notify:
+            self.mark(row)
+
+    def set_active(self, row, flag, notify=True):
+        self.active[row] = bool(flag)
+        if notify:
+            self.mark(row)
+
+    def set_alarm(self, row, flag, warn=False):
+        if self.alarm[row] != bool(flag) or self.warn[row] != bool(warn):
+            self.alarm[row] = bool(flag)
+            self.warn[row] = bool(warn)
+            self.mark(row)
+
+    def set_values(self, values, init=False):
+        """
+        Bulk setter for all rows
+
+        :param values: array of setpoints
+        :param init: if True the init values are set as well
+        :return:
+        """
+        self.values[:] = values
+        if init:
+            self.init_values[:] = values
+        self.mark_rows(range(len(self.ids)))
+
+    def active_ids(self):
+        return [eid for eid, flag in zip(self.ids, self.active) if flag]
+
+    def snapshot(self):
+        """
+        Copy of the arrays, e.g. for the undo database
+
+        :return: dict
+        """
+        return {"ids": list(self.ids), "values": self.values.copy(),
+                "init_values": self.init_values.copy(), "active": self.active.copy()}
+
+    def restore(self, snapshot):
+        if snapshot["ids"] != self.ids:
+            logger.warning(" DeviceStateModel: restore: snapshot ids differ from model ids")
+            return False
+        self.values[:] = snapshot["values"]
+        self.init_values[:] = snapshot["init_values"]
+        self.active[:] = snapshot["active"]
+        self.mark_rows(range(len(self.ids)))
+        return True
+
+
 class BPMUI:
     def __init__(self, ui=None):
         self.tableWidget = None
+        self.model = None
         self.row = 0
         self.col = 0
         self.alarm = False
         self.max_beam_amplitude = 30 # in [mm] 
 
     def get_value(self):
+        if self.model is not None:
+            x, y = self.model.values[self.row]
+            return (x, y)
         x = float(self.tableWidget.item(self.row, 1).text())
         y = float(self.tableWidget.item(self.row, 2).text())
         return (x, y)
 
     def set_value(self, val):
+        if self.model is not None:
+            self.model.set_value(self.row, val)
+            self.model.set_alarm(self.row, self.is_alarm(val))
+            self.alarm = self.model.alarm[self.row]
+            return
         x = val[0]
         y = val[1]
         x = np.round(x, 4)
@@ -143,6 +368,9 @@ class BPMUI:
         self.tableWidget.cellWidget(self.row, 2).setValue(y)
 
 
+    def is_alarm(self, vals):
+        return np.max(np.abs(vals)) > self.max_beam_amplitude or (vals[0] == 0 and vals[1] == 0)
+
     def check_values(self, vals):
         if np.max(np.abs(vals)) > self.max_beam_amplitude:
             self.tableWidget.item(self.row, 1).setBackground(QtGui.QColor(255, 0, 0))  # red
@@ -158,20 +386,33 @@ class BPMUI:
             self.alarm = False
 
     def set_init_value(self, val):
+        if self.model is not None:
+            self.model.set_init_value(self.row, val)
+            return
         self.tableWidget.item(self.row, 1).setText(str(val))
 
     def get_init_value(self):
+        if self.model is not None:
+            return self.model.init_values[self.row]
         return float(self.tableWidget.item(self.row, 1).text())
 
     def uncheck(self):
+        if self.model is not None:
+            self.model.set_active(self.row, False)
+            return
         item = self.tableWidget.item(self.row, 3)
         item.setCheckState(False)
 
     def check(self):
+        if self.model is not None:
+            self.model.set_active(self.row, True)
+            return
         item = self.tableWidget.item(self.row, 3)
         item.setCheckState(QtCore.Qt.Checked)
 
     def state(self):
+        if self.model is not None:
+            return QtCore.Qt.Checked if self.model.active[self.row] else QtCore.Qt.Unchecked
         item = self.tableWidget.item(self.row, 3)
         state = item.checkState()
         return state
@@ -256,37 +497,60 @@ class BPM(Device):
 class DeviceUI:
     def __init__(self, ui=None):
         self.tableWidget = None
+        self.model = None
         self.row = 0
         self.col = 0
         self.alarm = False
 
     def get_value(self):
+        if self.model is not None:
+            return self.model.values[self.row]
         return self.tableWidget.cellWidget(self.row, self.col).value()
 
     def set_value(self, val):
+        if self.model is not None:
+            self.model.set_value(self.row, val)
+            return
         self.tableWidget.cellWidget(self.row, self.col).setValue(val)
 
     def set_init_value(self, val):
         val = np.round(val, 4) # "{:1.4e}".format(val)
+        if self.model is not None:
+            self.model.set_init_value(self.row, val)
+            return
         self.tableWidget.item(self.row, 1).setText(str(val))
 
     def get_init_value(self):
+        if self.model is not None:
+            return self.model.init_values[self.row]
         return float(self.tableWidget.item(self.row, 1).text())
 
     def uncheck(self):
+        if self.model is not None:
+            self.model.set_active(self.row, False)
+            return
         item = self.tableWidget.item(self.row, 3)
         item.setCheckState(False)
 
     def check(self):
+        if self.model is not None:
+            self.model.set_active(self.row, True)
+            return
         item = self.tableWidget.item(self.row, 3)
         item.setCheckState(QtCore.Qt.Checked)
 
     def state(self):
+        if self.model is not None:
+            return QtCore.Qt.Checked if self.model.active[self.row] else QtCore.Qt.Unchecked
         item = self.tableWidget.item(self.row, 3)
         state = item.checkState()
         return state
 
     def check_values(self, val, lims, warn=False):
+        if self.model is not None:
+            self.alarm = not(lims[0] <= val <= lims[1])
+            self.model.set_alarm(self.row, self.alarm, warn)
+            return
         if warn:
             self.tableWidget.item(self.row, 0).setBackground(QtGui.QColor(255, 255, 0))  # yellow
         else:
@@ -309,6 +573,10 @@ class DeviceUI:
             
             
     def check_diff(self, tol=0.01):
+        if self.model is not None:
+            # difference is highlighted by the table listener on flush
+            self.model.mark(self.row)
+            return
         ival = self.get_init_value()
         val = self.get_value()
         diff = np.abs(val - ival)
@@ -358,6 +626,15 @@ class MIOrbit(Device, Thread):
         self.bpm_server = "ORBIT"     # or "BPM"
         self.time_delay = 0.1         # sec
         self.charge_threshold = 0.005 # nC
+        # beam synchronous acquisition: X, Y and CHARGE are aligned on the macropulse number (train id)
+        self.sync_trains = True
+        self.poll_delay = 0.01        # sec, delay between reads while waiting for a new train
+        self.train_timeout = 1.       # sec, maximum waiting time per train
+        self.align_attempts = 5       # re-reads of lagging channels to get X, Y and CHARGE of the same train
+        self.train_ids = []
+        self.decoder_x = WildcardDecoder()
+        self.decoder_y = WildcardDecoder()
+        self.decoder_charge = WildcardDecoder()
         self.subtrain = subtrain
         self.bpm_names = []
         self.x = []
@@ -403,18 +680,40 @@ class MIOrbit(Device, Thread):
         #    return False
         #print(orbit_x)
         try:
-            names_x = [data[4] for data in orbit_x]
-            names_y = [data[4] for data in orbit_y]
+            names_x, self.x, self.y = self.decode_positions(orbit_x, orbit_y)
         except Exception as e:
-            logger.critical("read_positions: names_x = [data['str'] for data in orbit_x]" + str(e))
+            logger.critical("read_positions: decode_positions: " + str(e))
             raise e
-
-        if not np.array_equal(names_x, names_y):
-            logger.warning(" MIOrbit: read_positions: X and Y orbits are not equal")
-        self.x = np.array([data[1] for data in orbit_x])
-        self.y = np.array([data[1] for data in orbit_y])
         return [names_x, self.x, self.y]
 
+    def decode_positions(self, orbit_x, orbit_y):
+        """
+        Method decodes X and Y wildcard replies. Y is gathered in the order of X with the cached permutation.
+
+        :param orbit_x: wildcard reply of X
+        :param orbit_y: wildcard reply of Y
+        :return: names, x, y
+        """
+        rec_x = self.decoder_x.decode(orbit_x)
+        names = rec_x["name"].tolist()
+        y, missing = self.decoder_y.gather(orbit_y, names)
+        if len(missing) > 0:
+            logger.warning(" MIOrbit: decode_positions: X and Y orbits are not equal")
+        return names, rec_x["value"], y
+
+    def decode_charge(self, charge, names):
+        """
+        Method gathers charge for the BPM names (TORA and TORC toroids of the reply are skipped this way)
+
+        :param charge: wildcard reply of CHARGE
+        :param names: BPM names
+        :return: array of charge, NaN if a BPM is not in the reply
+        """
+        values, missing = self.decoder_charge.gather(charge, names)
+        if len(missing) > 0:
+            logger.warning(" MIOrbit: decode_charge: CHARGE reading and POSITIONS are not equal")
+        return values
+
     def read_charge(self, suffix=""):
         if "HOLD" in self.subtrain and suffix == ".HOLD":
             logger.warning(" MIOrbit: read_charge: remove suffix. HOLD is in subtrain already")
@@ -424,34 +723,183 @@ class MIOrbit(Device, Thread):
         except Exception as e:
             logger.critical("read_charge: self.mi.get_value: " + str(e))
             raise e
-        names = [data[4] for data in charge]
-        values = np.array([data[1] for data in charge])
-        return names, values
+        rec = self.decoder_charge.decode(charge)
+        return rec["name"].tolist(), rec["value"]
 
     def read_orbit(self, reliable_reading, suffix=""):
         names_xy, x, y = self.read_positions(reliable_reading, suffix=suffix)
-        names_charge, charge = self.read_charge(suffix=suffix)
-        indx = [not ("TORA." in name or "TORC." in name) for name in names_charge]
-        names_charge = np.array(names_charge)[indx]
-        charge = np.array(charge)[indx]
-        
-        #print( len(names_charge), len(names_xy))
-        #for n_ch, n_xy in zip(names_charge, names_xy):
-        #    if n_ch != n_xy:
-        #       print(n_ch, n_xy)
+        if "HOLD" in self.subtrain and suffix == ".HOLD":
+            suffix = ""
+        try:
+            charge = self.mi.get_value(self.server + ".DIAG/CHARGE.ML/*/CHARGE." + self.subtrain + suffix)
+        except Exception as e:
+            logger.critical("read_orbit: self.mi.get_value: " + str(e))
+            raise e
+        return names_xy, x, y, self.decode_charge(charge, names_xy)
+
+
+    def orbit_channels(self, suffix=""):
+        """
+        Wildcard channels of X, Y and CHARGE of the subtrain
+        """
+        return [self.server + ".DIAG/" + self.bpm_server + "/*/X." + self.subtrain + suffix,
+                self.server + ".DIAG/" + self.bpm_server + "/*/Y." + self.subtrain + suffix,
+                self.server + ".DIAG/CHARGE.ML/*/CHARGE." + self.subtrain + suffix]
+
+    @staticmethod
+    def get_train_ids(replies):
+        """
+        Train identifiers of raw replies: macropulse numbers or, if a server does not fill them, timestamps
 
-        if not np.array_equal(names_xy, names_charge):
-            logger.warning(" MIOrbit: read_orbit: CHARGE reading and POSITIONS are not equal")
-            #return False
-        return names_xy, x, y, charge
+        :param replies: list of dictionaries from mi.get_raw_value()
+        :return: list of train ids or None if the replies carry neither macropulse nor timestamp
+        """
+        macropulses = [reply.get("macropulse") for reply in replies]
+        if all(macropulse is not None for macropulse in macropulses):
+            return macropulses
+        timestamps = [reply.get("timestamp") for reply in replies]
+        if all(timestamp is not None for timestamp in timestamps):
+            return timestamps
+        return None
+
+    def read_train(self, suffix=""):
+        """
+        Method reads X, Y and CHARGE wildcards in parallel. Channels which lag behind the newest one are read again
+        (up to self.align_attempts times) until all three replies belong to the same train.
+
+        :param suffix: "" or ".HOLD"
+        :return: (train_id, replies) - train_id is None if the replies could not be aligned,
+                 replies is None if the control system does not provide train ids
+        """
+        channels = self.orbit_channels(suffix)
+        replies = [None] * len(channels)
+        todo = list(range(len(channels)))
+        for attempt in range(self.align_attempts):
+            results = self.mi.bulk_call(self.mi.get_raw_value, [(channels[i],) for i in todo])
+            for i, (reply, exc) in zip(todo, results):
+                if exc is not None:
+                    logger.critical("read_train: self.mi.get_raw_value: " + channels[i] + ": " + str(exc))
+                    raise exc
+                replies[i] = reply
+            ids = self.get_train_ids(replies)
+            if ids is None:
+                return None, None
+            newest = max(ids)
+            todo = [i for i, train_id in enumerate(ids) if train_id != newest]
+            if len(todo) == 0:
+                return newest, replies
+            time.sleep(self.poll_delay)
+        logger.debug(" MIOrbit: read_train: X, Y and CHARGE are not aligned: " + str(ids))
+        return None, replies
+
+    def decode_train(self, replies):
+        """
+        Method converts aligned replies of read_train() into arrays, charge is gathered in the order of the BPMs.
 
+        :param replies: raw replies of X, Y and CHARGE
+        :return: names, x, y, charge
+        """
+        orbit_x, orbit_y, charge = [reply["data"] for reply in replies]
+        names, x, y = self.decode_positions(orbit_x, orbit_y)
+        return names, x, y, self.decode_charge(charge, names)
+
+    def acquire_trains(self, ntrains, reliable_reading=False, suffix=""):
+        """
+        Method collects ntrains distinct trains as fast as the machine delivers them. Replies of a train which
+        was already taken (same train id) are dropped, the next read follows after self.poll_delay.
+
+        :param ntrains: number of trains
+        :param reliable_reading: if True, trains with zero position of the first BPM are dropped
+        :param suffix: "" or ".HOLD"
+        :return: (names, x, y, charge, train_ids) with arrays (ntrains, nbpms)
+                 or None if the control system does not provide train ids
+        """
+        orbits_x = []
+        orbits_y = []
+        orbits_charge = []
+        train_ids = []
+        saved_names = None
+        deadline = time.monotonic() + self.train_timeout * ntrains
+        while len(train_ids) < ntrains and time.monotonic() < deadline:
+            train_id, replies = self.read_train(suffix=suffix)
+            if replies is None:
+                return None
+            fresh = train_id is not None and (len(train_ids) == 0 or train_id > train_ids[-1])
+            if fresh:
+                names, x, y, charge = self.decode_train(replies)
+                if reliable_reading and (len(x) == 0 or x[0] == 0 or y[0] == 0):
+                    fresh = False
+            if not fresh:
+                time.sleep(self.poll_delay)
+                continue
+            if saved_names is not None and not np.array_equal(saved_names, names):
+                logger.warning(" MIOrbit: acquire_trains: BPM list changed, train " + str(train_id) + " is dropped")
+                continue
+            saved_names = names
+            orbits_x.append(x)
+            orbits_y.append(y)
+            orbits_charge.append(charge)
+            train_ids.append(train_id)
+        if len(train_ids) == 0:
+            raise TimeoutError("MIOrbit: acquire_trains: no train within " + str(self.train_timeout * ntrains) + " sec")
+        if len(train_ids) < ntrains:
+            logger.warning(" MIOrbit: acquire_trains: only " + str(len(train_ids)) + " of " + str(ntrains) +
+                           " trains within " + str(self.train_timeout * ntrains) + " sec")
+        return saved_names, np.array(orbits_x), np.array(orbits_y), np.array(orbits_charge), train_ids
+
+    def average_snapshots(self, snapshots):
+        """
+        Method averages OrbitSnapshots of the OrbitStreamer. Snapshots with a BPM list different
+        from the newest one are dropped.
+
+        :param snapshots: list of OrbitSnapshots
+        :return: bpm_names, mean_x, mean_y, mean_charge
+        """
+        snapshots = [s for s in snapshots if s.names == snapshots[-1].names]
+        self.bpm_names = list(snapshots[-1].names)
+        self.train_ids = [s.train_id for s in snapshots]
+        self.mean_x = np.mean([s.x for s in snapshots], axis=0)
+        self.mean_y = np.mean([s.y for s in snapshots], axis=0)
+        self.mean_charge = np.mean([s.charge for s in snapshots], axis=0)
+        return self.bpm_names, self.mean_x, self.mean_y, self.mean_charge
 
     def read_and_average(self, nreadings, take_last_n, reliable_reading=False, suffix=""):
+        """
+        Method reads nreadings orbits and averages the last take_last_n.
+        If an OrbitStreamer of the subtrain is running, the next nreadings trains of the stream are taken.
+        With self.sync_trains the orbits are distinct trains with X, Y and CHARGE of the same train (acquire_trains()),
+        otherwise the readings are done with self.time_delay in between. If the replies carry no train ids,
+        only this call falls back to the readings with time delay, the next call tries the train synchronization again.
+
+        :param nreadings: number of readings
+        :param take_last_n: number of last readings for the average
+        :param reliable_reading: see read_positions()
+        :param suffix: "" or ".HOLD"
+        :return: bpm_names, mean_x, mean_y, mean_charge
+        """
         logger.info(" MIorbit: read_and_average")
         if "HOLD" in self.subtrain and suffix == ".HOLD":
             logger.warning(" MIOrbit: read_and_average: remove suffix. HOLD is in subtrain already")
             suffix = ""
-            
+
+        streamer = running_streamer(self.server, self.bpm_server, self.subtrain)
+        if streamer is not None and suffix == "" and not reliable_reading:
+            snapshots = streamer.collect(nreadings, timeout=self.train_timeout)
+            if len(snapshots) > 0:
+                return self.average_snapshots(snapshots[-take_last_n:])
+
+        if self.sync_trains:
+            trains = self.acquire_trains(nreadings, reliable_reading=reliable_reading, suffix=suffix)
+            if trains is not None:
+                self.bpm_names, orbits_x, orbits_y, orbits_charge, self.train_ids = trains
+                self.mean_x = np.mean(orbits_x[-take_last_n:], axis=0)
+                self.mean_y = np.mean(orbits_y[-take_last_n:], axis=0)
+                self.mean_charge = np.mean(orbits_charge[-take_last_n:], axis=0)
+                return self.bpm_names, self.mean_x, self.mean_y, self.mean_charge
+            logger.warning(" MIOrbit: read_and_average: no train ids from the control system, "
+                           "readings with time delay")
+
+        self.train_ids = []
         orbits_x = []
         orbits_y = []
         orbits_charge = []
@@ -472,32 +920,37 @@ class MIOrbit(Device, Thread):
         self.mean_charge = np.mean(orbits_charge[-take_last_n:], axis=0)
         return self.bpm_names, self.mean_x, self.mean_y, self.mean_charge
 
-    def get_bpms(self, bpms):
+    def get_bpms(self, bpms, state=None):
         """
         All bpm works with [m] but doocs gives position in [mm]
 
         :param bpms: list of BPM objects
-        :param charge_threshold:
+        :param state: OrbitState or None. If given, the averaged orbit is gathered into the state arrays in bulk
         :return:
         """
         if len(self.bpm_names) == 0:
             return False
-        #bpm_names = [bpm.id for bpm in bpms]
+        name2indx = {name: i for i, name in enumerate(self.bpm_names)}
         indxs = []
-        valid_bpm_inx = []
-        for i, bpm in enumerate(bpms):
-            if bpm.id not in self.bpm_names:
+        valid_bpms = []
+        for bpm in bpms:
+            inx = name2indx.get(bpm.id)
+            if inx is None:
                 bpm.ui.uncheck()
             else:
-                valid_bpm_inx.append(i)
-                indxs.append(self.bpm_names.index(bpm.id))
-                logger.debug(" MIOrbit: get_bpms: len(bpm)="+ str(len(bpms)) + "  len(indxs) = " + str(len(indxs)))
-        bpms = [bpms[indx] for indx in valid_bpm_inx]
-        for i, bpm in enumerate(bpms):
-            inx = indxs[i]
-            bpm.x = self.mean_x[inx]/1000      # [mm] -> [m]
-            bpm.y = self.mean_y[inx]/1000      # [mm] -> [m]
-            bpm.charge = self.mean_charge[inx] # nC
+                valid_bpms.append(bpm)
+                indxs.append(inx)
+        logger.debug(" MIOrbit: get_bpms: len(bpm)=" + str(len(bpms)) + "  len(indxs) = " + str(len(indxs)))
+        indxs = np.array(indxs, dtype=int)
+        x = np.asarray(self.mean_x)[indxs]/1000          # [mm] -> [m]
+        y = np.asarray(self.mean_y)[indxs]/1000          # [mm] -> [m]
+        charge = np.asarray(self.mean_charge)[indxs]     # nC
+        for bpm, bpm_x, bpm_y, bpm_charge in zip(valid_bpms, x, y, charge):
+            bpm.x = bpm_x
+            bpm.y = bpm_y
+            bpm.charge = bpm_charge
+        if state is not None:
+            state.set_orbit(self.bpm_names, self.mean_x, self.mean_y, self.mean_charge)
         return True
 
     def read_doocs_ref_orbit(self):
@@ -532,6 +985,7 @@ class MIAdviser(Device):
         self.bpm_server = "BPM"  # "ORBIT"     # or "BPM"
         self.subtrain = subtrain
         self.server = server
+        self.decoders = {}
 
     def get_x(self):
         try:
@@ -583,60 +1037,72 @@ class MIAdviser(Device):
         self.get_kicks()
         self.get_momentums()
         self.get_cor_z_pos()
-        names = [x["str"] for x in self.kicks]
-        #print(self.kicks)
-        kicks = np.array([x["float1"] for x in self.kicks])/1000.
-        moments = np.array([x["float1"] for x in self.moments])
-        z_poss = np.array([x["float1"] for x in self.cor_z_pos])
-        indxs = []
-        for name in ref_names:
-            indxs.append(names.index(name))
-        return kicks[indxs], moments[indxs], z_poss[indxs]
+        kicks = self.gather("kicks", self.kicks, ref_names)/1000.
+        moments = self.gather("moments", self.moments, ref_names)
+        z_poss = self.gather("cor_z_pos", self.cor_z_pos, ref_names)
+        return kicks, moments, z_poss
+
+    def gather(self, key, data, ref_names, skip_missing=False):
+        """
+        Method takes values of a wildcard reply for ref_names with a cached WildcardDecoder
+
+        :param key: name of the decoder (one per wildcard channel)
+        :param data: wildcard reply
+        :param ref_names: list of names
+        :param skip_missing: if True, names which are not in the reply are skipped, otherwise ValueError is raised
+        :return: array of values
+        """
+        if key not in self.decoders:
+            self.decoders[key] = WildcardDecoder()
+        values, missing = self.decoders[key].gather(data, ref_names)
+        if len(missing) > 0:
+            if not skip_missing:
+                raise ValueError(str(missing) + " are not in the " + key + " reply")
+            missing = set(missing)
+            values = values[np.array([name not in missing for name in ref_names], dtype=bool)]
+        return values
 
     def get_bpm_z_from_ref(self, ref_names):
         self.get_bpm_z_pos()
-        names = [x["str"] for x in self.bpm_z_pos]
-        z_poss = np.array([x["float1"] for x in self.bpm_z_pos])
-        indxs = []
-        for name in ref_names:
-            indxs.append(names.index(name))
+        return self.gather("bpm_z_pos", self.bpm_z_pos, ref_names)
         
-        return z_poss[indxs]
-        
-    def get_bpm_x(self, ref_names):
+    def streamed_positions(self, ref_names, plane):
+        """
+        Positions from the latest train of a running OrbitStreamer of the same BPM server and subtrain
 
-        self.get_x()
-        if len(self.orbit_x) == 0:
+        :param ref_names: list of BPM names
+        :param plane: "x" or "y"
+        :return: array of positions of the BPMs which are in the stream or None if no stream is running
+        """
+        streamer = running_streamer(self.server, self.bpm_server, self.subtrain)
+        snapshot = streamer.latest() if streamer is not None else None
+        if snapshot is None:
             return None
-        names = [x["str"] for x in self.orbit_x]
-        pos = np.array([x["float1"] for x in self.orbit_x])
+        indx, found = snapshot_indices(snapshot, ref_names)
+        positions = snapshot.x if plane == "x" else snapshot.y
+        return positions[indx[found]]
 
-        indxs = []
-        for name in ref_names:
-            if name in names:
-                indxs.append(names.index(name))
-        
+    def get_bpm_x(self, ref_names):
+
+        pos = self.streamed_positions(ref_names, "x")
+        if pos is None:
+            self.get_x()
+            if len(self.orbit_x) == 0:
+                return None
+            pos = self.gather("orbit_x", self.orbit_x, ref_names, skip_missing=True)
         z_pos = self.get_bpm_z_from_ref(ref_names)
-        return pos[indxs], z_pos
+        return pos, z_pos
 
     def get_bpm_y(self, ref_names):
 
-        self.get_y()
-        #self.get_bpm_z_pos()
-
-        if len(self.orbit_y) == 0:
-            return None
-
-        names = [x["str"] for x in self.orbit_y]
-        pos = np.array([x["float1"] for x in self.orbit_y])
-        #z_poss = np.array([x["float"] for x in self.bpm_z_pos])
-
-        indxs = []
-        for name in ref_names:
-            indxs.append(names.index(name))
-            
+        pos = self.streamed_positions(ref_names, "y")
+        if pos is None:
+            self.get_y()
+            if len(self.orbit_y) == 0:
+                return None
+            pos = self.gather("orbit_y", self.orbit_y, ref_names)
         z_pos = self.get_bpm_z_from_ref(ref_names)
-        return pos[indxs], z_pos
+        return pos, z_pos
 
 
 class MIStandardFeedback(Device):
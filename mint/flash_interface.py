@@ -53,6 +53,8 @@ class FLASHMachineInterface(MachineInterface):
         self.drm_method = LinacDisperseSimRM
         self.lattice_manager = flash_lattice_manager
         self.devices = devices
+        # pydoocs calls are done in parallel by get_values()/set_values()
+        self.max_workers = 16
 
     def get_value(self, channel):
         """
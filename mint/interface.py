@@ -3,11 +3,16 @@ S.Tomin, 2018
 """
 import time
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class MachineInterface(object):
     def __init__(self, args):
         self.debug = False
+        # number of threads for get_values()/set_values(), 1 - channels are read one by one
+        self.max_workers = 1
+        self.executor = None
 
     def get_value(self, channel):
         """
@@ -18,6 +23,142 @@ class MachineInterface(object):
         """
         raise NotImplementedError
 
+    def get_raw_value(self, channel):
+        """
+        Getter with the meta data of the reply. Control systems without train information return
+        macropulse and timestamp None.
+
+        :param channel: (str) String of the devices name used
+        :return: dictionary {"data", "macropulse", "timestamp"}
+        """
+        return {"data": self.get_value(channel), "macropulse": None, "timestamp": None}
+
+    def bulk_call(self, func, args_list):
+        """
+        Method calls func for every tuple of arguments. With self.max_workers > 1 the calls are done
+        in parallel in a thread pool, otherwise one by one.
+
+        :param func: function
+        :param args_list: list of tuples with arguments
+        :return: list of (result, exception) in the order of args_list, exception is None if the call succeeded
+        """
+        def call(args):
+            try:
+                return func(*args), None
+            except Exception as e:
+                return None, e
+
+        if self.max_workers <= 1 or len(args_list) <= 1:
+            return [call(args) for args in args_list]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self.executor.map(call, args_list))
+
+    def get_values(self, channels):
+        """
+        Bulk getter. Duplicated channels are read once.
+
+        :param channels: list of channels
+        :return: (values, errors) - list of values in the order of channels (None if reading failed)
+                 and dictionary {channel: exception} of the failed channels
+        """
+        unique = list(OrderedDict.fromkeys(channels))
+        results = self.bulk_call(self.get_value, [(ch,) for ch in unique])
+        data = {}
+        errors = {}
+        for ch, (val, exc) in zip(unique, results):
+            if exc is None:
+                data[ch] = val
+            else:
+                errors[ch] = exc
+        return [data.get(ch) for ch in channels], errors
+
+    def set_values(self, mapping):
+        """
+        Bulk setter.
+
+        :param mapping: dictionary {channel: value}
+        :return: dictionary {channel: exception} of the failed writes, empty if all values were written
+        """
+        items = list(mapping.items())
+        results = self.bulk_call(self.set_value, items)
+        return {ch: exc for (ch, val), (res, exc) in zip(items, results) if exc is not None}
+
+    def get_devices_values(self, devs):
+        """
+        Bulk version of dev.get_value() for a list of devices
+
+        :param devs: list of Devices
+        :return: (values, errors) - list of values in the order of devs (None if reading failed)
+                 and dictionary {dev.id: exception} of the failed devices
+        """
+        channels = [dev.get_value_channel() for dev in devs]
+        values, ch_errors = self.get_values(channels)
+        errors = {dev.id: ch_errors[ch] for dev, ch in zip(devs, channels) if ch in ch_errors}
+        return values, errors
+
+    def set_devices_values(self, devs, values):
+        """
+        Bulk version of dev.set_value(val) for a list of devices
+
+        :param devs: list of Devices
+        :param values: list of values
+        :return: dictionary {dev.id: exception} of the failed writes
+        """
+        channels = [dev.set_value_channel() for dev in devs]
+        ch_errors = self.set_values(OrderedDict(zip(channels, values)))
+        for dev, ch, val in zip(devs, channels, values):
+            if ch not in ch_errors:
+                dev.target = val
+        return {dev.id: ch_errors[ch] for dev, ch in zip(devs, channels) if ch in ch_errors}
+
+    def set_devices_transaction(self, devs, values, snapshot=None, verify=False):
+        """
+        Transactional bulk setter. All values are written in parallel (see set_devices_values()), then optionally
+        read back in parallel with the Device.wait_target() tolerance check on Device.get_readback_channel(). If any write or readback check fails,
+        the devices which were already written are set back to the snapshot values.
+
+        :param devs: list of Devices
+        :param values: list of values
+        :param snapshot: list of values to roll back to (e.g. undo snapshot), None - no roll back
+        :param verify: if True, check that the readback of every device reaches the target within dev.timeout
+        :return: (ok, report) - ok is True if all values were written (and verified),
+                 report is dictionary {dev.id: {"value", "written", "verified", "rolled_back", "error"}}
+        """
+        report = OrderedDict()
+        for dev, val in zip(devs, values):
+            report[dev.id] = {"value": val, "written": False, "verified": None, "rolled_back": False, "error": None}
+
+        errors = self.set_devices_values(devs, values)
+        written = []
+        for dev in devs:
+            if dev.id in errors:
+                report[dev.id]["error"] = str(errors[dev.id])
+            else:
+                report[dev.id]["written"] = True
+                written.append(dev)
+        ok = len(errors) == 0
+
+        if verify and len(written) > 0:
+            results = self.bulk_call(lambda dev: dev.wait_target(), [(dev,) for dev in written])
+            for dev, (reached, exc) in zip(written, results):
+                report[dev.id]["verified"] = exc is None and bool(reached)
+                if exc is not None:
+                    report[dev.id]["error"] = "readback: " + str(exc)
+                elif not reached:
+                    report[dev.id]["error"] = "readback: target is not reached within " + str(dev.timeout) + " sec"
+                ok = ok and report[dev.id]["verified"]
+
+        if not ok and snapshot is not None and len(written) > 0:
+            old_values = dict(zip([dev.id for dev in devs], snapshot))
+            rb_errors = self.set_devices_values(written, [old_values[dev.id] for dev in written])
+            for dev in written:
+                if dev.id in rb_errors:
+                    report[dev.id]["error"] = "roll back: " + str(rb_errors[dev.id])
+                else:
+                    report[dev.id]["rolled_back"] = True
+        return ok, report
+
     @staticmethod
     def add_args(subparser):
         """
@@ -96,6 +237,31 @@ class Device(object):
         self.target = val
         self.mi.set_value(self.eid, val)
 
+    def get_value_channel(self):
+        """
+        Channel which is read by get_value(), used by MachineInterface.get_devices_values()
+        """
+        return self.eid
+
+    def set_value_channel(self):
+        """
+        Channel which is written by set_value(), used by MachineInterface.set_devices_values()
+        """
+        return self.eid
+
+    def get_readback_channel(self):
+        """
+        Channel of the actual (measured) value, used by wait_target(). Devices with a separate readback
+        must override it. None - there is no readback, wait_target() only checks get_value().
+        """
+        return None
+
+    def get_readback(self):
+        ch = self.get_readback_channel()
+        if ch is None:
+            return self.get_value()
+        return self.mi.get_value(ch)
+
     def set_low_limit(self, val):
         self.low_limit = val
 
@@ -110,14 +276,24 @@ class Device(object):
         pass
 
     def wait(self):
+        self.wait_target()
+
+    def wait_target(self):
+        """
+        Method waits until the readback of the device (see get_readback_channel()) reaches the target
+        (|readback - target| < tol) or timeout
+
+        :return: True if the target is reached (or there is no target) otherwise False
+        """
         if self.target is None:
-            return
+            return True
 
         start_time = time.time()
         while  time.time() <= start_time + self.timeout:
-            if np.abs(self.get_value() - self.target) < self.tol:
-                return
+            if np.abs(self.get_readback() - self.target) < self.tol:
+                return True
             time.sleep(0.05)
+        return False
 
     def state(self):
         """
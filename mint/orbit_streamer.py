@@ -0,0 +1,216 @@
+"""
+Continuous orbit acquisition shared by all windows.
+
+One OrbitStreamer per (server, bpm_server, subtrain) reads X, Y and CHARGE at the beam rate and publishes the
+latest train as an immutable OrbitSnapshot. Consumers take the latest snapshot (no lock) or block for the next one,
+so the load on the control system scales with the number of streams and not with the number of open windows.
+"""
+import time
+from collections import namedtuple
+from threading import Thread, Event, Condition, Lock
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+OrbitSnapshot = namedtuple("OrbitSnapshot", ["train_id", "time", "names", "index", "x", "y", "charge"])
+OrbitSnapshot.__doc__ = """
+Orbit of one train. Arrays are read-only and in the order of names.
+
+:param train_id: macropulse number (or counter if the control system does not provide train ids)
+:param time: time.time() of the acquisition
+:param names: list of BPM names
+:param index: dictionary name -> position in the arrays (shared by snapshots with the same names)
+:param x: horizontal positions [mm]
+:param y: vertical positions [mm]
+:param charge: charge [nC]
+"""
+
+
+def snapshot_indices(snapshot, names):
+    """
+    Positions of names in the snapshot arrays
+
+    :param snapshot: OrbitSnapshot
+    :param names: list of BPM names
+    :return: (indx, found) - integer array (0 for missing names) and boolean array
+    """
+    indx = np.array([snapshot.index.get(name, -1) for name in names], dtype=int)
+    found = indx >= 0
+    indx[~found] = 0
+    return indx, found
+
+
+class OrbitStreamer(Thread):
+    """
+    Background acquisition of the orbit of a subtrain. Every new train is published by swapping the reference
+    to a new immutable snapshot: readers never lock and a snapshot which is held by a reader is never overwritten.
+
+    Use acquire_streamer()/release_streamer() instead of creating streamers directly.
+
+    :param mi_orbit: MIOrbit device, the streamer reads with its own copy
+    :param period: repetition period of the trains [sec]
+    """
+    def __init__(self, mi_orbit, period=0.1):
+        super(OrbitStreamer, self).__init__(name="OrbitStreamer " + mi_orbit.subtrain)
+        self.daemon = True
+        self.key = streamer_key(mi_orbit.server, mi_orbit.bpm_server, mi_orbit.subtrain)
+        self.mi_orbit = mi_orbit.__class__(server=mi_orbit.server, subtrain=mi_orbit.subtrain)
+        self.mi_orbit.bpm_server = mi_orbit.bpm_server
+        self.mi_orbit.mi = mi_orbit.mi
+        self.period = period
+        self.users = 0
+        self.ntrains = 0
+        self.errors = 0
+        self._snapshot = None
+        self._index = {}
+        self._index_names = []
+        self._new_train = Condition()
+        self._stop_event = Event()
+
+    def run(self):
+        logger.info(" OrbitStreamer: " + str(self.key) + " started")
+        counter = 0
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                replies = None
+                if getattr(self.mi_orbit, "sync_trains", False):
+                    train_id, replies = self.mi_orbit.read_train()
+                    self.mi_orbit.sync_trains = replies is not None
+                if replies is None:
+                    # control system without train ids: every reading is a new train
+                    names, x, y, charge = self.mi_orbit.read_orbit(reliable_reading=False)
+                    counter += 1
+                    train_id = counter
+                elif train_id is None or (self._snapshot is not None and train_id <= self._snapshot.train_id):
+                    self._stop_event.wait(self.mi_orbit.poll_delay)
+                    continue
+                else:
+                    names, x, y, charge = self.mi_orbit.decode_train(replies)
+                self.publish(train_id, names, x, y, charge)
+            except Exception as e:
+                self.errors += 1
+                logger.error(" OrbitStreamer: " + str(self.key) + " read error: " + str(e))
+            self._stop_event.wait(max(0., self.period - (time.monotonic() - start)))
+        logger.info(" OrbitStreamer: " + str(self.key) + " stopped. trains = " + str(self.ntrains))
+
+    def publish(self, train_id, names, x, y, charge):
+        if names != self._index_names:
+            self._index = {name: i for i, name in enumerate(names)}
+            self._index_names = list(names)
+        arrays = []
+        for values in (x, y, charge):
+            values = np.array(values, dtype=float)
+            values.flags.writeable = False
+            arrays.append(values)
+        snapshot = OrbitSnapshot(train_id, time.time(), self._index_names, self._index, *arrays)
+        with self._new_train:
+            self._snapshot = snapshot
+            self.ntrains += 1
+            self._new_train.notify_all()
+
+    def latest(self):
+        """
+        :return: the latest OrbitSnapshot or None if no train was read yet
+        """
+        return self._snapshot
+
+    def wait_next(self, after=None, timeout=1.):
+        """
+        Method blocks until a train newer than "after" is published
+
+        :param after: OrbitSnapshot or train id, None - the latest snapshot at the moment of the call
+        :param timeout: [sec]
+        :return: OrbitSnapshot or None if there was no new train within timeout
+        """
+        if after is None:
+            after = self._snapshot
+        if isinstance(after, OrbitSnapshot):
+            after = after.train_id
+        deadline = time.monotonic() + timeout
+        with self._new_train:
+            while self._snapshot is None or (after is not None and self._snapshot.train_id <= after):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.is_alive():
+                    return None
+                self._new_train.wait(remaining)
+            return self._snapshot
+
+    def collect(self, ntrains, timeout=None):
+        """
+        Method collects ntrains consecutive new trains from the stream
+
+        :param ntrains: number of trains
+        :param timeout: timeout per train [sec], None - 10 periods
+        :return: list of OrbitSnapshots (shorter than ntrains if the stream stalled)
+        """
+        if timeout is None:
+            timeout = 10 * self.period
+        snapshots = []
+        last = None
+        for i in range(ntrains):
+            snapshot = self.wait_next(after=last, timeout=timeout)
+            if snapshot is None:
+                logger.warning(" OrbitStreamer: collect: only " + str(len(snapshots)) + " of " + str(ntrains) + " trains")
+                break
+            snapshots.append(snapshot)
+            last = snapshot
+        return snapshots
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def streamer_key(server, bpm_server, subtrain):
+    return (server, bpm_server, subtrain)
+
+
+_streamers = {}
+_streamers_lock = Lock()
+
+
+def acquire_streamer(mi_orbit, period=0.1):
+    """
+    Function returns the running streamer of the subtrain of mi_orbit or starts a new one.
+    Every acquire_streamer() must be paired with release_streamer().
+
+    :param mi_orbit: MIOrbit device
+    :param period: repetition period [sec], used only if a new streamer is started
+    :return: OrbitStreamer
+    """
+    key = streamer_key(mi_orbit.server, mi_orbit.bpm_server, mi_orbit.subtrain)
+    with _streamers_lock:
+        streamer = _streamers.get(key)
+        if streamer is None or not streamer.is_alive():
+            streamer = OrbitStreamer(mi_orbit, period=period)
+            _streamers[key] = streamer
+            streamer.start()
+        streamer.users += 1
+        return streamer
+
+
+def release_streamer(streamer):
+    """
+    Function releases a streamer from acquire_streamer(), the streamer is stopped when it has no users anymore
+
+    :param streamer: OrbitStreamer
+    :return:
+    """
+    with _streamers_lock:
+        streamer.users -= 1
+        if streamer.users <= 0:
+            streamer.stop()
+            if _streamers.get(streamer.key) is streamer:
+                del _streamers[streamer.key]
+
+
+def running_streamer(server, bpm_server, subtrain):
+    """
+    :return: running OrbitStreamer of the subtrain or None
+    """
+    streamer = _streamers.get(streamer_key(server, bpm_server, subtrain))
+    if streamer is not None and streamer.is_alive():
+        return streamer
+    return None
@@ -0,0 +1,88 @@
+"""
+Decoding of DOOCS wildcard replies (e.g. XFEL.DIAG/ORBIT/*/X.SA1) into NumPy structured arrays.
+"""
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# one row per device of the wildcard reply
+WILDCARD_DTYPE = np.dtype([("valid", np.int64), ("value", np.float64), ("z_pos", np.float64), ("name", object)])
+
+
+def decode_wildcard(data):
+    """
+    Function converts a wildcard reply into a structured array with fields valid, value, z_pos and name.
+    The reply is a list of [int, float, float, time, name] (old pydoocs versions give dictionaries).
+
+    :param data: reply of mi.get_value() for a wildcard channel
+    :return: structured array with WILDCARD_DTYPE
+    """
+    rec = np.zeros(len(data), dtype=WILDCARD_DTYPE)
+    if len(data) == 0:
+        return rec
+    if isinstance(data[0], dict):
+        rec["valid"] = [x["int"] for x in data]
+        rec["value"] = [x["float1"] for x in data]
+        rec["z_pos"] = [x["float2"] for x in data]
+        rec["name"] = [x["str"] for x in data]
+        return rec
+    table = np.empty((len(data), len(data[0])), dtype=object)
+    table[:] = data
+    rec["valid"] = table[:, 0]
+    rec["value"] = table[:, 1]
+    rec["z_pos"] = table[:, 2]
+    rec["name"] = table[:, -1]
+    return rec
+
+
+class WildcardDecoder:
+    """
+    Decoder of one wildcard channel. The permutation "requested names -> rows of the reply" is cached and reused
+    while the names of the reply and the requested names are unchanged (the common case), then gathering values
+    is a single vectorized indexing.
+    """
+    def __init__(self):
+        self._reply_names = None
+        self._names = None
+        self._perm = None
+        self._found = None
+
+    def decode(self, data):
+        return decode_wildcard(data)
+
+    def permutation(self, reply_names, names):
+        """
+        :param reply_names: object array of names in the reply (rec["name"])
+        :param names: list of requested names
+        :return: (perm, found) - integer array with rows of the reply and boolean array, False if a name
+                 is not in the reply (perm is 0 there)
+        """
+        if self._perm is None or not np.array_equal(reply_names, self._reply_names) or \
+                not np.array_equal(names, self._names):
+            index = {name: i for i, name in enumerate(reply_names)}
+            perm = np.array([index.get(name, -1) for name in names], dtype=int)
+            self._found = perm >= 0
+            perm[~self._found] = 0
+            self._perm = perm
+            self._reply_names = reply_names.copy()
+            self._names = list(names)
+        return self._perm, self._found
+
+    def gather(self, data, names, field="value"):
+        """
+        Method decodes the reply and takes the field for the requested names
+
+        :param data: reply of mi.get_value() for a wildcard channel
+        :param names: list of requested names
+        :param field: "value", "z_pos" or "valid"
+        :return: (values, missing) - float array (NaN if the name is not in the reply) and list of missing names
+        """
+        rec = self.decode(data)
+        if len(rec) == 0:
+            return np.full(len(names), np.nan), list(names)
+        perm, found = self.permutation(rec["name"], names)
+        values = rec[field][perm].astype(float)
+        values[~found] = np.nan
+        missing = [name for name, ok in zip(names, found) if not ok] if not found.all() else []
+        return values, missing
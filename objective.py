@@ -0,0 +1,151 @@
+"""
+Objective function of the adaptive feedback: an expression of the channels A, B and C, e.g. "np.mean(A)/B".
+The expression is parsed once, checked against a whitelist of syntax, names and functions and compiled;
+evaluation of a sample is then a call of the compiled code without access to builtins.
+Powers are limited to constant exponents (abs <= MAX_EXPONENT) without nested powers in the base,
+so an expression like 9**9**9 is rejected instead of blocking the worker.
+"""
+import ast
+import types
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_NAMES = ("A", "B", "C")
+
+# functions which can be called as np.<name> (or <name>)
+NUMPY_FUNCTIONS = ("abs", "sqrt", "exp", "log", "log10", "sin", "cos", "tan", "arctan2", "sign",
+                   "mean", "median", "std", "var", "sum", "min", "max", "ptp", "average",
+                   "nanmean", "nanmedian", "nanstd", "nansum", "nanmin", "nanmax", "percentile",
+                   "argmax", "argmin", "diff", "cumsum", "clip", "where", "square", "hypot")
+CONSTANTS = {"pi": np.pi, "e": np.e}
+BUILTIN_FUNCTIONS = {"abs": abs, "min": min, "max": max, "sum": sum, "len": len, "float": float, "round": round}
+MAX_EXPONENT = 10
+
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+                  ast.Name, ast.Load, ast.Attribute, ast.Subscript, ast.Slice, ast.Tuple, ast.List, ast.keyword,
+                  ast.Constant,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+                  ast.Not, ast.And, ast.Or,
+                  ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+# python < 3.9 wraps subscripts
+_ALLOWED_NODES += tuple(getattr(ast, name) for name in ("Index", "ExtSlice", "Num") if hasattr(ast, name))
+
+
+def _namespace():
+    safe_np = types.SimpleNamespace(**{name: getattr(np, name) for name in NUMPY_FUNCTIONS})
+    safe_np.pi = np.pi
+    safe_np.e = np.e
+    names = {"__builtins__": {}, "np": safe_np, "numpy": safe_np}
+    names.update(BUILTIN_FUNCTIONS)
+    names.update(CONSTANTS)
+    for name in NUMPY_FUNCTIONS:
+        names.setdefault(name, getattr(np, name))
+    return names
+
+
+def channel_value(value, reduce_trace=True):
+    """
+    Channel value for the expression: lists and arrays are converted to float arrays, DOOCS traces (.TD, spectra)
+    with (n, 2) rows [x, value] are reduced to the value column if reduce_trace
+
+    :param value: reply of mi.get_value()
+    :param reduce_trace: if False, (n, 2) arrays are kept, e.g. for A[:, 0]
+    :return: float or numpy array
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        value = np.asarray(value, dtype=float)
+        if reduce_trace and value.ndim == 2 and value.shape[1] == 2:
+            value = value[:, 1]
+    return value
+
+
+def is_power(node):
+    return isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow)
+
+
+class ObjectiveExpression:
+    """
+    Compiled objective function expression of the channels A, B and C
+
+    A channel which is indexed in the expression (e.g. A[:, 1]) gets the raw array of a DOOCS trace,
+    otherwise traces are reduced to the value column (see channel_value()).
+
+    :param text: expression, e.g. "np.mean(A[10:20, 1]) - B". Empty expression evaluates to 0.
+    :raise ValueError: if the expression has a syntax error or uses not allowed names/constructs
+    """
+    def __init__(self, text):
+        self.text = text.strip()
+        self.names = _namespace()
+        self.used_channels = set()
+        self.indexed_channels = set()
+        if self.text == "":
+            self.code = None
+            return
+        try:
+            tree = ast.parse(self.text, mode="eval")
+        except SyntaxError as e:
+            raise ValueError("objective function: syntax error: " + str(e))
+        self.check(tree)
+        self.code = compile(tree, "<objective function>", "eval")
+
+    def check(self, tree):
+        for node in ast.walk(tree):
+            if not isinstance(node, _ALLOWED_NODES):
+                raise ValueError("objective function: " + node.__class__.__name__ + " is not allowed")
+            if isinstance(node, ast.Name):
+                if node.id in CHANNEL_NAMES:
+                    self.used_channels.add(node.id)
+                elif node.id not in self.names or node.id.startswith("_"):
+                    raise ValueError("objective function: unknown name " + node.id)
+            elif isinstance(node, ast.Attribute):
+                if not (isinstance(node.value, ast.Name) and node.value.id in ("np", "numpy")) or \
+                        not hasattr(self.names["np"], node.attr):
+                    raise ValueError("objective function: attribute " + node.attr + " is not allowed")
+            elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError("objective function: constant " + repr(node.value) + " is not allowed")
+            elif isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and \
+                    node.value.id in CHANNEL_NAMES:
+                self.indexed_channels.add(node.value.id)
+            elif is_power(node):
+                self.check_power(node)
+
+    def check_power(self, node):
+        exponent = node.right
+        if isinstance(exponent, ast.UnaryOp) and isinstance(exponent.op, (ast.USub, ast.UAdd)):
+            exponent = exponent.operand
+        value = getattr(exponent, "value", getattr(exponent, "n", None))
+        if not isinstance(exponent, (ast.Constant, getattr(ast, "Num", ast.Constant))) or \
+                isinstance(value, bool) or not isinstance(value, (int, float)) or abs(value) > MAX_EXPONENT:
+            raise ValueError("objective function: exponent must be a number with abs value <= " + str(MAX_EXPONENT))
+        if any(is_power(child) for child in ast.walk(node.left)):
+            raise ValueError("objective function: nested powers are not allowed")
+
+    def channel_value(self, name, value):
+        """
+        :param name: "A", "B" or "C"
+        :param value: reply of mi.get_value()
+        :return: value for evaluate(), see channel_value()
+        """
+        return channel_value(value, reduce_trace=name not in self.indexed_channels)
+
+    def evaluate(self, A=0., B=0., C=0.):
+        """
+        :param A: value of channel A (see channel_value())
+        :param B: value of channel B
+        :param C: value of channel C
+        :return: float, array results are averaged
+        """
+        if self.code is None:
+            return 0
+        names = self.names
+        names["A"] = A
+        names["B"] = B
+        names["C"] = C
+        result = eval(self.code, names)
+        if isinstance(result, np.ndarray):
+            result = float(np.mean(result)) if result.size != 1 else float(result.reshape(-1)[0])
+        elif isinstance(result, np.generic):
+            result = result.item()
+        return result
@@ -1 +1 @@
-"""Sergey Tomin. XFEL/DESY, 2017."""import loggingfrom threading import Thread, Eventimport pyqtgraph as pgfrom PyQt5 import QtGui, QtCoreimport numpy as npfrom ocelot import *from ocelot.cpbd.track import *import timefrom ocelot.cpbd.orbit_correction import Orbit, OrbitSVD, MICADOfrom ocelot.cpbd.response_matrix import *from golden_orbit import GoldenOrbitfrom adaptive_feedback import UIAFeedBackfrom ocelot.cpbd import matchimport matplotlib.pyplot as pltimport seaborn as snslogger = logging.getLogger(__name__)try:    from bpm_api import bpm_apiexcept Exception as e:    logger.warning("Import bpm_api: " + str(e))    class ResponseMatrixCalculator(Thread):    """    Wrap for ResponseMatrix class. Allow to calculate response matrices (ORM and DRM) in different thread    """    def __init__(self, rm, drm):        super(ResponseMatrixCalculator, self).__init__()        self.rm = rm        self.drm = drm        self.do_DRM_calc = True        self.tw_init = None        self.rm_filename = None        self.drm_filename = None                    def run(self):        self.rm.calculate(tw_init=self.tw_init)        cor_names = self.rm.cor_names        bpm_names = self.rm.bpm_names        inj_matrix = self.rm.matrix        try:            self.rm.load(self.rm_filename)        except:            logger.warning("ResponseMatrixCalculator: Could not load RM.")            if self.rm_filename != None:                logger.warning("ResponseMatrixCalculator: Dumping RM >" + str(self.rm_filename))                self.rm.dump(filename=self.rm_filename)            return False                if len(cor_names) > len(self.rm.cor_names) or len(bpm_names) > len(self.rm.bpm_names):            logger.info("ResponseMatrixCalculator: dump calculated ORM")            self.rm.cor_names = cor_names            self.rm.bpm_names = bpm_names            self.rm.matrix = inj_matrix            self.rm.dump(filename=self.rm_filename)        else:            logger.info("ResponseMatrixCalculator: inject calculated ORM")            self.rm.inject(cor_names, bpm_names, inj_matrix)            logger.warning("ResponseMatrixCalculator: Dumping RM >" + str(self.rm_filename))            self.rm.dump(filename=self.rm_filename)            #print(np.shape(self.rm.matrix))        #if self.rm_filename != None:        #    self.rm.dump(filename=self.rm_filename)        if self.do_DRM_calc:            if self.drm != None:                logger.info("ResponseMatrixCalculator: DRM calculation ... ")                self.drm.calculate(tw_init=self.tw_init)            if self.drm_filename != None:                self.rm.dump(filename=self.drm_filename)                logger.info("ResponseMatrixCalculator: DRM dumping > " + self.drm_filename)class OrbitKeeper(Thread):    def __init__(self, orbit_class):        super(OrbitKeeper, self).__init__()        self.orbit_class = orbit_class        self._stop_event = Event()        self.do = None        self.delay = 1        self.stop_event = False        def one_correction(self, reset):        beam_on = self.orbit_class.read_orbit()        time.sleep(0.01)        if beam_on:            self.orbit_class.correct(reset=reset)            time.sleep(0.01)            self.orbit_class.apply_kicks()            time.sleep(0.5)        else:            logger.debug("AutoCorrection->one_correction: no beam")            time.sleep(1)        def run(self):        reset = True        while not self.stop_event:            self.one_correction(reset)            logger.debug("AutoCorrection->run: correct")            time.sleep(self.delay)            reset = False                def stop(self):        self._stop_event.set()class OrbitInterface:    """    Main class for orbit correction    """    def __init__(self, parent):        self.parent = parent        self.bpms4remove = self.parent.uncheck_bpms #["BPMS.99.I1", "BPMS.192.B1"]        self.corrs4remove = self.parent.uncheck_corrs #["CBB.98.I1", "CBB.100.I1", "CBB.101.I1","CBB.191.B1", "CBB.193.B1", "CBB.202.B1",           # 'CBL.73.I1', 'CBL.78.I1', 'CBL.83.I1', 'CBL.88.I1', 'CBL.90.I1', 'CBB.403.B2', 'CBB.405.B2', 'CBB.414.B2']        #print("corrs unchecked:", self.corrs4remove)        self.svd_epsilon_x = self.parent.svd_epsilon_x        self.svd_epsilon_y = self.parent.svd_epsilon_y        self.ui = parent.ui        self.online_calc = True        self.reset_undo_database()        self.corrs = []        self.hcors = []        self.vcors = []        self.s_bpm = []        self.x_bpm = []        self.y_bpm = []        #self.mi_orbit = MIOrbit(server=self.parent.server, subtrain=self.parent.subtrain)        #self.mi_orbit.mi = self.parent.mi        #        #self.xfel_mps = MPS(server=self.parent.server, subtrain=self.parent.subtrain)        #self.xfel_mps.mi = self.parent.mi        self.update_machine_interface()        self.calc_correction = {}        self.p_init = None        self.orbit = None        self.add_orbit_plot()        self.ui.pb_check.clicked.connect(lambda: self.getRows(2, self.ui.table_cor))        self.ui.pb_uncheck.clicked.connect(lambda: self.getRows(0, self.ui.table_cor))        self.ui.pb_bpm_uncheck.clicked.connect(lambda: self.getRows(0, self.ui.table_bpm))        self.ui.pb_bpm_check.clicked.connect(lambda: self.getRows(2, self.ui.table_bpm))        self.ui.actionRead_BPMs_Corrs.triggered.connect(self.read_orbit)        self.ui.pb_apply_kicks.clicked.connect(self.apply_kicks)        #self.ui.pb_calc_RM.clicked.connect(self.calc_response_matrix)        self.ui.actionCalculate_RM.triggered.connect(lambda: self.calc_response_matrix(do_DRM_calc=True))        self.ui.actionCalculate_ORM.triggered.connect(lambda: self.calc_response_matrix(do_DRM_calc=False))        self.ui.actionShow_ORM.triggered.connect(self.show_orm)        self.ui.actionAnalyse_Corrections.triggered.connect(self.analyse_corrections)        #self.ui.pb_correct_orbit.clicked.connect(self.correct)        self.ui.pb_correct_orbit.clicked.connect(self.read_and_correct)        self.ui.pb_read_orbit.clicked.connect(self.read_bpms)        self.ui.pb_calculate.clicked.connect(self.calculate_correction)        self.ui.pb_reset_all.clicked.connect(self.undo)        self.ui.cb_x_cors.stateChanged.connect(self.choose_plane)        self.ui.cb_y_cors.stateChanged.connect(self.choose_plane)        self.ui.actionUpdate_Lattice_from_DOOCS.triggered.connect(self.parent.read_quads)        self.ui.cb_cbxy.stateChanged.connect(self.uncheck_aircols)        self.ui.cb_caxy.stateChanged.connect(self.uncheck_aircols)        #self.ui.pb_uncheck_red.clicked.connect(self.uncheck_red)        self.ui.actionUncheck_Red.triggered.connect(self.uncheck_red)        self.ui.pb_online_orbit.clicked.connect(self.start_stop_live_orbit)        self.ui.pb_calc_orb.clicked.connect(self.start_stop_calc_orbit)        self.ui.pb_ref_orb.clicked.connect(self.start_stop_ref_orbit)        #self.cavity = CavityA1(eid="CTRL.A1.I1")        #self.cavity.mi = self.parent.mi        self.ui.pb_feedback.clicked.connect(self.start_stop_feedback)        self.rm_calc = pg.QtCore.QTimer()        self.rm_calc.timeout.connect(self.is_rm_calc_alive)        self.golden_orbit = GoldenOrbit(parent=self)        self.ui.sb_apply_fraction.valueChanged.connect(self.set_values2correctors)        #self.ui.cb_correction_result.stateChanged.connect(self.update_plot)        self.orbit_keeper = OrbitKeeper(orbit_class=self)        self.ui.actionAdaptive_Feedback.triggered.connect(self.run_awindow)        self.adaptive_feedback = None        #self.adaptive_feedback = None        self.dev_mode = self.parent.dev_mode                self.ui.actionSave_corrs.triggered.connect(self.save_correctors)        self.ui.actionLoad_corrs.triggered.connect(self.restore_correctors)        self.button_bpm = None        self.cavity_bpm = None        try:            self.button_bpm = bpm_api.ButtonBPM()            self.cavity_bpm = bpm_api.CavityBPM()        except Exception as e:            logger.warning("Initialization of bpm_api.ButtonBPM and bpm_api.CavityBPM: " + str(e))        self.ui.cb_freeze_bpms.stateChanged.connect(self.freeze_bpms)    def freeze_bpms(self):        # switched off freeze and unfreeze functionality.        if 1:            return                if self.ui.cb_freeze_bpms.isChecked():            logger.info("Freeze BPMs")            self.xfel_mps.beam_off()            self.xfel_mps.num_bunches_requested(num_bunches=1)            charge = self.ui.sb_bpm_charge.value() # in pC            amplitude = self.ui.sp_orbit_ampl.value()  # in mm            attenuation = self.ui.sb_attenuation.value() # attenuation            self.button_bpm.activate(max_charge_value=charge, max_pos_value=amplitude)            self.cavity_bpm.activate(attenuation=attenuation)        else:            logger.info("Unfreeze BPMs")            self.button_bpm.deactivate()            self.cavity_bpm.deactivate()    def show_orm(self):        if self.orbit is not None:            cor_list = [cor.id for cor in np.append(self.orbit.hcors, self.orbit.vcors)]            bpm_list = [bpm.id for bpm in self.orbit.bpms]            if self.orbit.response_matrix is None:                print("ORM is None in self.orbit")                return            df_slice = self.orbit.response_matrix.extract_df_slice(cor_list, bpm_list)            if df_slice is None:                print("df_slice is None. return")                return            shape = np.array(df_slice.shape)            print("ORM shape: " + str(shape))            if any(shape > 100):                self.parent.error_box("ORM is too large. Shape: " + str(shape))                return            ax = sns.heatmap(df_slice, annot=True)            ax.set_title("Orbit response matrix")            plt.show()    def analyse_corrections(self):        if self.parent.cor_analysis is not None:            if self.parent.cor_analysis.df is not None:                self.parent.cor_analysis.calculate_orm()    def update_machine_interface(self):        self.mi_orbit = self.parent.mi.devices.MIOrbit(server=self.parent.server, subtrain=self.parent.subtrain)        self.mi_orbit.mi = self.parent.mi        self.mi_orbit.bpm_server = self.parent.bpm_server        #self.mi_orbit.start()        self.xfel_mps = self.parent.mi.devices.MPS(server=self.parent.server, subtrain=self.parent.subtrain)        self.xfel_mps.mi = self.parent.mi                self.mi_charge_doocs = self.parent.mi.devices.ChargeDoocs(server=self.parent.server, subtrain=self.parent.subtrain)        self.mi_charge_doocs.mi = self.parent.mi    def reset_undo_database(self):        self.undo_data_base = []    def run_awindow(self):        if self.adaptive_feedback is None:            self.adaptive_feedback = UIAFeedBack(orbit=self)        self.adaptive_feedback.show()    def uncheck_red(self):        """        Method to uncheck correctors if they are out of limits (red color in the GUI)        :return:        """        corrs = self.get_dev_from_cb_state(self.corrs)        for cor in corrs:            if cor.ui.alarm:                cor.ui.uncheck()        bpms = self.get_dev_from_cb_state(self.bpms)        for bpm in bpms:            if bpm.ui.alarm:                bpm.ui.uncheck()    def uncheck_aircols(self):        """        Method checks and unchecks corresponding aircoils downstream or upstream        :return:        """        upstream = self.ui.cb_caxy.isChecked()        downstream = self.ui.cb_cbxy.isChecked()        #corrs = self.get_dev_from_cb_state(self.corrs)        logger.debug("uncheck_aircoils: upstream / downstream: " + str(upstream) + "/" + str(downstream))        for cor in self.corrs:            #print(cor.id, upstream, downstream)            if ".SA1" in cor.id or (".SA3" in cor.id) or (".SA2" in cor.id):                if not upstream:                    if ("CAX." in cor.id) or ("CAY." in cor.id):                        cor.ui.uncheck()                if not downstream:                    if ("CBX." in cor.id) or ("CBY." in cor.id):                        cor.ui.uncheck()                if upstream:                    if ("CAX." in cor.id) or ("CAY." in cor.id):                        cor.ui.check()                if downstream:                    if ("CBX." in cor.id) or ("CBY." in cor.id):                        cor.ui.check()    def choose_plane(self):        """        Method checks and unchecks corresponding correctors in horizontal or/and vertical planes        :return:        """        x_plane = self.ui.cb_x_cors.isChecked()        y_plane = self.ui.cb_y_cors.isChecked()        if y_plane and not x_plane:            for cor in self.corrs:                if cor.__class__ == Hcor:                    cor.ui.uncheck()                    cor.ui.set_hide(True)                else:                    cor.ui.check()                    cor.ui.set_hide(False)        elif x_plane and not y_plane:            for cor in self.corrs:                if cor.__class__ == Hcor:                    cor.ui.check()                    cor.ui.set_hide(False)                else:                    cor.ui.uncheck()                    cor.ui.set_hide(True)        else:            for cor in self.corrs:                cor.ui.check()                cor.ui.set_hide(False)                # uncheck correctors from the ban list        self.uncheck_corrs(self.corrs, self.corrs4remove)    def reset_all(self):        """        Method to reset initial values of the correctors        :return:        """        corrs = self.get_dev_from_cb_state(self.corrs)        self.online_calc = False        for cor in corrs:            kick_mrad = cor.ui.get_init_value()            cor.ui.set_value(kick_mrad)        self.online_calc = True    def undo(self):        """        Method to reset initial values of the correctors        :return:        """        if len(self.undo_data_base) == 0:            return 0        self.online_calc = False        corrs_dict = self.undo_data_base[-1]        for cor in self.corrs:            if cor.id in corrs_dict.keys():                cor.ui.check()                kick_mrad = corrs_dict[cor.id]                cor.ui.set_init_value(kick_mrad)                cor.ui.set_value(kick_mrad)            else:                cor.ui.uncheck()        del self.undo_data_base[-1]        self.ui.pb_reset_all.setText("Undo (" + str(len(self.undo_data_base)) + ")")        self.online_calc = True    def save_correctors(self):        corrs_save = {}        for cor in self.corrs:            logger.debug("save correctors: " + cor.id + " " + str(cor.ui.get_init_value()))            corrs_save[cor.id] = cor.ui.get_init_value()                    with open("corrs_save.json", 'w') as f:            json.dump(corrs_save, f)    def restore_correctors(self):        with open("corrs_save.json", 'r') as f:            table = json.load(f)        cor_ids = [cor.id for cor in self.corrs]        self.online_calc = False        for cor_id in table.keys():            if cor_id in cor_ids:                inx = cor_ids.index(cor_id)                cor = self.corrs[inx]                cor.ui.set_value(table[cor.id])                logger.debug("restore correctors:" + cor.id +" before %s after %s" % (cor.ui.get_value(), table[cor.id]))        self.online_calc = True    def apply_kicks(self):        """        Methods sends correctors kicks to DOOCS, if strengths below the limits,        otherwise error box will appear        :return:        """        logger.info("Apply Kicks")        corrs = self.get_dev_from_cb_state(self.corrs)        for cor in corrs:            if cor.ui.alarm:                logger.info("apply_kicks: kick exceeds limits. Stop applying")                self.parent.error_box("kick exceeds limits. Try 'Uncheck Red' and recalculate correction")                return 0        kicks = np.array([cor.ui.get_value() for cor in corrs])        if np.all(kicks == 0):            yes = self.parent.question_box("All kicks are zero. Apply?")            if not yes:                return        for cor in corrs:            kick_mrad = cor.ui.get_value()            logger.debug("Apply kicks: " + cor.id + " set: %s --> %s" % (cor.ui.get_init_value(), kick_mrad))            try:                cor.mi.set_value(kick_mrad)            except:                logger.error("Apply kick: mi.set_value cause error - corrector.id = "+ str(cor.id) + ", kick_mrad = " + str(kick_mrad))                self.parent.error_box("Error during writing in DOOCS. Repeat APPLY KICKS. Corrector: " + str(cor.id) + " kick = " + str(kick_mrad))        dict_delta_kicks_rad = self.write_old_kicks(corrs)        # if self.parent.cor_analysis is not None and self.parent.mi.analyse_correction is True:        #     self.parent.cor_analysis.save_kicks(dict_delta_kicks_rad)        #     #self.parent.cor_analysis.used_correctors(corrs)        #     self.parent.cor_analysis.start()    def write_old_kicks(self, corrs):        """        Method to store a history of the applied kicks in self.undo_data_base.        secondary functionality is to store correctors dictionary with delta kick for analysis.        :param corrs: list of correcors (classes)        :return: dict_delta_kicks_rad, dictionary {"cor_id": delta_kick_in_rad, ...}        """        old_corrs_kicks = {}        dict_delta_kicks_rad = {}        save_flag = False        for cor in corrs:            # write to dict old kicker strengths            old_corrs_kicks[cor.id] = cor.ui.get_init_value()            dict_delta_kicks_rad[cor.id] = (cor.ui.get_value() - cor.ui.get_init_value())/1000 # mrad -> rad            if cor.ui.get_init_value() != cor.ui.get_value():                save_flag = True        if save_flag:            self.undo_data_base.append(old_corrs_kicks)            self.ui.pb_reset_all.setText("Undo (" + str(len(self.undo_data_base)) + ")")        return dict_delta_kicks_rad    def read_correctors_BESSY(self):        cor_names = [cor.id for cor in self.corrs]        self.parent.mi.corrector_data.connect(cor_names)        self.parent.mi.correctors_kick = self.parent.mi.corrector_data.get()        self.online_calc = False        for elem in self.corrs:            hw2phys = self.parent.mi.corr_conversion[elem.id][0]            elem.kick_mrad = elem.mi.get_value_from_dict()            elem.angle_read = elem.kick_mrad*hw2phys            elem.i_kick = elem.kick_mrad            elem.ui.set_init_value(elem.kick_mrad)            elem.ui.set_value(elem.kick_mrad)        self.online_calc = True        self.parent.lat.update_transfer_maps()    def read_correctors(self):        """        Method to read from MI correctors (angles: mrad->rad)        self.online_calc = False - switch off recalculating of the calculated orbit        otherwise after every set in table orbit will be recalculated.        :return:        """        self.online_calc = False        for elem in self.corrs:            elem.kick_mrad = elem.mi.get_value()            elem.angle_read = elem.mi.hw2phys(elem.kick_mrad)            elem.i_kick = elem.kick_mrad            elem.ui.set_init_value(elem.kick_mrad)            elem.ui.set_value(elem.kick_mrad)        self.online_calc = True        self.parent.lat.update_transfer_maps()    def read_orbit_one_by_one(self):        """        Method to readw from MI: correctors (angles: mrad->rad) and        BPMs (X and Y: mm -> m) and checks charge on the BPMs        if the charge below charge_thresh return False        :return: bool, True if the charge on all BPMs >= charge_thresh otherwise False        """        self.read_correctors()        charge_thresh = 0.005        bpms = self.get_dev_from_cb_state(self.bpms)        beam_on = True        for elem in bpms:            try:                x_mm, y_mm = elem.mi.get_pos()                if np.isnan(x_mm) or np.isnan(y_mm):                    logger.warning("read bpm: " + elem.id + "NaN -> was unchecked")                    elem.ui.uncheck()                charge = elem.mi.get_charge()                if charge < charge_thresh:                    beam_on = False                if np.abs(charge/self.parent.bunch_charge) < self.parent.charge_tol/100:                    logger.info(" BPM:" + elem.id + " unchecked -> " +str(np.round(charge, 2)) + "/" + str(np.round(self.parent.bunch_charge, 2)) + " < " + str(self.parent.charge_tol/100))                    elem.ui.uncheck()                elem.x = x_mm/1000.                elem.y = y_mm/1000.                elem.ui.set_value((x_mm, y_mm))            except Exception as exc:                logger.error("read bpm: " + elem.id + " was unchecked.  Error: " + str(exc))                elem.ui.uncheck()        self.update_plot()        return beam_on    def read_orbit_star(self):        """        Method to readw from MI: correctors (angles: mrad->rad) and        BPMs (X and Y: mm -> m) and checks charge on the BPMs        if the charge below charge_thresh return False        :return: bool, True if the charge on all BPMs >= charge_thresh otherwise False        """        self.mi_orbit.read_and_average(nreadings=1, take_last_n=1)        self.read_correctors()        charge_thresh = 0.005        bpms = self.get_dev_from_cb_state(self.bpms)        self.mi_orbit.get_bpms(bpms)                beam_on = True        for elem in bpms:            try:                if np.isnan(elem.x) or np.isnan(elem.y):                    logger.warning("read bpm: " + elem.id + "NaN -> was unchecked")                    elem.ui.uncheck()                charge = elem.charge                if charge < charge_thresh:                    beam_on = False                if np.abs(charge/self.parent.bunch_charge) < self.parent.charge_tol/100:                    logger.info(" BPM:" + elem.id + " unchecked -> " +str(np.round(charge, 2)) + "/" + str(np.round(self.parent.bunch_charge, 2)) + " < " + str(self.parent.charge_tol/100))                    elem.ui.uncheck()                elem.ui.set_value((elem.x*1000, elem.y*1000))            except Exception as exc:                logger.error("read bpm: " + elem.id + " was unchecked.  Error: " + str(exc))                elem.ui.uncheck()        self.update_plot()        return beam_on    def read_orbit(self):        if self.parent.mi.allow_star_operation is True:            return self.read_orbit_star()        else:            return self.read_orbit_one_by_one()    def calc_orbit(self):        """        function calculates the orbit taking into account correctors strength        :return: None        """        if self.online_calc == False:            return        for elem in self.parent.lat.sequence:            if elem.__class__ in [Hcor, Vcor] and hasattr(elem, 'ui'):                elem.kick_mrad = elem.ui.get_value()                kick_mrad_i = elem.ui.get_init_value()                warn = (np.abs(elem.kick_mrad) - np.abs(elem.ui.get_init_value())) > 0.5                elem.ui.check_values(elem.kick_mrad, elem.lims, warn=warn)                #angle = (elem.kick_mrad - kick_mrad_i)/1000.                kick_mrad = (elem.kick_mrad - kick_mrad_i)                elem.angle = elem.mi.hw2phys(kick_mrad)                elem.transfer_map = self.parent.lat.method.create_tm(elem)        #self.update_cors_plot()        self.update_plot()    def create_Orbit_obj(self):        """        function creates the Orbit object with correctors and bpms which are active in the GUI        Orbit - is object form ocelot.cpbd.orbit_correction        :return: Orbit        """        self.orbit = Orbit(self.parent.lat, empty=True, rm_method=self.parent.mi.orm_method,                              disp_rm_method=self.parent.mi.drm_method)        # setup correction method        if self.parent.solver_name == "SVD":            self.orbit.orbit_solver = OrbitSVD(epsilon_x=self.parent.svd_epsilon_x,                                  epsilon_y=self.parent.svd_epsilon_y)        else:            self.orbit.orbit_solver = MICADO(epsilon_x=self.parent.svd_epsilon_x,                                  epsilon_y=self.parent.svd_epsilon_y, epsilon_ksi=self.parent.epsilon_ksi)        # checking hardware of the correctors        self.check_hardware_status(self.corrs)        s_pos_min = np.min([cor.s for cor in self.corrs])        bpms = np.array(self.bpms)        corrs = np.array(self.corrs)        s_pos_max = np.max([bpm.s for bpm in bpms])        bpms_unch = bpms[np.array([bpm.s for bpm in self.bpms]) < s_pos_min]        corrs_unch = corrs[np.array([corr.s for corr in self.corrs]) > s_pos_max]        if self.parent.mi.uncheck_upstream_bpms:            [bpm.ui.uncheck() for bpm in bpms_unch]            [corr.ui.uncheck() for corr in corrs_unch]        bpms = self.get_dev_from_cb_state(bpms)        if len(bpms) == 0:            self.parent.error_box("No BPM. Check SUBTRAIN.")            return None                corrs = self.get_dev_from_cb_state(self.corrs)        if len(corrs) == 0:            self.parent.error_box("No correctors for correction")            return None                self.orbit.bpms = bpms        self.orbit.corrs = corrs        self.hcors = []        self.vcors = []        for cor in corrs:            if cor.__class__ == Hcor:                self.hcors.append(cor)            else:                self.vcors.append(cor)        self.orbit.hcors = self.hcors        self.orbit.vcors = self.vcors        self.orbit.setup_response_matrix()        self.orbit.setup_disp_response_matrix()        return self.orbit    def load_response_matrices(self):        """        Method to load ORM and DRM from the file.        :return: True if the corresponding file exists and False if not        """        logger.debug("load_response_matrices: path: " + self.parent.rm_files_dir + "RM_" + self.ui.cb_lattice.currentText() + ".p")        try:            self.orbit.response_matrix.load(self.parent.rm_files_dir + "RM_" + self.ui.cb_lattice.currentText() + ".p")        except:            logger.error("load_response_matrices: No Response Matrix")            return False        try:            self.orbit.disp_response_matrix.load(self.parent.rm_files_dir + "DRM_" + self.ui.cb_lattice.currentText() + ".p")        except:            logger.error("load_response_matrices: No Dispersion Response Matrix. Setting: self.orbit.disp_response_matrix = None")            self.orbit.disp_response_matrix = None            return True        return True    def is_rm_ok(self, orbit):        """        Method to check and load if needed the RMs        :return: True -  if shape of the ORM (!) is correct (shape of the DRM is not checked)                 False - if the RM does not exist or RM load was failed        """        #print(len(self.orbit.response_matrix.matrix))        if len(self.orbit.response_matrix.matrix) == 0:            is_ok = self.load_response_matrices()            logger.debug("is_rm_ok: tring to load response matrix ... Is OK? " + str(is_ok))            if not is_ok:                return is_ok        cor_list = [cor.id for cor in np.append(orbit.hcors, orbit.vcors)]        bpm_list = [bpm.id for bpm in orbit.bpms]        RM = None        try:            RM = self.orbit.response_matrix.extract(cor_list=cor_list, bpm_list=bpm_list)        except:            self.parent.error_box(message="Problem with RM. Recalcualte it. Load all section from min position to maximum and manually select all correctors and BPms.")            return False        if np.shape(RM)[0] != len(bpm_list)*2 or np.shape(RM)[1] != len(cor_list):            return False        else:            return True    def close_orbit(self):        """        Method sets BPM.x_ref and BPM.y_ref from dictionary: self.golden_orbit        :return:        """        n_bpms = len(self.orbit.bpms)        if n_bpms < 10:            self.ui.cb_close_orbit.setChecked(False)        for i, elem in enumerate(self.orbit.bpms[-self.parent.co_nlast_bpms:]):            elem.x_ref = elem.x            elem.y_ref = elem.y            logger.debug("close_orbit: set BPM to ref orbit: " + elem.id)    def set_values2correctors(self):        apply_fraction = self.ui.sb_apply_fraction.value()        self.online_calc = False        for cor in self.corrs:            kick_mrad_old = cor.ui.get_init_value()            if cor.id in self.calc_correction.keys():                cor.angle = self.calc_correction[cor.id]            delta_kick_mrad = cor.mi.phys2hw(cor.angle)*apply_fraction            #delta_kick_mrad = cor.angle*1000*apply_fraction            #print(cor.angle*1000, delta_kick_mrad)            new_kick_mrad = kick_mrad_old + delta_kick_mrad            cor.kick_mrad =  new_kick_mrad            cor.ui.set_value(cor.kick_mrad)                        if np.abs(delta_kick_mrad) > 0.001:                self.ui.table_cor.item(cor.row, 1).setForeground(QtGui.QColor(255, 101, 101))  # red            else:                self.ui.table_cor.item(cor.row, 1).setForeground(QtGui.QColor(255, 255, 255))  # white                            warn = (np.abs(new_kick_mrad) - np.abs(kick_mrad_old)) > 0.5            cor.ui.check_values(cor.kick_mrad, cor.lims, warn)        self.online_calc = True        self.calc_orbit()    def single_shot_read_bpms(self):        # remove checking if the freeze checkBox is checked        # if not self.ui.cb_freeze_bpms.isChecked():        #     self.parent.error_box("Freeze BPMs first")        #     return        logger.info("Single Shot reading")                try:            self.read_correctors()        except Exception as e:            logger.critical("single_shot_read: read_correctors ERROR: " + str(e))            self.parent.error_box("Error in DOOCS during correctors reading")        self.xfel_mps.num_bunches_requested(num_bunches=1)        self.xfel_mps.beam_on()        time.sleep(0.2)        self.xfel_mps.beam_off()        time.sleep(0.5)        try:            self.mi_orbit.read_and_average(nreadings=1, take_last_n=1, reliable_reading=False, suffix=".HOLD")        except Exception as e:            logger.error("single_shot_orbit_read: mi_orbit.read_and_average()" + str(e))            raise        #time.sleep(0.1)                self.calculate_correction()    def multi_shot_read_bpms(self):        logger.info("Multi Shot reading")        try:            self.read_correctors()        except Exception as e:            logger.critical("multi_shot_read: read_correctors ERROR: " + str(e))            self.parent.error_box("Error in DOOCS during correctors reading")        self.xfel_mps.num_bunches_requested(num_bunches=1)                # first idle reading before real one.          #self.mi_orbit.read_and_average(nreadings=1, take_last_n=1)                self.xfel_mps.beam_on()        try:            self.mi_orbit.read_and_average(nreadings=self.parent.gc_nreadings, take_last_n=self.parent.gc_nlast, suffix="")        except Exception as e:            logger.error("read_bpms: mi_orbit.read_and_average() " + str(e))            raise        self.xfel_mps.beam_off()        self.calculate_correction()    def read_bpms(self):        if self.parent.single_shot_flag and (self.button_bpm != None and self.cavity_bpm != None):            self.single_shot_read_bpms()        else:            self.multi_shot_read_bpms()    def calculate_correction(self):        logger.debug("calculate_correction: .. ")        bpms = self.get_dev_from_cb_state(self.bpms)        checked_bpms_id = [bpm.id for bpm in bpms]        self.mi_orbit.get_bpms(bpms)        bpms = self.get_dev_from_cb_state(self.bpms)        charge_thresh = 0.005        for elem in bpms:            if np.isnan(elem.x) or np.isnan(elem.y):                logger.debug("calculate_correction: check BPM: " + elem.id + " NAN -> was unchecked")                elem.ui.uncheck()            if elem.charge < charge_thresh:                elem.ui.uncheck()            elem.ui.set_value((elem.x*1000, elem.y*1000))        self.update_plot()                self.uncheck_red()        self.correct()        for elem in bpms:            if elem.id in checked_bpms_id:                elem.ui.check()        logger.debug("calculate_correction: .. OK")    def read_and_correct(self):        logger.debug("read_and_correct ... ")        self.read_orbit()        self.uncheck_red()        self.correct()        logger.debug("read_and_correct ... OK")    def correct(self, reset=True):        """        Method to the Orbit correction. Method calculate correctors strengths (kicks)        and call function to calculate (self.calc_orbit()) and draw orbit on the plot        but does not send it to the DOOCS server.        :return:        """        logger.info("correct: ... ")        if reset:            self.orbit = self.create_Orbit_obj()        if self.orbit is None:            return         if not self.is_rm_ok(self.orbit):            self.parent.error_box("Calculate Response Matrix")            return 0        self.golden_orbit.dict2golden_orbit()        if self.ui.cb_close_orbit.isChecked():            self.close_orbit()        if self.parent.mi.analyse_correction is True:            self.parent.cor_analysis.initialization(mi_orbit=self.mi_orbit, orbit=self.orbit)            self.parent.cor_analysis.get_snapshot()        self.calc_correction = {}        for cor in self.corrs:            cor.angle = 0.            self.calc_correction[cor.id] = cor.angle                alpha = self.ui.sb_alpha.value()        # print("PARAMS: ", self.parent.svd_epsilon_x, self.parent.svd_epsilon_y, self.parent.svd_beta)        self.orbit.correction(alpha=alpha, p_init=None, beta=self.parent.svd_beta, print_log=False)        for cor in self.corrs:            self.calc_correction[cor.id] = cor.angle        self.set_values2correctors()        logger.info("correct: ... OK")    def start_stop_feedback(self):        """        Method to start/stop feedback timer.        sb_feedback_sec - spinBox - set seconds for timer        pb_feedback - pushBatton Off/On        feedback_timer - timer        :return:        """        delay = self.ui.sb_feedback_sec.value()*1000        if self.ui.pb_feedback.text() == "Orbit Keeper Off":            self.parent.feedback_timer.stop()            self.ui.pb_feedback.setStyleSheet("color: rgb(85, 255, 127);")            self.ui.pb_feedback.setText("Orbit Keeper On")        else:            self.parent.feedback_timer.start(delay)            self.ui.pb_feedback.setText("Orbit Keeper Off")            self.ui.pb_feedback.setStyleSheet("color: red")    def start_stop_feedback_new(self):        """        Method to start/stop feedback timer.        sb_feedback_sec - spinBox - set seconds for timer        pb_feedback - pushBatton Off/On        feedback_timer - timer        :return:        """        delay = self.ui.sb_feedback_sec.value()        if self.ui.pb_feedback.text() == "Orbit Keeper Off":            self.orbit_keeper.stop_event = True            self.orbit_keeper.stop()            self.ui.pb_feedback.setStyleSheet("color: rgb(85, 255, 127);")            self.ui.pb_feedback.setText("Orbit Keeper On")        else:            self.orbit_keeper.delay = delay            self.orbit_keeper.stop_event = False            self.orbit_keeper.start()            self.ui.pb_feedback.setText("Orbit Keeper Off")            self.ui.pb_feedback.setStyleSheet("color: red")    def auto_correction(self):        """        Method repeats correction in a loop.        repetation rate is defined by spinBox - sb_feedback_sec        feedback_timer - QTimer to repats correction oin different thread        :return:        """        beam_on = self.read_orbit()        time.sleep(0.01)        if beam_on:            self.correct()            time.sleep(0.01)            self.apply_kicks()            time.sleep(0.5)        else:            logger.info("auto_correction: no beam")            time.sleep(1)    def get_dev_from_cb_state(self, devs):        """        Gets list of all pvs that have checked boxes.        Returns:                List of PV strings        """        checked_devs = []        for dev in devs:            state = dev.ui.state()            #print(dev.id, state)            if state == 2:                checked_devs.append(dev)        return checked_devs    def check_hardware_status(self, devs):        """        Check hardware status of the devices        Returns:                List of PV strings        """        checked_devs = []        for dev in devs:            is_ok = dev.mi.is_ok()            if not is_ok and not self.dev_mode:                logger.warning(" harware_status fault: " + dev.id )                dev.ui.uncheck()                dev.ui.set_fault(True)            else:                dev.ui.set_fault(False)    def calc_response_matrix(self, do_DRM_calc=True):        """        Method is connected to pushBatton pb_calc_RM and creates ResponseMatrixCalculator        which calculates ORM and DRM in different thread        self.parent.rm_files_dir - name of directory for RMs sore        self.ui.cb_lattice.currentText() - name of the sections (e.g. "I1D, L1, SASE1 and so on)        The method also launchs the Qtimer self.rm_calc to controle when the thread        ResponseMatrixCalculator finishs the calculations        :return:        """        self.orbit = self.create_Orbit_obj()        if self.orbit == None:            return        self.RMs = ResponseMatrixCalculator(rm=self.orbit.response_matrix,                                      drm=self.orbit.disp_response_matrix)        self.RMs.do_DRM_calc = do_DRM_calc        self.ui.pb_correct_orbit.setText("RMs are calculated. Please Wait...")        self.ui.pb_correct_orbit.setStyleSheet("color: red")        self.RMs.tw_init = self.parent.tws0        self.RMs.rm_filename = self.parent.rm_files_dir + "RM_" + self.ui.cb_lattice.currentText() + ".p"        self.RMs.drm_filename = self.parent.rm_files_dir + "DRM_" + self.ui.cb_lattice.currentText() + ".p"        self.RMs.start()        self.rm_calc.start()    def is_rm_calc_alive(self):        """        Method to check if the ResponseMatrixCalculator thread is alive.        it is needed to change name and color of the pushBatton pb_calc_RM.        When RMs caclulation is finished. If the thread is dead QTimer self.rm_calc is stopped        :return:        """        if not self.RMs.is_alive():            self.ui.pb_correct_orbit.setStyleSheet("color: rgb(85, 255, 127);")            self.ui.pb_correct_orbit.setText("Read and Calculate")            self.rm_calc.stop()    def load_correctors(self):        """        """        self.corrs = self.load_devices(types=[Hcor, Vcor])        self.parent.add_devs2table(self.corrs, w_table=self.ui.table_cor, calc_obj=self.calc_orbit,                                   spin_params=[-100, 100, 0.1], check_box=True)        self.cor_ampl = np.max(np.append(1, np.abs(np.array([q.kick_mrad for q in self.corrs]))))        self.ui.table_cor.horizontalHeader().setResizeMode(QtGui.QHeaderView.Stretch)    def load_bpms(self, lat):        devices = []        L = 0        for i, elem in enumerate(lat.sequence):            L += elem.l            if elem.__class__ in [Monitor]:                elem.s = L - elem.l/2.                devices.append(elem)                mi_dev = self.parent.mi.devices.BPM(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                mi_dev.mi = self.parent.mi                mi_dev.bpm_server = self.parent.bpm_server                elem.mi = mi_dev                elem.lat_inx = i                elem.x = 0                elem.y = 0                elem.Dx = 0                elem.Dy = 0                elem.Dx_des = 0                elem.Dy_des = 0                elem.weight = 1        return devices    def add_bpms2table(self, devs, w_table, check_box=False):        """ Initialize the UI table object """        self.spin_boxes = []        w_table.setRowCount(0)        for row in range(len(devs)):            #eng = QtCore.QLocale(QtCore.QLocale.English, QtCore.QLocale.UnitedStates)            w_table.setRowCount(row + 1)            pv = devs[row].id            # put PV in the table            w_table.setItem(row, 0, QtGui.QTableWidgetItem(str(pv)))            # put start val in            w_table.setItem(row, 1, QtGui.QTableWidgetItem(str(devs[row].x)))            w_table.setItem(row, 2, QtGui.QTableWidgetItem(str(devs[row].y)))            #header = w_table.horizontalHeader()            #header.setStretchLastSection(True)            #header.setResizeMode(0, QtGui.QHeaderView.ResizeToContents)            if check_box:                checkBoxItem = QtGui.QTableWidgetItem()                # checkBoxItem.setBackgroundColor(QtGui.QColor(100,100,150))                checkBoxItem.setCheckState(QtCore.Qt.Checked)                flags = checkBoxItem.flags()                checkBoxItem.setFlags(flags)                w_table.setItem(row, 3, checkBoxItem)                #checkBoxItem.itemChanged.connect(self.calc_orbit)            devs[row].row = row            ui = self.parent.mi.devices.BPMUI()            ui.tableWidget = w_table            ui.row = row            ui.col = 2            devs[row].ui = ui        w_table.resizeColumnsToContents()    def uncheck_bpms(self, bpms, bmps4uncheck):        for bpm in bpms:            if bpm.id in bmps4uncheck:                bpm.ui.uncheck()    def uncheck_corrs(self, corrs, cors4uncheck):        for cor in corrs:            if cor.id in cors4uncheck:                cor.ui.uncheck()    def load_orbit_devs(self):        self.bpms = self.load_bpms(lat=self.parent.lat)        self.add_bpms2table(self.bpms, w_table=self.ui.table_bpm, check_box=True)        self.uncheck_bpms(self.bpms, self.bpms4remove)        self.load_correctors()        self.uncheck_corrs(self.corrs, self.corrs4remove)        self.golden_orbit.copy_bpms(self.bpms)    def load_devices(self, types, load_all=False):        devices = []        mi_devs = {}        lat_seq = self.parent.lat.sequence        if load_all:            lat_seq = self.parent.big_sequence        L = 0        for i, elem in enumerate(lat_seq):            L += elem.l            if elem.__class__ in types:                elem.s = L - elem.l / 2.                if "ps_id" in elem.__dict__:                    if elem.ps_id not in mi_devs.keys():                        mi_dev = self.parent.mi.devices.Corrector(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                        mi_dev.mi = self.parent.mi                        elem.mi = mi_dev                        mi_devs[elem.ps_id] = mi_dev                    else:                        elem.mi = mi_devs[elem.ps_id]                else:                    mi_dev = self.parent.mi.devices.Corrector(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                    mi_dev.mi = self.parent.mi                    elem.mi = mi_dev                try:                    elem.lims = elem.mi.get_limits()                except Exception as e:                    logger.error("load_devices: get_limits error, id = " + elem.id + str(e))                    continue                self.parent.mi.add_conversion(elem)                #elem.kick_mrad = elem.angle* 1000.                elem.kick_mrad = elem.mi.phys2hw(elem.angle)                elem.i_kick = elem.kick_mrad                elem.lat_inx = i                if self.dev_mode:                    elem.lims = [-1, 1]                if elem.__class__ == Hcor:                    self.hcors.append(elem)                elif elem.__class__ == Vcor:                    self.vcors.append(elem)                else:                    logger.error("load_devices: wrong device type")                devices.append(elem)        return devices    def add_orbit_plot(self):        win = pg.GraphicsLayoutWidget()        self.plot_x = win.addPlot(row=0, col=0)        #win.ci.layout.setRowMaximumHeight(0, 200)        self.plot_x.showGrid(1, 1, 1)        self.plot_y = win.addPlot(row=1, col=0)        self.plot_x.setXLink(self.plot_y)        self.plot_y.showGrid(1, 1, 1)        self.plot_y.getAxis('left').enableAutoSIPrefix(enable=False)  # stop the auto unit scaling on y axes        layout = QtGui.QGridLayout()        layout.setContentsMargins(0, 0, 0, 0)        self.ui.w_orbit.setLayout(layout)        layout.addWidget(win, 0, 0)        self.plot_y.setAutoVisible(y=True)        self.plot_y.addLegend()        color = QtGui.QColor(0, 255, 255)        pen = pg.mkPen(color, width=3)        self.orb_y = pg.PlotCurveItem(x=[], y=[], pen=pen, name='Y calc', antialias=True)        self.plot_y.addItem(self.orb_y)        color = QtGui.QColor(255, 0, 0)        pen = pg.mkPen(color, width=4)        self.orb_y_ref = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', name='Y', antialias=True)        self.plot_y.addItem(self.orb_y_ref)        color = QtGui.QColor(255,165,0)        pen = pg.mkPen(color, width=3)        self.orb_y_golden = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush=(255, 165, 0), name='Y golden', antialias=True)        color = QtGui.QColor(0, 255, 0)        pen = pg.mkPen(color, width=2)        self.orb_y_live = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush="g", name='Y live')        self.plot_x.addLegend()        color = QtGui.QColor(0, 255, 255)        pen = pg.mkPen(color, width=3)        self.orb_x = pg.PlotCurveItem(x=[], y=[], pen=pen,  name='X calc', antialias=True)        self.plot_x.addItem(self.orb_x)        color = QtGui.QColor(255, 0, 0)        pen = pg.mkPen(color, width=4, symbolPen='o')        self.orb_x_ref = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', name='X', antialias=True)        self.plot_x.addItem(self.orb_x_ref)        color = QtGui.QColor(0, 255, 0)        pen = pg.mkPen(color, width=2)        self.orb_x_live = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush="g", name='X live')        color = QtGui.QColor(255,165,0)        pen = pg.mkPen(color, width=3)        self.orb_x_golden= pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush=(255, 165, 0), name='X golden', antialias=True)        #self.plot_cor.sigRangeChanged.connect(self.zoom_signal)        #self.plot_cor.setYRange(-3, 3)        self.plot_x.sigRangeChanged.connect(self.zoom_signal)        self.plot_x.setYRange(-2, 2)        self.plot_y.setYRange(-2, 2)    def zoom_signal(self):        if len(self.corrs) == 0:            return        s_up = self.plot_y.viewRange()[0][0]        s_down = self.plot_y.viewRange()[0][1]        s_pos = np.array([q.s for q in self.corrs]) + self.parent.lat_zi        s_up = s_up if s_up <= s_pos[-1] else s_pos[-1]        s_down = s_down if s_down >= s_pos[0] else s_pos[0]        s_bpm_pos = np.array([q.s for q in self.bpms]) + self.parent.lat_zi        s_bpm_up = s_up if s_up <= s_bpm_pos[-1] else s_bpm_pos[-1]        s_bpm_down = s_down if s_down >= s_bpm_pos[0] else s_bpm_pos[0]        indexes = np.arange(np.argwhere(s_pos >= s_up)[0][0], np.argwhere(s_pos <= s_down)[-1][0] + 1)        mask = np.ones(len(self.corrs), np.bool)        mask[indexes] = 0        self.corrs = np.array(self.corrs)        [q.ui.set_hide(hide=False) for q in self.corrs[indexes]]        [q.ui.set_hide(hide=True) for q in self.corrs[mask]]        #[q.ui.check() for q in self.corrs[indexes]]        #[q.ui.uncheck() for q in self.corrs[mask]]        s_bpm_pos = np.array([q.s for q in self.bpms]) + self.parent.lat_zi        s_bpm_up = s_bpm_up if s_bpm_up <= s_bpm_pos[-1] else s_bpm_pos[-1]        s_bpm_down = s_bpm_down if s_bpm_down >= s_bpm_pos[0] else s_bpm_pos[0]        indexes_bpm = np.arange(np.argwhere(s_bpm_pos >= s_bpm_up)[0][0], np.argwhere(s_bpm_pos <= s_bpm_down)[-1][0] + 1)        mask_bpm = np.ones(len(self.bpms), np.bool)        mask_bpm[indexes_bpm] = 0        self.bpms = np.array(self.bpms)        [q.ui.set_hide(hide=False) for q in self.bpms[indexes_bpm]]        [q.ui.set_hide(hide=True) for q in self.bpms[mask_bpm]]    def start_stop_live_orbit(self):        if self.ui.pb_online_orbit.text() == "Live Orbit Off":            self.parent.timer_live.stop()            self.ui.pb_online_orbit.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_online_orbit.setText("Live Orbit On")            self.plot_x.removeItem(self.orb_x_live)            self.plot_y.removeItem(self.orb_y_live)            self.plot_x.legend.removeItem(self.orb_x_live.name())            self.plot_y.legend.removeItem(self.orb_y_live.name())        else:            self.parent.timer_live.start(200)            self.ui.pb_online_orbit.setText("Live Orbit Off")            self.ui.pb_online_orbit.setStyleSheet("color: rgb(85, 255, 127);")            self.plot_x.addItem(self.orb_x_live)            self.plot_y.addItem(self.orb_y_live)    def start_stop_calc_orbit(self):        if self.ui.pb_calc_orb.text() == "Calc Orb Off":            self.plot_x.removeItem(self.orb_x)            self.plot_y.removeItem(self.orb_y)            self.plot_x.legend.removeItem(self.orb_x.name())            self.plot_y.legend.removeItem(self.orb_y.name())            self.ui.pb_calc_orb.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_calc_orb.setText("Calc Orb On")        else:            self.ui.pb_calc_orb.setText("Calc Orb Off")            self.ui.pb_calc_orb.setStyleSheet("color: rgb(255, 0, 0);")                        self.plot_x.addItem(self.orb_x)            self.plot_y.addItem(self.orb_y)            self.update_plot()                def start_stop_ref_orbit(self):        if self.ui.pb_ref_orb.text() == "Ref Orb Off":            self.plot_x.removeItem(self.orb_x_ref)            self.plot_y.removeItem(self.orb_y_ref)            self.plot_x.legend.removeItem(self.orb_x_ref.name())            self.plot_y.legend.removeItem(self.orb_y_ref.name())            self.ui.pb_ref_orb.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_ref_orb.setText("Ref Orb On")        else:            self.ui.pb_ref_orb.setText("Ref Orb Off")            self.ui.pb_ref_orb.setStyleSheet("color: rgb(255, 0, 0);")                        self.plot_x.addItem(self.orb_x_ref)            self.plot_y.addItem(self.orb_y_ref)            self.update_plot()     def live_orbit(self):        s_bpm = np.array([])        x_bpm = np.array([])        y_bpm = np.array([])        bpms = self.get_dev_from_cb_state(self.bpms)        #print(self.xfel_mps.is_beam_on())        if self.xfel_mps.is_beam_on() != 1 and not self.dev_mode:            logger.info("live_orbit: beam off. return ")            return                    for elem in bpms:            try:                x_mm, y_mm = elem.mi.get_pos()                s_bpm = np.append(s_bpm, elem.s)                x_bpm = np.append(x_bpm, x_mm - elem.x_ref*1000)                y_bpm = np.append(y_bpm, y_mm - elem.y_ref*1000)            except Exception as exc:                logger.warning("live_orbit: could not read BPM: " + elem.id + " Error: " + str(exc))        s_bpm += self.parent.lat_zi        self.orb_x_live.setData(x=s_bpm, y=x_bpm)        self.orb_y_live.setData(x=s_bpm, y=y_bpm)        self.orb_y.update()        self.orb_x.update()    def update_plot(self):        #start = time.time()        start = time.time()        if self.parent.mi.twiss_periodic is True:            p = match.closed_orbit(self.parent.lat)        else:            p = Particle()        print("update plot: traj closed_orbit ", time.time() - start)        start = time.time()        p.E = self.parent.tws0.E        p_list = lattice_track(self.parent.lat, p)        print("update plot: traj calculation ", time.time() - start)        #print("3 = ", start - time.time())        x = np.array([p.x for p in p_list])*1000        y = np.array([p.y for p in p_list])*1000        s = np.array([p.s for p in p_list]) + self.parent.lat_zi        bpms = self.get_dev_from_cb_state(self.bpms)        s_bpm = np.array([bpm.s for bpm in bpms]) + self.parent.lat_zi        x_bpm = np.array([bpm.x - bpm.x_ref for bpm in bpms])*1000        y_bpm = np.array([bpm.y - bpm.y_ref for bpm in bpms])*1000        indx = np.searchsorted(s, s_bpm)        x_bpms_track = x[indx]        y_bpms_track = y[indx]        # Line        self.orb_x_ref.setData(x=s_bpm, y=x_bpm)        self.orb_y_ref.setData(x=s_bpm, y=y_bpm)        if self.parent.show_correction_result: #otherwise "changes"            self.orb_x.setData(x=s_bpm, y=x_bpm + x_bpms_track)            self.orb_y.setData(x=s_bpm, y=y_bpm + y_bpms_track)        else:            self.orb_x.setData(x=s, y=x)            self.orb_y.setData(x=s, y=y)        #self.orb_y.setData(x=s, y=y)        #self.plot_cor.update()        self.orb_y.update()        self.orb_x.update()    def uncheckBoxes(self):        """ Method to unchecked all active boxes """        for cor in self.corrs:            cor.ui.uncheck()    def getRows(self, state, widget):        """        Method to set the UI checkbox state from slected rows.        Loops though the rows and gets the selected state from the 'Active" column.        If highlighted, check box is set the the 'state' input arg.        Args:                state (bool): Bool of whether the boxes should be checked or unchecked.        """        rows=[]        for idx in widget.selectedIndexes():            rows.append(idx.row())            item = widget.item(idx.row(), 3)            if item.flags() == QtCore.Qt.NoItemFlags:                print("item disabled")                continue            item.setCheckState(state)
\ No newline at end of file
+"""Sergey Tomin. XFEL/DESY, 2017."""import osimport loggingfrom threading import Threadimport pyqtgraph as pgfrom PyQt5 import QtGui, QtCorefrom PyQt5.QtWidgets import QCheckBoximport numpy as npfrom collections import OrderedDictfrom ocelot import *from ocelot.cpbd.track import *import timefrom ocelot.cpbd.orbit_correction import Orbitfrom ocelot.cpbd.response_matrix import *from golden_orbit import GoldenOrbitfrom orbit_state import OrbitStatefrom orbit_math import TrajectoryResponse, SolverCache, CachedOrbitSVD, CachedMICADO, is_linear_sequence, extract_matrixfrom rm_cache import ResponseMatrixCache, optics_fingerprintfrom rm_parallel import calculate_rm, set_matrixfrom feedback_engine import FeedbackEngine, format_statsfrom orbit_keeper import OrbitKeeper, KeeperSettingsfrom manul_feedback import FeedbackClientfrom mint.orbit_streamer import acquire_streamer, release_streamer, snapshot_indicesfrom gui.tables.device_state_table import BPMTableSyncfrom mint.devices import DeviceStateModelfrom adaptive_feedback import UIAFeedBackfrom ocelot.cpbd import matchimport matplotlib.pyplot as pltimport seaborn as snslogger = logging.getLogger(__name__)try:    from bpm_api import bpm_apiexcept Exception as e:    logger.warning("Import bpm_api: " + str(e))    class ResponseMatrixCalculator(Thread):    """    Wrap for ResponseMatrix class. Allow to calculate response matrices (ORM and DRM) in different thread    """    def __init__(self, rm, drm):        super(ResponseMatrixCalculator, self).__init__()        self.rm = rm        self.drm = drm        self.do_DRM_calc = True        self.tw_init = None        self.rm_filename = None        self.drm_filename = None        self.cache = None        self.rm_key = None        self.drm_key = None        self.section = ""        self.stage = "RM"        self.progress = 0.    def set_progress(self, fraction):        self.progress = fraction    def calculate(self, rm, key, kind):        """        Method takes the matrix from the cache if the optics (key) and the requested correctors/BPMs are there,        otherwise calculates it and puts it into the cache.        :param rm: ResponseMatrix        :param key: optics fingerprint or None        :param kind: "RM" or "DRM"        :return:        """        cached = None        if self.cache is not None and key is not None:            cached = self.cache.get(key, kind=kind, cor_names=rm.cor_names, bpm_names=rm.bpm_names)        if cached is not None:            logger.info("ResponseMatrixCalculator: " + kind + " from cache")            set_matrix(rm, *cached)            return        self.stage = kind        self.progress = 0.        calculate_rm(rm, tw_init=self.tw_init, progress=self.set_progress)        if self.cache is not None and key is not None:            self.cache.put(key, rm.matrix, rm.cor_names, rm.bpm_names, kind=kind, section=self.section)    def run(self):        self.calculate(self.rm, self.rm_key, "RM")        cor_names = self.rm.cor_names        bpm_names = self.rm.bpm_names        inj_matrix = self.rm.matrix        try:            self.rm.load(self.rm_filename)        except:            logger.warning("ResponseMatrixCalculator: Could not load RM.")            if self.rm_filename != None:                logger.warning("ResponseMatrixCalculator: Dumping RM >" + str(self.rm_filename))                self.rm.dump(filename=self.rm_filename)            return False                if len(cor_names) > len(self.rm.cor_names) or len(bpm_names) > len(self.rm.bpm_names):            logger.info("ResponseMatrixCalculator: dump calculated ORM")            self.rm.cor_names = cor_names            self.rm.bpm_names = bpm_names            self.rm.matrix = inj_matrix            self.rm.dump(filename=self.rm_filename)        else:            logger.info("ResponseMatrixCalculator: inject calculated ORM")            self.rm.inject(cor_names, bpm_names, inj_matrix)            logger.warning("ResponseMatrixCalculator: Dumping RM >" + str(self.rm_filename))            self.rm.dump(filename=self.rm_filename)            #print(np.shape(self.rm.matrix))        #if self.rm_filename != None:        #    self.rm.dump(filename=self.rm_filename)        if self.do_DRM_calc:            if self.drm != None:                logger.info("ResponseMatrixCalculator: DRM calculation ... ")                self.calculate(self.drm, self.drm_key, "DRM")            if self.drm_filename != None and self.drm != None:                self.drm.dump(filename=self.drm_filename)                logger.info("ResponseMatrixCalculator: DRM dumping > " + self.drm_filename)class OrbitInterface:    """    Main class for orbit correction    """    def __init__(self, parent):        self.parent = parent        self.bpms4remove = self.parent.uncheck_bpms #["BPMS.99.I1", "BPMS.192.B1"]        self.corrs4remove = self.parent.uncheck_corrs #["CBB.98.I1", "CBB.100.I1", "CBB.101.I1","CBB.191.B1", "CBB.193.B1", "CBB.202.B1",           # 'CBL.73.I1', 'CBL.78.I1', 'CBL.83.I1', 'CBL.88.I1', 'CBL.90.I1', 'CBB.403.B2', 'CBB.405.B2', 'CBB.414.B2']        #print("corrs unchecked:", self.corrs4remove)        self.svd_epsilon_x = self.parent.svd_epsilon_x        self.svd_epsilon_y = self.parent.svd_epsilon_y        self.ui = parent.ui        self.online_calc = True        self.reset_undo_database()        self.corrs = []        self.hcors = []        self.vcors = []        self.s_bpm = []        self.x_bpm = []        self.y_bpm = []        self.orbit_state = OrbitState()        self.traj = TrajectoryResponse()        self.traj_valid = False        self.cor_tm_angles = {}        self.live_streamer = None        #self.mi_orbit = MIOrbit(server=self.parent.server, subtrain=self.parent.subtrain)        #self.mi_orbit.mi = self.parent.mi        #        #self.xfel_mps = MPS(server=self.parent.server, subtrain=self.parent.subtrain)        #self.xfel_mps.mi = self.parent.mi        self.update_machine_interface()        self.calc_correction = {}        self.p_init = None        self.orbit = None        self.rm_cache = None        self.solver_cache = SolverCache()        # RM and DRM slices of the checked devices, see load_response_matrices_from_cache()        self.rm_slices = OrderedDict()        self.add_orbit_plot()        self.ui.pb_check.clicked.connect(lambda: self.getRows(2, self.ui.table_cor))        self.ui.pb_uncheck.clicked.connect(lambda: self.getRows(0, self.ui.table_cor))        self.ui.pb_bpm_uncheck.clicked.connect(lambda: self.getRows(0, self.ui.table_bpm))        self.ui.pb_bpm_check.clicked.connect(lambda: self.getRows(2, self.ui.table_bpm))        self.ui.actionRead_BPMs_Corrs.triggered.connect(self.read_orbit)        self.ui.pb_apply_kicks.clicked.connect(self.apply_kicks)        #self.ui.pb_calc_RM.clicked.connect(self.calc_response_matrix)        self.ui.actionCalculate_RM.triggered.connect(lambda: self.calc_response_matrix(do_DRM_calc=True))        self.ui.actionCalculate_ORM.triggered.connect(lambda: self.calc_response_matrix(do_DRM_calc=False))        self.ui.actionShow_ORM.triggered.connect(self.show_orm)        self.ui.actionAnalyse_Corrections.triggered.connect(self.analyse_corrections)        #self.ui.pb_correct_orbit.clicked.connect(self.correct)        self.ui.pb_correct_orbit.clicked.connect(self.read_and_correct)        self.ui.pb_read_orbit.clicked.connect(self.read_bpms)        self.ui.pb_calculate.clicked.connect(self.calculate_correction)        self.ui.pb_reset_all.clicked.connect(self.undo)        self.ui.cb_x_cors.stateChanged.connect(self.choose_plane)        self.ui.cb_y_cors.stateChanged.connect(self.choose_plane)        self.ui.actionUpdate_Lattice_from_DOOCS.triggered.connect(self.parent.read_quads)        self.ui.cb_cbxy.stateChanged.connect(self.uncheck_aircols)        self.ui.cb_caxy.stateChanged.connect(self.uncheck_aircols)        #self.ui.pb_uncheck_red.clicked.connect(self.uncheck_red)        self.ui.actionUncheck_Red.triggered.connect(self.uncheck_red)        self.ui.pb_online_orbit.clicked.connect(self.start_stop_live_orbit)        self.ui.pb_calc_orb.clicked.connect(self.start_stop_calc_orbit)        self.ui.pb_ref_orb.clicked.connect(self.start_stop_ref_orbit)        #self.cavity = CavityA1(eid="CTRL.A1.I1")        #self.cavity.mi = self.parent.mi        self.ui.pb_feedback.clicked.connect(self.start_stop_feedback)        self.rm_calc = pg.QtCore.QTimer()        self.rm_calc.timeout.connect(self.is_rm_calc_alive)        self.golden_orbit = GoldenOrbit(parent=self)        self.ui.sb_apply_fraction.valueChanged.connect(self.set_values2correctors)        #self.ui.cb_correction_result.stateChanged.connect(self.update_plot)        self.orbit_keeper = None        # Orbit Keeper in the headless daemon (manul_feedback.py), if it is running        self.feedback_client = FeedbackClient(timeout=5.)        self.remote_keeper = pg.QtCore.QTimer()        self.remote_keeper.timeout.connect(self.poll_remote_keeper)        self.cb_feedback_daemon = QCheckBox("Run in feedback daemon", self.ui.groupBox_4)        self.cb_feedback_daemon.setToolTip("Orbit Keeper runs in manul_feedback.py (must be started separately) "                                           "and keeps running without the GUI.\n"                                           "Orbit correction only: no dispersion correction (alpha), no close orbit, "                                           "no corrector status check.\nRM is taken from the RM cache.")        self.ui.gridLayout_24.addWidget(self.cb_feedback_daemon, 1, 3, 1, 1)        self.ui.actionAdaptive_Feedback.triggered.connect(self.run_awindow)        self.adaptive_feedback = None        #self.adaptive_feedback = None        self.dev_mode = self.parent.dev_mode                self.ui.actionSave_corrs.triggered.connect(self.save_correctors)        self.ui.actionLoad_corrs.triggered.connect(self.restore_correctors)        self.button_bpm = None        self.cavity_bpm = None        try:            self.button_bpm = bpm_api.ButtonBPM()            self.cavity_bpm = bpm_api.CavityBPM()        except Exception as e:            logger.warning("Initialization of bpm_api.ButtonBPM and bpm_api.CavityBPM: " + str(e))        self.ui.cb_freeze_bpms.stateChanged.connect(self.freeze_bpms)    def freeze_bpms(self):        # switched off freeze and unfreeze functionality.        if 1:            return                if self.ui.cb_freeze_bpms.isChecked():            logger.info("Freeze BPMs")            self.xfel_mps.beam_off()            self.xfel_mps.num_bunches_requested(num_bunches=1)            charge = self.ui.sb_bpm_charge.value() # in pC            amplitude = self.ui.sp_orbit_ampl.value()  # in mm            attenuation = self.ui.sb_attenuation.value() # attenuation            self.button_bpm.activate(max_charge_value=charge, max_pos_value=amplitude)            self.cavity_bpm.activate(attenuation=attenuation)        else:            logger.info("Unfreeze BPMs")            self.button_bpm.deactivate()            self.cavity_bpm.deactivate()    def show_orm(self):        if self.orbit is not None:            cor_list = [cor.id for cor in np.append(self.orbit.hcors, self.orbit.vcors)]            bpm_list = [bpm.id for bpm in self.orbit.bpms]            if self.orbit.response_matrix is None:                print("ORM is None in self.orbit")                return            df_slice = self.orbit.response_matrix.extract_df_slice(cor_list, bpm_list)            if df_slice is None:                print("df_slice is None. return")                return            shape = np.array(df_slice.shape)            print("ORM shape: " + str(shape))            if any(shape > 100):                self.parent.error_box("ORM is too large. Shape: " + str(shape))                return            ax = sns.heatmap(df_slice, annot=True)            ax.set_title("Orbit response matrix")            plt.show()    def analyse_corrections(self):        if self.parent.cor_analysis is not None:            if self.parent.cor_analysis.df is not None:                self.parent.cor_analysis.calculate_orm()    def update_machine_interface(self):        self.mi_orbit = self.parent.mi.devices.MIOrbit(server=self.parent.server, subtrain=self.parent.subtrain)        self.mi_orbit.mi = self.parent.mi        self.mi_orbit.bpm_server = self.parent.bpm_server        if getattr(self, "live_streamer", None) is not None:            # server or subtrain could be changed            release_streamer(self.live_streamer)            self.live_streamer = acquire_streamer(self.mi_orbit)        #self.mi_orbit.start()        self.xfel_mps = self.parent.mi.devices.MPS(server=self.parent.server, subtrain=self.parent.subtrain)        self.xfel_mps.mi = self.parent.mi                self.mi_charge_doocs = self.parent.mi.devices.ChargeDoocs(server=self.parent.server, subtrain=self.parent.subtrain)        self.mi_charge_doocs.mi = self.parent.mi        # wildcard reads of all magnets, only for machine interfaces which provide it        self.cor_bank = None        if hasattr(self.parent.mi.devices, "MICorrectorBank"):            self.cor_bank = self.parent.mi.devices.MICorrectorBank(server=self.parent.server, subtrain=self.parent.subtrain)            self.cor_bank.mi = self.parent.mi    def reset_undo_database(self):        self.undo_data_base = []    def run_awindow(self):        if self.adaptive_feedback is None:            self.adaptive_feedback = UIAFeedBack(orbit=self)        self.adaptive_feedback.show()    def uncheck_red(self):        """        Method to uncheck correctors if they are out of limits (red color in the GUI)        :return:        """        corrs = self.get_dev_from_cb_state(self.corrs)        for cor in corrs:            if cor.ui.alarm:                cor.ui.uncheck()        bpms = self.get_dev_from_cb_state(self.bpms)        for bpm in bpms:            if bpm.ui.alarm:                bpm.ui.uncheck()    def uncheck_aircols(self):        """        Method checks and unchecks corresponding aircoils downstream or upstream        :return:        """        upstream = self.ui.cb_caxy.isChecked()        downstream = self.ui.cb_cbxy.isChecked()        #corrs = self.get_dev_from_cb_state(self.corrs)        logger.debug("uncheck_aircoils: upstream / downstream: " + str(upstream) + "/" + str(downstream))        for cor in self.corrs:            #print(cor.id, upstream, downstream)            if ".SA1" in cor.id or (".SA3" in cor.id) or (".SA2" in cor.id):                if not upstream:                    if ("CAX." in cor.id) or ("CAY." in cor.id):                        cor.ui.uncheck()                if not downstream:                    if ("CBX." in cor.id) or ("CBY." in cor.id):                        cor.ui.uncheck()                if upstream:                    if ("CAX." in cor.id) or ("CAY." in cor.id):                        cor.ui.check()                if downstream:                    if ("CBX." in cor.id) or ("CBY." in cor.id):                        cor.ui.check()    def choose_plane(self):        """        Method checks and unchecks corresponding correctors in horizontal or/and vertical planes        :return:        """        x_plane = self.ui.cb_x_cors.isChecked()        y_plane = self.ui.cb_y_cors.isChecked()        if y_plane and not x_plane:            for cor in self.corrs:                if cor.__class__ == Hcor:                    cor.ui.uncheck()                    cor.ui.set_hide(True)                else:                    cor.ui.check()                    cor.ui.set_hide(False)        elif x_plane and not y_plane:            for cor in self.corrs:                if cor.__class__ == Hcor:                    cor.ui.check()                    cor.ui.set_hide(False)                else:                    cor.ui.uncheck()                    cor.ui.set_hide(True)        else:            for cor in self.corrs:                cor.ui.check()                cor.ui.set_hide(False)                # uncheck correctors from the ban list        self.uncheck_corrs(self.corrs, self.corrs4remove)    def reset_all(self):        """        Method to reset initial values of the correctors        :return:        """        corrs = self.get_dev_from_cb_state(self.corrs)        self.online_calc = False        for cor in corrs:            kick_mrad = cor.ui.get_init_value()            cor.ui.set_value(kick_mrad)        self.online_calc = True    def undo(self):        """        Method to reset initial values of the correctors        :return:        """        if len(self.undo_data_base) == 0:            return 0        self.online_calc = False        corrs_dict = self.undo_data_base[-1]        for cor in self.corrs:            if cor.id in corrs_dict.keys():                cor.ui.check()                kick_mrad = corrs_dict[cor.id]                cor.ui.set_init_value(kick_mrad)                cor.ui.set_value(kick_mrad)            else:                cor.ui.uncheck()        del self.undo_data_base[-1]        self.ui.pb_reset_all.setText("Undo (" + str(len(self.undo_data_base)) + ")")        self.online_calc = True    def save_correctors(self):        corrs_save = {}        for cor in self.corrs:            logger.debug("save correctors: " + cor.id + " " + str(cor.ui.get_init_value()))            corrs_save[cor.id] = cor.ui.get_init_value()                    with open("corrs_save.json", 'w') as f:            json.dump(corrs_save, f)    def restore_correctors(self):        with open("corrs_save.json", 'r') as f:            table = json.load(f)        cor_ids = [cor.id for cor in self.corrs]        self.online_calc = False        for cor_id in table.keys():            if cor_id in cor_ids:                inx = cor_ids.index(cor_id)                cor = self.corrs[inx]                cor.ui.set_value(table[cor.id])                logger.debug("restore correctors:" + cor.id +" before %s after %s" % (cor.ui.get_value(), table[cor.id]))        self.online_calc = True    def apply_kicks(self):        """        Methods sends correctors kicks to DOOCS, if strengths below the limits,        otherwise error box will appear        :return:        """        logger.info("Apply Kicks")        prepared = self.prepare_kicks(ask_zero=True)        if prepared is None:            return 0        corrs, kicks, snapshot = prepared        ok, report = self.write_kicks(corrs, kicks, snapshot)        self.finish_kicks(corrs, ok, report)    def prepare_kicks(self, ask_zero=True):        """        First step of apply_kicks() (GUI thread): checks limits and collects kicks of the checked correctors        :param ask_zero: if True and all kicks are zero, ask the user        :return: (corrs, kicks, snapshot) or None if kicks must not be applied        """        corrs = self.get_dev_from_cb_state(self.corrs)        for cor in corrs:            if cor.ui.alarm:                logger.info("apply_kicks: kick exceeds limits. Stop applying")                self.parent.error_box("kick exceeds limits. Try 'Uncheck Red' and recalculate correction")                return None        kicks = np.array([cor.ui.get_value() for cor in corrs])        if ask_zero and np.all(kicks == 0):            yes = self.parent.question_box("All kicks are zero. Apply?")            if not yes:                return None        for cor in corrs:            logger.debug("Apply kicks: " + cor.id + " set: %s --> %s" % (cor.ui.get_init_value(), cor.ui.get_value()))        # undo snapshot: if any write fails, the written correctors are set back to the initial kicks        snapshot = [cor.ui.get_init_value() for cor in corrs]        return corrs, kicks, snapshot    def write_kicks(self, corrs, kicks, snapshot):        """        Second step of apply_kicks(): machine I/O only, can be called from a worker thread        :param corrs: list of correctors        :param kicks: array of kicks [mrad]        :param snapshot: kicks for roll back        :return: ok, report (see MachineInterface.set_devices_transaction())        """        return self.parent.mi.set_devices_transaction([cor.mi for cor in corrs], kicks, snapshot=snapshot,                                                      verify=not self.dev_mode)    def finish_kicks(self, corrs, ok, report):        """        Last step of apply_kicks() (GUI thread): error box or undo database        :return:        """        if not ok:            failed = [dev_id for dev_id, res in report.items() if res["error"] is not None]            for dev_id in failed:                logger.error("Apply kick: corrector.id = " + dev_id + ", kick_mrad = " + str(report[dev_id]["value"]) + " " + report[dev_id]["error"])            rolled_back = [dev_id for dev_id, res in report.items() if res["rolled_back"]]            self.parent.error_box("Error during writing in DOOCS. Correctors: " + ", ".join(failed) +                                  ". Rolled back: " + str(len(rolled_back)) + " correctors. Repeat APPLY KICKS.")            return        dict_delta_kicks_rad = self.write_old_kicks(corrs)        # if self.parent.cor_analysis is not None and self.parent.mi.analyse_correction is True:        #     self.parent.cor_analysis.save_kicks(dict_delta_kicks_rad)        #     #self.parent.cor_analysis.used_correctors(corrs)        #     self.parent.cor_analysis.start()    def write_old_kicks(self, corrs):        """        Method to store a history of the applied kicks in self.undo_data_base.        secondary functionality is to store correctors dictionary with delta kick for analysis.        :param corrs: list of correcors (classes)        :return: dict_delta_kicks_rad, dictionary {"cor_id": delta_kick_in_rad, ...}        """        old_corrs_kicks = {}        dict_delta_kicks_rad = {}        save_flag = False        for cor in corrs:            # write to dict old kicker strengths            old_corrs_kicks[cor.id] = cor.ui.get_init_value()            dict_delta_kicks_rad[cor.id] = (cor.ui.get_value() - cor.ui.get_init_value())/1000 # mrad -> rad            if cor.ui.get_init_value() != cor.ui.get_value():                save_flag = True        if save_flag:            self.undo_data_base.append(old_corrs_kicks)            self.ui.pb_reset_all.setText("Undo (" + str(len(self.undo_data_base)) + ")")        return dict_delta_kicks_rad    def read_correctors_BESSY(self):        cor_names = [cor.id for cor in self.corrs]        self.parent.mi.corrector_data.connect(cor_names)        self.parent.mi.correctors_kick = self.parent.mi.corrector_data.get()        self.online_calc = False        for elem in self.corrs:            hw2phys = self.parent.mi.corr_conversion[elem.id][0]            elem.kick_mrad = elem.mi.get_value_from_dict()            elem.angle_read = elem.kick_mrad*hw2phys            elem.i_kick = elem.kick_mrad            elem.ui.set_init_value(elem.kick_mrad)            elem.ui.set_value(elem.kick_mrad)        self.online_calc = True        self.parent.lat.update_transfer_maps()    def read_corrector_bank(self, method, corrs, dev_func):        """        Method reads a property of the correctors with one wildcard request (MICorrectorBank).        Correctors which are missing in the wildcard reply are read device by device with dev_func,        as well as all correctors if the machine interface has no MICorrectorBank or the wildcard read failed.        :param method: MICorrectorBank method: "get_values", "get_limits" or "get_status"        :param corrs: list of correctors        :param dev_func: function(Corrector) - device by device version of method        :return: list of (result, exception) in the order of corrs        """        results = None        if self.cor_bank is not None and len(corrs) > 0:            try:                values, errors = getattr(self.cor_bank, method)([cor.mi for cor in corrs])                results = [(val, None) for val in values]            except Exception as e:                logger.warning(" read_corrector_bank: " + method + ": wildcard read failed: " + str(e))        if results is None:            return self.parent.mi.bulk_call(lambda cor: dev_func(cor.mi), [(cor,) for cor in corrs])        missing = [i for i, cor in enumerate(corrs) if cor.mi.id in errors]        retry = self.parent.mi.bulk_call(lambda cor: dev_func(cor.mi), [(corrs[i],) for i in missing])        for i, res in zip(missing, retry):            results[i] = res        return results    def read_correctors(self):        """        Method to read from MI correctors (angles: mrad->rad)        self.online_calc = False - switch off recalculating of the calculated orbit        otherwise after every set in table orbit will be recalculated.        :return:        """        self.set_corrector_kicks(self.fetch_corrector_kicks())    def fetch_corrector_kicks(self, corrs=None):        """        Machine I/O part of read_correctors(), can be called from a worker thread        :param corrs: list of correctors, None - self.corrs        :return: list of kicks [mrad] in the order of corrs        """        corrs = self.corrs if corrs is None else corrs        results = self.read_corrector_bank("get_values", corrs, lambda dev: dev.get_value())        errors = [(elem.id, exc) for elem, (kick, exc) in zip(corrs, results) if exc is not None]        if len(errors) > 0:            logger.error("read_correctors: could not read: " + str([name for name, exc in errors]))            raise errors[0][1]        return [kick for kick, exc in results]    def set_corrector_kicks(self, kicks):        """        Method writes the read kicks into the elements, the table and the lattice        :param kicks: list of kicks [mrad] in the order of self.corrs        :return:        """        self.online_calc = False        for elem, kick_mrad in zip(self.corrs, kicks):            elem.kick_mrad = kick_mrad            elem.angle_read = elem.mi.hw2phys(elem.kick_mrad)            elem.i_kick = elem.kick_mrad            elem.ui.set_init_value(elem.kick_mrad)            elem.ui.set_value(elem.kick_mrad)        self.online_calc = True        self.parent.lat.update_transfer_maps()    def read_orbit_one_by_one(self):        """        Method to readw from MI: correctors (angles: mrad->rad) and        BPMs (X and Y: mm -> m) and checks charge on the BPMs        if the charge below charge_thresh return False        :return: bool, True if the charge on all BPMs >= charge_thresh otherwise False        """        self.read_correctors()        charge_thresh = 0.005        bpms = self.get_dev_from_cb_state(self.bpms)        readings = self.parent.mi.bulk_call(lambda bpm: (bpm.mi.get_pos(), bpm.mi.get_charge()),                                            [(elem,) for elem in bpms])        beam_on = True        for elem, (reading, exc) in zip(bpms, readings):            try:                if exc is not None:                    raise exc                (x_mm, y_mm), charge = reading                if np.isnan(x_mm) or np.isnan(y_mm):                    logger.warning("read bpm: " + elem.id + "NaN -> was unchecked")                    elem.ui.uncheck()                if charge < charge_thresh:                    beam_on = False                if np.abs(charge/self.parent.bunch_charge) < self.parent.charge_tol/100:                    logger.info(" BPM:" + elem.id + " unchecked -> " +str(np.round(charge, 2)) + "/" + str(np.round(self.parent.bunch_charge, 2)) + " < " + str(self.parent.charge_tol/100))                    elem.ui.uncheck()                elem.x = x_mm/1000.                elem.y = y_mm/1000.                elem.ui.set_value((x_mm, y_mm))            except Exception as exc:                logger.error("read bpm: " + elem.id + " was unchecked.  Error: " + str(exc))                elem.ui.uncheck()        self.update_plot()        return beam_on    def read_orbit_star(self):        """        Method to readw from MI: correctors (angles: mrad->rad) and        BPMs (X and Y: mm -> m) and checks charge on the BPMs        if the charge below charge_thresh return False        :return: bool, True if the charge on all BPMs >= charge_thresh otherwise False        """        self.mi_orbit.read_and_average(nreadings=1, take_last_n=1)        return self.apply_orbit_reading(self.fetch_corrector_kicks())    def apply_orbit_reading(self, kicks):        """        Second part of read_orbit_star(): writes the orbit read by self.mi_orbit and the corrector kicks        into the elements, tables and plots and checks charge on the BPMs        :param kicks: list of kicks [mrad] in the order of self.corrs        :return: bool, True if the charge on all BPMs >= charge_thresh otherwise False        """        self.set_corrector_kicks(kicks)        charge_thresh = 0.005        bpms = self.get_dev_from_cb_state(self.bpms)        self.mi_orbit.get_bpms(bpms, state=self.orbit_state)        state = self.orbit_state        indx = state.rows(bpms)        x = state.x[indx]        y = state.y[indx]        charge = state.charge[indx]        beam_on = not np.any(charge < charge_thresh)        for i in np.flatnonzero(np.isnan(x) | np.isnan(y)):            logger.warning("read bpm: " + bpms[i].id + "NaN -> was unchecked")            bpms[i].ui.uncheck()        for i in np.flatnonzero(state.low_charge(self.parent.bunch_charge, self.parent.charge_tol)[indx]):            logger.info(" BPM:" + bpms[i].id + " unchecked -> " + str(np.round(charge[i], 2)) + "/" + str(np.round(self.parent.bunch_charge, 2)) + " < " + str(self.parent.charge_tol/100))            bpms[i].ui.uncheck()        for elem, x_mm, y_mm in zip(bpms, x*1000, y*1000):            elem.ui.set_value((x_mm, y_mm))        self.update_plot()        return beam_on    def read_orbit(self):        if self.parent.mi.allow_star_operation is True:            return self.read_orbit_star()        else:            return self.read_orbit_one_by_one()    def calc_orbit(self):        """        function calculates the orbit taking into account correctors strength        :return: None        """        if self.online_calc == False:            return        for elem in self.corrs:            elem.kick_mrad = elem.ui.get_value()            kick_mrad_i = elem.ui.get_init_value()            warn = (np.abs(elem.kick_mrad) - np.abs(elem.ui.get_init_value())) > 0.5            elem.ui.check_values(elem.kick_mrad, elem.lims, warn=warn)            #angle = (elem.kick_mrad - kick_mrad_i)/1000.            kick_mrad = (elem.kick_mrad - kick_mrad_i)            elem.angle = elem.mi.hw2phys(kick_mrad)            # transfer map is rebuilt only for correctors which were changed            angle_tm = self.cor_tm_angles.get(id(elem))            if angle_tm is not None and angle_tm == elem.angle:                continue            if angle_tm is None:                self.traj_valid = False            elif self.traj_valid:                self.traj.apply_kick(elem, elem.angle - angle_tm)            elem.transfer_map = self.parent.lat.method.create_tm(elem)            self.cor_tm_angles[id(elem)] = elem.angle        #self.update_cors_plot()        self.update_plot()    def invalidate_trajectory(self):        """        Method has to be called after optics changes (quads, cavities, lattice method or update_transfer_maps()).        The next update_plot() tracks the full lattice and the next calc_orbit() rebuilds transfer maps of all correctors.        :return:        """        self.traj_valid = False        self.cor_tm_angles = {}    def track_trajectory(self):        """        Method returns the trajectory on the lattice_track() grid.        The full tracking is done only after optics changes (see invalidate_trajectory()),        kick changes of single correctors are applied to the cached trajectory in calc_orbit().        With first order maps and without other kicks than the correctors the trajectory is calculated from        the stacked maps (orbit_math.linear_trajectory()) instead of lattice_track().        :return: s, x, y in [m]        """        # closed orbit and second order tracking are not linear in the kicks        first_order = getattr(self.parent.lat.method, "global_method", TransferMap) == TransferMap        if self.parent.mi.twiss_periodic is True:            p = match.closed_orbit(self.parent.lat)        elif self.traj_valid:            return self.traj.s, self.traj.x, self.traj.y        elif first_order and is_linear_sequence(self.parent.lat.sequence):            self.traj.update_optics(self.parent.lat, self.parent.tws0.E)            x, y = self.traj.track()            self.traj_valid = True            return self.traj.s, x, y        else:            p = Particle()        p.E = self.parent.tws0.E        p_list = lattice_track(self.parent.lat, p)        x = np.array([p.x for p in p_list])        y = np.array([p.y for p in p_list])        s = np.array([p.s for p in p_list])        if self.parent.mi.twiss_periodic is not True and first_order:            self.traj.update_optics(self.parent.lat, self.parent.tws0.E)            if len(self.traj.s) == len(s):                self.traj.set_trajectory(x, y)                self.traj_valid = True        return s, x, y    def create_Orbit_obj(self):        """        function creates the Orbit object with correctors and bpms which are active in the GUI        Orbit - is object form ocelot.cpbd.orbit_correction        :return: Orbit        """        self.orbit = Orbit(self.parent.lat, empty=True, rm_method=self.parent.mi.orm_method,                              disp_rm_method=self.parent.mi.drm_method)        # setup correction method        if self.parent.solver_name == "SVD":            self.orbit.orbit_solver = CachedOrbitSVD(epsilon_x=self.parent.svd_epsilon_x,                                  epsilon_y=self.parent.svd_epsilon_y, cache=self.solver_cache)        else:            self.orbit.orbit_solver = CachedMICADO(epsilon_x=self.parent.svd_epsilon_x,                                  epsilon_y=self.parent.svd_epsilon_y, epsilon_ksi=self.parent.epsilon_ksi,                                  cache=self.solver_cache)        # checking hardware of the correctors        self.check_hardware_status(self.corrs)        bpms, corrs = self.checked_devices()        if len(bpms) == 0:            self.parent.error_box("No BPM. Check SUBTRAIN.")            return None        if len(corrs) == 0:            self.parent.error_box("No correctors for correction")            return None                self.orbit.bpms = bpms        self.orbit.corrs = corrs        self.hcors = []        self.vcors = []        for cor in corrs:            if cor.__class__ == Hcor:                self.hcors.append(cor)            else:                self.vcors.append(cor)        self.orbit.hcors = self.hcors        self.orbit.vcors = self.vcors        self.orbit.orbit_solver.set_devices(bpms, self.hcors + self.vcors)        self.orbit.setup_response_matrix()        self.orbit.setup_disp_response_matrix()        return self.orbit    def checked_devices(self):        """        Checked BPMs and correctors. BPMs upstream of the first corrector and correctors downstream of the last BPM        are unchecked before if mi.uncheck_upstream_bpms is True.        :return: bpms, corrs        """        s_pos_min = np.min([cor.s for cor in self.corrs])        bpms = np.array(self.bpms)        corrs = np.array(self.corrs)        s_pos_max = np.max([bpm.s for bpm in bpms])        bpms_unch = bpms[np.array([bpm.s for bpm in self.bpms]) < s_pos_min]        corrs_unch = corrs[np.array([corr.s for corr in self.corrs]) > s_pos_max]        if self.parent.mi.uncheck_upstream_bpms:            [bpm.ui.uncheck() for bpm in bpms_unch]            [corr.ui.uncheck() for corr in corrs_unch]        return self.get_dev_from_cb_state(self.bpms), self.get_dev_from_cb_state(self.corrs)    def get_rm_cache(self):        """        Cache of response matrices in self.parent.rm_files_dir + "cache". The folder depends on the lattice config.        :return: ResponseMatrixCache or None        """        cache_dir = self.parent.rm_files_dir + "cache" + os.sep        if self.rm_cache is None or self.rm_cache.cache_dir != cache_dir:            try:                self.rm_cache = ResponseMatrixCache(cache_dir)            except Exception as e:                logger.warning("get_rm_cache: RM cache is not available: " + str(e))                self.rm_cache = None        return self.rm_cache    def optics_key(self, kind="RM"):        """        Fingerprint of the current optics for the RM cache        :param kind: "RM" or "DRM"        :return: str        """        method = self.parent.mi.orm_method if kind == "RM" else self.parent.mi.drm_method        return optics_fingerprint(self.parent.lat.sequence, tws0=self.parent.tws0,                                  extra=kind + ":" + getattr(method, "__name__", str(method)))    def rm_slice(self, cache, key, kind, cor_names, bpm_names):        """        :return: (matrix, cor_names, bpm_names) of the cached RM reduced to the devices or None        """        cached = cache.get(key, kind=kind, cor_names=cor_names, bpm_names=bpm_names)        if cached is None:            return None        return extract_matrix(*cached, cor_list=cor_names, bpm_list=bpm_names), list(cor_names), list(bpm_names)    def load_response_matrices_from_cache(self):        """        Method to load ORM and DRM from the RM cache for the current optics.        The slices for the checked devices are kept in self.rm_slices: a new Orbit object with the same devices        and optics does not read and slice the cache again. The slices are shared and must not be changed in place.        :return: True if the ORM is in the cache and False if not        """        cache = self.get_rm_cache()        if cache is None:            return False        cor_names = [cor.id for cor in self.orbit.corrs]        bpm_names = [bpm.id for bpm in self.orbit.bpms]        rm_key, drm_key = self.optics_key("RM"), self.optics_key("DRM")        slice_key = (rm_key, drm_key, tuple(cor_names), tuple(bpm_names))        slices = self.rm_slices.get(slice_key)        if slices is None:            rm_slice = self.rm_slice(cache, rm_key, "RM", cor_names, bpm_names)            if rm_slice is None:                return False            slices = (rm_slice, self.rm_slice(cache, drm_key, "DRM", cor_names, bpm_names))            self.rm_slices[slice_key] = slices            while len(self.rm_slices) > 8:                self.rm_slices.popitem(last=False)        else:            self.rm_slices.move_to_end(slice_key)        rm_slice, drm_slice = slices        set_matrix(self.orbit.response_matrix, *rm_slice)        if drm_slice is not None and self.orbit.disp_response_matrix is not None:            set_matrix(self.orbit.disp_response_matrix, *drm_slice)        else:            # no DRM of the current optics in the cache            logger.error("load_response_matrices_from_cache: No Dispersion Response Matrix for the current optics. Setting: self.orbit.disp_response_matrix = None")            self.orbit.disp_response_matrix = None        logger.debug("load_response_matrices_from_cache: RM is loaded from the cache")        return True    def import_response_matrices(self):        """        Method imports RM_<section>.p and DRM_<section>.p into the RM cache under the current optics if the cache        has no entry for it, e.g. the first start after the RM cache was introduced. The files are not bound        to the optics, they are used as before the RM cache.        :return: True if the ORM file was imported and False if not        """        cache = self.get_rm_cache()        if cache is None:            return False        section = self.ui.cb_lattice.currentText()        imported = False        for kind, rm in [("RM", self.orbit.response_matrix), ("DRM", self.orbit.disp_response_matrix)]:            key = self.optics_key(kind)            filename = self.parent.rm_files_dir + kind + "_" + section + ".p"            if rm is None or (key, kind) in cache or not os.path.isfile(filename):                continue            try:                rm.load(filename)                cache.put(key, rm.matrix, rm.cor_names, rm.bpm_names, kind=kind, section=section)            except Exception as e:                logger.warning("import_response_matrices: " + filename + " is not imported: " + str(e))                continue            logger.info("import_response_matrices: " + filename + " is imported into the RM cache")            imported = imported or kind == "RM"        return imported    def load_response_matrices(self):        """        Method to load ORM and DRM for the current optics from the RM cache.        If the cache has no ORM for the current optics, RM_<section>.p and DRM_<section>.p are imported        into the cache (import_response_matrices()).        :return: True if the ORM is loaded and False if not        """        if self.load_response_matrices_from_cache():            return True        if self.import_response_matrices() and self.load_response_matrices_from_cache():            return True        logger.error("load_response_matrices: No Response Matrix for the current optics. Calculate Response Matrix")        return False    def is_rm_ok(self, orbit):        """        Method to check and load if needed the RMs        :return: True -  if shape of the ORM (!) is correct (shape of the DRM is not checked)                 False - if the RM does not exist or RM load was failed        """        #print(len(self.orbit.response_matrix.matrix))        if len(self.orbit.response_matrix.matrix) == 0:            is_ok = self.load_response_matrices()            logger.debug("is_rm_ok: tring to load response matrix ... Is OK? " + str(is_ok))            if not is_ok:                return is_ok        cor_list = [cor.id for cor in np.append(orbit.hcors, orbit.vcors)]        bpm_list = [bpm.id for bpm in orbit.bpms]        RM = None        try:            RM = self.orbit.response_matrix.extract(cor_list=cor_list, bpm_list=bpm_list)        except:            self.parent.error_box(message="Problem with RM. Recalcualte it. Load all section from min position to maximum and manually select all correctors and BPms.")            return False        if np.shape(RM)[0] != len(bpm_list)*2 or np.shape(RM)[1] != len(cor_list):            return False        else:            return True    def close_orbit(self):        """        Method sets BPM.x_ref and BPM.y_ref from dictionary: self.golden_orbit        :return:        """        n_bpms = len(self.orbit.bpms)        if n_bpms < 10:            self.ui.cb_close_orbit.setChecked(False)        for i, elem in enumerate(self.orbit.bpms[-self.parent.co_nlast_bpms:]):            elem.x_ref = elem.x            elem.y_ref = elem.y            logger.debug("close_orbit: set BPM to ref orbit: " + elem.id)    def set_values2correctors(self):        apply_fraction = self.ui.sb_apply_fraction.value()        self.online_calc = False        for cor in self.corrs:            kick_mrad_old = cor.ui.get_init_value()            if cor.id in self.calc_correction.keys():                cor.angle = self.calc_correction[cor.id]            delta_kick_mrad = cor.mi.phys2hw(cor.angle)*apply_fraction            #delta_kick_mrad = cor.angle*1000*apply_fraction            #print(cor.angle*1000, delta_kick_mrad)            new_kick_mrad = kick_mrad_old + delta_kick_mrad            cor.kick_mrad =  new_kick_mrad            cor.ui.set_value(cor.kick_mrad)                        if np.abs(delta_kick_mrad) > 0.001:                self.ui.table_cor.item(cor.row, 1).setForeground(QtGui.QColor(255, 101, 101))  # red            else:                self.ui.table_cor.item(cor.row, 1).setForeground(QtGui.QColor(255, 255, 255))  # white                            warn = (np.abs(new_kick_mrad) - np.abs(kick_mrad_old)) > 0.5            cor.ui.check_values(cor.kick_mrad, cor.lims, warn)        self.online_calc = True        self.calc_orbit()    def single_shot_read_bpms(self):        # remove checking if the freeze checkBox is checked        # if not self.ui.cb_freeze_bpms.isChecked():        #     self.parent.error_box("Freeze BPMs first")        #     return        logger.info("Single Shot reading")                try:            self.read_correctors()        except Exception as e:            logger.critical("single_shot_read: read_correctors ERROR: " + str(e))            self.parent.error_box("Error in DOOCS during correctors reading")        self.xfel_mps.num_bunches_requested(num_bunches=1)        self.xfel_mps.beam_on()        time.sleep(0.2)        self.xfel_mps.beam_off()        time.sleep(0.5)        try:            self.mi_orbit.read_and_average(nreadings=1, take_last_n=1, reliable_reading=False, suffix=".HOLD")        except Exception as e:            logger.error("single_shot_orbit_read: mi_orbit.read_and_average()" + str(e))            raise        #time.sleep(0.1)                self.calculate_correction()    def multi_shot_read_bpms(self):        logger.info("Multi Shot reading")        try:            self.read_correctors()        except Exception as e:            logger.critical("multi_shot_read: read_correctors ERROR: " + str(e))            self.parent.error_box("Error in DOOCS during correctors reading")        self.xfel_mps.num_bunches_requested(num_bunches=1)                # first idle reading before real one.          #self.mi_orbit.read_and_average(nreadings=1, take_last_n=1)                self.xfel_mps.beam_on()        try:            self.mi_orbit.read_and_average(nreadings=self.parent.gc_nreadings, take_last_n=self.parent.gc_nlast, suffix="")        except Exception as e:            logger.error("read_bpms: mi_orbit.read_and_average() " + str(e))            raise        self.xfel_mps.beam_off()        self.calculate_correction()    def read_bpms(self):        if self.parent.single_shot_flag and (self.button_bpm != None and self.cavity_bpm != None):            self.single_shot_read_bpms()        else:            self.multi_shot_read_bpms()    def calculate_correction(self):        logger.debug("calculate_correction: .. ")        bpms = self.get_dev_from_cb_state(self.bpms)        checked_bpms_id = [bpm.id for bpm in bpms]        self.mi_orbit.get_bpms(bpms, state=self.orbit_state)        bpms = self.get_dev_from_cb_state(self.bpms)        charge_thresh = 0.005        state = self.orbit_state        indx = state.rows(bpms)        x = state.x[indx]        y = state.y[indx]        for i in np.flatnonzero(np.isnan(x) | np.isnan(y)):            logger.debug("calculate_correction: check BPM: " + bpms[i].id + " NAN -> was unchecked")            bpms[i].ui.uncheck()        for i in np.flatnonzero(state.charge[indx] < charge_thresh):            bpms[i].ui.uncheck()        for elem, x_mm, y_mm in zip(bpms, x*1000, y*1000):            elem.ui.set_value((x_mm, y_mm))        self.update_plot()                self.uncheck_red()        self.correct()        for elem in bpms:            if elem.id in checked_bpms_id:                elem.ui.check()        logger.debug("calculate_correction: .. OK")    def read_and_correct(self):        logger.debug("read_and_correct ... ")        self.read_orbit()        self.uncheck_red()        self.correct()        logger.debug("read_and_correct ... OK")    def correct(self, reset=True):        """        Method to the Orbit correction. Method calculate correctors strengths (kicks)        and call function to calculate (self.calc_orbit()) and draw orbit on the plot        but does not send it to the DOOCS server.        :return:        """        logger.info("correct: ... ")        if reset:            self.orbit = self.create_Orbit_obj()        if self.orbit is None:            return         if not self.is_rm_ok(self.orbit):            self.parent.error_box("Calculate Response Matrix")            return 0        self.golden_orbit.dict2golden_orbit()        if self.ui.cb_close_orbit.isChecked():            self.close_orbit()        if self.parent.mi.analyse_correction is True:            self.parent.cor_analysis.initialization(mi_orbit=self.mi_orbit, orbit=self.orbit)            self.parent.cor_analysis.get_snapshot()        self.calc_correction = {}        for cor in self.corrs:            cor.angle = 0.            self.calc_correction[cor.id] = cor.angle                alpha = self.ui.sb_alpha.value()        # print("PARAMS: ", self.parent.svd_epsilon_x, self.parent.svd_epsilon_y, self.parent.svd_beta)        self.orbit.correction(alpha=alpha, p_init=None, beta=self.parent.svd_beta, print_log=False)        self.invalidate_trajectory()        for cor in self.corrs:            self.calc_correction[cor.id] = cor.angle        self.set_values2correctors()        logger.info("correct: ... OK")    def start_stop_feedback(self):        """        Method to start/stop feedback timer.        sb_feedback_sec - spinBox - set seconds for timer        pb_feedback - pushBatton Off/On        feedback_timer - timer        :return:        """        period = self.ui.sb_feedback_sec.value()        if self.ui.pb_feedback.text() == "Orbit Keeper Off":            self.stop_orbit_keeper()        elif self.cb_feedback_daemon.isChecked():            if not self.feedback_client.is_available():                self.parent.error_box("Feedback daemon is not running. Start manul_feedback.py serve or uncheck 'Run in feedback daemon'")                return            self.start_remote_keeper()        else:            if self.feedback_client.is_available() and self.feedback_client.status()["running"]:                self.parent.error_box("Orbit Keeper is running in the feedback daemon. Check 'Run in feedback daemon' to attach to it")                return            # response matrices are loaded here, the cycles only take them from self.orbit (see keeper_settings())            self.orbit = self.create_Orbit_obj()            if self.orbit is None:                return            if not self.is_rm_ok(self.orbit):                self.parent.error_box("Calculate Response Matrix")                return            keeper = OrbitKeeper(self)            self.orbit_keeper = FeedbackEngine(cycle=keeper.cycle, period=period, name="Orbit Keeper",                                               stats_file="./logs/orbit_keeper_stats.json")            self.orbit_keeper.signals.cycle_done.connect(self.orbit_keeper_cycle_done)            self.orbit_keeper.signals.stopped.connect(self.orbit_keeper_stopped)            self.orbit_keeper.start()            self.ui.pb_feedback.setText("Orbit Keeper Off")            self.ui.pb_feedback.setStyleSheet("color: red")    def stop_orbit_keeper(self, stop_remote=True):        """        :param stop_remote: if False, the Orbit Keeper in the daemon keeps running (e.g. when the GUI is closed)        """        if self.orbit_keeper is not None:            self.orbit_keeper.stop()        if self.remote_keeper.isActive():            self.remote_keeper.stop()            if stop_remote:                try:                    self.feedback_client.stop()                except Exception as e:                    logger.error("stop_orbit_keeper: feedback daemon: " + str(e))        self.orbit_keeper_stopped("stopped")    def feedback_job(self):        """        Orbit Keeper job for the feedback daemon (see manul_feedback.FeedbackJob): checked devices,        golden orbit, solver settings and the RM of the current optics in the RM cache        :return: dictionary        """        cache = self.get_rm_cache()        if cache is None:            raise ValueError("RM cache is not available")        bpms, corrs = self.checked_devices()        # columns of the RM: horizontal and then vertical correctors        corrs = [cor for cor in corrs if cor.__class__ == Hcor] + [cor for cor in corrs if cor.__class__ != Hcor]        self.golden_orbit.dict2golden_orbit()        return {"name": "Orbit Keeper " + self.parent.subtrain, "server": self.parent.server,                "subtrain": self.parent.subtrain, "bpm_server": self.parent.bpm_server,                "bpms": [bpm.id for bpm in bpms], "corrs": [cor.id for cor in corrs],                "golden_orbit": {bpm.id: [bpm.x_ref, bpm.y_ref] for bpm in bpms},                "rm": {"cache_dir": cache.cache_dir, "key": self.optics_key("RM")},                "solver": self.parent.solver_name, "epsilon_x": self.parent.svd_epsilon_x,                "epsilon_y": self.parent.svd_epsilon_y, "epsilon_ksi": self.parent.epsilon_ksi,                "beta": self.parent.svd_beta, "weights": {bpm.id: getattr(bpm, "weight", 1.) for bpm in bpms},                "gain": self.ui.sb_apply_fraction.value(), "period": self.ui.sb_feedback_sec.value()}    def start_remote_keeper(self):        """        Method starts the Orbit Keeper in the feedback daemon with the current settings,        or attaches to it if it is already running. The GUI only polls the status.        """        try:            if not self.feedback_client.status()["running"]:                self.feedback_client.load_job(self.feedback_job())                self.feedback_client.start()        except Exception as e:            logger.error("start_remote_keeper: " + str(e))            self.parent.error_box("Feedback daemon: " + str(e))            return        self.remote_keeper.start(1000)        self.ui.pb_feedback.setText("Orbit Keeper Off")        self.ui.pb_feedback.setStyleSheet("color: red")    def poll_remote_keeper(self):        try:            status = self.feedback_client.status()            stats = self.feedback_client.stats()        except Exception as e:            self.remote_keeper.stop()            self.orbit_keeper_stopped("feedback daemon is not reachable: " + str(e))            return        if not status["running"]:            self.remote_keeper.stop()            self.orbit_keeper_stopped(status.get("reason", "stopped"))            return        self.ui.pb_feedback.setToolTip(format_stats(stats))    def keeper_settings(self):        """        Settings of one Orbit Keeper cycle (GUI thread, see orbit_keeper.OrbitKeeper.cycle()):        checked devices, golden orbit, response matrices and solver parameters. No machine I/O.        :return: KeeperSettings or None if there are no devices or no response matrix        """        if self.orbit is None or len(self.orbit.response_matrix.matrix) == 0:            return None        bpms, corrs = self.checked_devices()        if len(bpms) == 0 or len(corrs) == 0:            return None        self.golden_orbit.dict2golden_orbit()        close_orbit = self.ui.cb_close_orbit.isChecked()        if close_orbit and len(bpms) < 10:            self.ui.cb_close_orbit.setChecked(False)        alpha = self.ui.sb_alpha.value()        dispersion = None        if alpha != 0:            dispersion = np.append([getattr(bpm, "Dx", 0.) - getattr(bpm, "Dx_des", 0.) for bpm in bpms],                                   [getattr(bpm, "Dy", 0.) - getattr(bpm, "Dy_des", 0.) for bpm in bpms])        rm = self.orbit.response_matrix        drm = self.orbit.disp_response_matrix        if drm is not None:            drm = (drm.matrix, list(drm.cor_names), list(drm.bpm_names))        return KeeperSettings(bpms=bpms, corrs=corrs, all_corrs=list(self.corrs),                              x_ref=np.array([bpm.x_ref for bpm in bpms]), y_ref=np.array([bpm.y_ref for bpm in bpms]),                              weights=np.array([getattr(bpm, "weight", 1.) for bpm in bpms]), dispersion=dispersion,                              rm=(rm.matrix, list(rm.cor_names), list(rm.bpm_names)), drm=drm,                              solver_name=self.parent.solver_name, epsilon_x=self.parent.svd_epsilon_x,                              epsilon_y=self.parent.svd_epsilon_y, epsilon_ksi=self.parent.epsilon_ksi,                              alpha=alpha, beta=self.parent.svd_beta, gain=self.ui.sb_apply_fraction.value(),                              close_orbit=close_orbit, co_nlast_bpms=self.parent.co_nlast_bpms,                              bunch_charge=self.parent.bunch_charge, charge_tol=self.parent.charge_tol,                              star=self.parent.mi.allow_star_operation is True, dev_mode=self.dev_mode)    def apply_keeper_result(self, result):        """        Method shows a finished Orbit Keeper cycle in the tables and plots (GUI thread)        :param result: orbit_keeper.KeeperResult        :return:        """        if [cor.id for cor in self.corrs] != list(result.all_cor_ids):            logger.debug("apply_keeper_result: correctors were reloaded. Result is skipped")            return        for cor in self.corrs:            if cor.id in result.faults:                logger.warning(" harware_status fault: " + cor.id)                cor.ui.uncheck()                cor.ui.set_fault(True)        self.set_corrector_kicks(result.kicks_read)        readings = {bpm_id: i for i, bpm_id in enumerate(result.bpm_ids)}        for bpm in self.bpms:            i = readings.get(bpm.id)            if i is None:                continue            if bpm.id in result.unchecked_bpms:                logger.info(" BPM:" + bpm.id + " unchecked -> x = " + str(result.x[i]) + " y = " + str(result.y[i]) +                            " charge = " + str(np.round(result.charge[i], 2)))                bpm.ui.uncheck()            bpm.x = result.x[i]            bpm.y = result.y[i]            bpm.charge = result.charge[i]            bpm.ui.set_value((result.x[i] * 1000., result.y[i] * 1000.))        if result.kicks is not None:            corrs = {cor.id: cor for cor in self.corrs}            corrs = [corrs[cor_id] for cor_id in result.cor_ids]            self.online_calc = False            for cor, kick_mrad in zip(corrs, result.kicks):                cor.kick_mrad = kick_mrad                cor.ui.set_value(kick_mrad)                warn = (np.abs(kick_mrad) - np.abs(cor.ui.get_init_value())) > 0.5                cor.ui.check_values(kick_mrad, cor.lims, warn)            self.online_calc = True            if len(result.exceeded) > 0:                self.parent.error_box("kick exceeds limits. Try 'Uncheck Red' and recalculate correction")            elif result.ok is not None:                self.finish_kicks(corrs, result.ok, result.report)            self.calc_orbit()        self.update_plot()    def orbit_keeper_cycle_done(self, snapshot):        self.ui.pb_feedback.setToolTip(format_stats(snapshot.stats))        self.apply_keeper_result(snapshot.data)    def orbit_keeper_stopped(self, reason):        if reason != "stopped":            logger.warning("Orbit Keeper stopped: " + reason)        self.ui.pb_feedback.setStyleSheet("color: rgb(85, 255, 127);")        self.ui.pb_feedback.setText("Orbit Keeper On")    def get_dev_from_cb_state(self, devs):        """        Gets list of all pvs that have checked boxes.        Returns:                List of PV strings        """        checked_devs = []        for dev in devs:            state = dev.ui.state()            #print(dev.id, state)            if state == 2:                checked_devs.append(dev)        return checked_devs    def check_hardware_status(self, devs):        """        Check hardware status of the devices        Returns:                List of PV strings        """        checked_devs = []        status = self.read_corrector_bank("get_status", devs, lambda dev: dev.is_ok())        for dev, (is_ok, exc) in zip(devs, status):            if exc is not None:                logger.warning(" harware_status: could not read status: " + dev.id + " " + str(exc))                is_ok = False            if not is_ok and not self.dev_mode:                logger.warning(" harware_status fault: " + dev.id )                dev.ui.uncheck()                dev.ui.set_fault(True)            else:                dev.ui.set_fault(False)    def calc_response_matrix(self, do_DRM_calc=True):        """        Method is connected to pushBatton pb_calc_RM and creates ResponseMatrixCalculator        which calculates ORM and DRM in different thread        self.parent.rm_files_dir - name of directory for RMs sore        self.ui.cb_lattice.currentText() - name of the sections (e.g. "I1D, L1, SASE1 and so on)        The method also launchs the Qtimer self.rm_calc to controle when the thread        ResponseMatrixCalculator finishs the calculations        :return:        """        self.orbit = self.create_Orbit_obj()        if self.orbit == None:            return        self.RMs = ResponseMatrixCalculator(rm=self.orbit.response_matrix,                                      drm=self.orbit.disp_response_matrix)        self.RMs.do_DRM_calc = do_DRM_calc        self.ui.pb_correct_orbit.setText("RMs are calculated. Please Wait...")        self.ui.pb_correct_orbit.setStyleSheet("color: red")        self.RMs.tw_init = self.parent.tws0        self.RMs.rm_filename = self.parent.rm_files_dir + "RM_" + self.ui.cb_lattice.currentText() + ".p"        self.RMs.drm_filename = self.parent.rm_files_dir + "DRM_" + self.ui.cb_lattice.currentText() + ".p"        self.RMs.cache = self.get_rm_cache()        self.RMs.rm_key = self.optics_key("RM")        self.RMs.drm_key = self.optics_key("DRM")        self.RMs.section = self.ui.cb_lattice.currentText()        self.RMs.start()        self.rm_calc.start()    def is_rm_calc_alive(self):        """        Method to check if the ResponseMatrixCalculator thread is alive.        it is needed to change name and color of the pushBatton pb_calc_RM.        When RMs caclulation is finished. If the thread is dead QTimer self.rm_calc is stopped        :return:        """        if not self.RMs.is_alive():            self.ui.pb_correct_orbit.setStyleSheet("color: rgb(85, 255, 127);")            self.ui.pb_correct_orbit.setText("Read and Calculate")            self.rm_calc.stop()        else:            self.ui.pb_correct_orbit.setText("RMs are calculated (" + self.RMs.stage + " " +                                             str(int(self.RMs.progress*100)) + "%). Please Wait...")    def load_correctors(self):        """        """        self.corrs = self.load_devices(types=[Hcor, Vcor])        self.cor_model = self.parent.add_devs2table(self.corrs, w_table=self.ui.table_cor, calc_obj=self.calc_orbit,                                   spin_params=[-100, 100, 0.1], check_box=True)        self.cor_ampl = np.max(np.append(1, np.abs(np.array([q.kick_mrad for q in self.corrs]))))        self.ui.table_cor.horizontalHeader().setResizeMode(QtGui.QHeaderView.Stretch)    def load_bpms(self, lat):        devices = []        L = 0        for i, elem in enumerate(lat.sequence):            L += elem.l            if elem.__class__ in [Monitor]:                elem.s = L - elem.l/2.                devices.append(elem)                mi_dev = self.parent.mi.devices.BPM(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                mi_dev.mi = self.parent.mi                mi_dev.bpm_server = self.parent.bpm_server                elem.mi = mi_dev                elem.lat_inx = i                elem.x = 0                elem.y = 0                elem.Dx = 0                elem.Dy = 0                elem.Dx_des = 0                elem.Dy_des = 0                elem.weight = 1        return devices    def add_bpms2table(self, devs, w_table, check_box=False):        """        Initialize the UI table object.        x, y and active flags live in a DeviceStateModel (returned), the table is only a view on it.        """        self.spin_boxes = []        if getattr(w_table, "state_sync", None) is not None:            w_table.state_sync.detach()        w_table.state_sync = None        model = DeviceStateModel(ids=[dev.id for dev in devs], width=2)        model.set_values([(dev.x, dev.y) for dev in devs])        model.dirty = set()        w_table.setRowCount(0)        for row in range(len(devs)):            #eng = QtCore.QLocale(QtCore.QLocale.English, QtCore.QLocale.UnitedStates)            w_table.setRowCount(row + 1)            pv = devs[row].id            # put PV in the table            w_table.setItem(row, 0, QtGui.QTableWidgetItem(str(pv)))            # put start val in            w_table.setItem(row, 1, QtGui.QTableWidgetItem(str(devs[row].x)))            w_table.setItem(row, 2, QtGui.QTableWidgetItem(str(devs[row].y)))            #header = w_table.horizontalHeader()            #header.setStretchLastSection(True)            #header.setResizeMode(0, QtGui.QHeaderView.ResizeToContents)            if check_box:                checkBoxItem = QtGui.QTableWidgetItem()                # checkBoxItem.setBackgroundColor(QtGui.QColor(100,100,150))                checkBoxItem.setCheckState(QtCore.Qt.Checked)                flags = checkBoxItem.flags()                checkBoxItem.setFlags(flags)                w_table.setItem(row, 3, checkBoxItem)                #checkBoxItem.itemChanged.connect(self.calc_orbit)            devs[row].row = row            ui = self.parent.mi.devices.BPMUI()            ui.tableWidget = w_table            ui.model = model            ui.row = row            ui.col = 2            devs[row].ui = ui        if check_box:            w_table.state_sync = BPMTableSync(model, w_table)        else:            w_table.state_sync = BPMTableSync(model, w_table, check_col=None)        w_table.resizeColumnsToContents()        return model    def uncheck_bpms(self, bpms, bmps4uncheck):        for bpm in bpms:            if bpm.id in bmps4uncheck:                bpm.ui.uncheck()    def uncheck_corrs(self, corrs, cors4uncheck):        for cor in corrs:            if cor.id in cors4uncheck:                cor.ui.uncheck()    def load_orbit_devs(self):        self.bpms = self.load_bpms(lat=self.parent.lat)        self.bpm_model = self.add_bpms2table(self.bpms, w_table=self.ui.table_bpm, check_box=True)        self.uncheck_bpms(self.bpms, self.bpms4remove)        self.load_correctors()        self.uncheck_corrs(self.corrs, self.corrs4remove)        self.orbit_state.load(self.bpms, self.corrs)        self.invalidate_trajectory()        self.golden_orbit.copy_bpms(self.bpms)    def load_devices(self, types, load_all=False):        devices = []        mi_devs = {}        lat_seq = self.parent.lat.sequence        if load_all:            lat_seq = self.parent.big_sequence        L = 0        candidates = []        for i, elem in enumerate(lat_seq):            L += elem.l            if elem.__class__ in types:                elem.s = L - elem.l / 2.                if "ps_id" in elem.__dict__:                    if elem.ps_id not in mi_devs.keys():                        mi_dev = self.parent.mi.devices.Corrector(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                        mi_dev.mi = self.parent.mi                        elem.mi = mi_dev                        mi_devs[elem.ps_id] = mi_dev                    else:                        elem.mi = mi_devs[elem.ps_id]                else:                    mi_dev = self.parent.mi.devices.Corrector(eid=elem.id, server=self.parent.server, subtrain=self.parent.subtrain)                    mi_dev.mi = self.parent.mi                    elem.mi = mi_dev                candidates.append((i, elem))        limits = self.read_corrector_bank("get_limits", [elem for i, elem in candidates], lambda dev: dev.get_limits())        for (i, elem), (lims, exc) in zip(candidates, limits):            if exc is not None:                logger.error("load_devices: get_limits error, id = " + elem.id + str(exc))                continue            elem.lims = lims            self.parent.mi.add_conversion(elem)            #elem.kick_mrad = elem.angle* 1000.            elem.kick_mrad = elem.mi.phys2hw(elem.angle)            elem.i_kick = elem.kick_mrad            elem.lat_inx = i            if self.dev_mode:                elem.lims = [-1, 1]            if elem.__class__ == Hcor:                self.hcors.append(elem)            elif elem.__class__ == Vcor:                self.vcors.append(elem)            else:                logger.error("load_devices: wrong device type")            devices.append(elem)        return devices    def add_orbit_plot(self):        win = pg.GraphicsLayoutWidget()        self.plot_x = win.addPlot(row=0, col=0)        #win.ci.layout.setRowMaximumHeight(0, 200)        self.plot_x.showGrid(1, 1, 1)        self.plot_y = win.addPlot(row=1, col=0)        self.plot_x.setXLink(self.plot_y)        self.plot_y.showGrid(1, 1, 1)        self.plot_y.getAxis('left').enableAutoSIPrefix(enable=False)  # stop the auto unit scaling on y axes        layout = QtGui.QGridLayout()        layout.setContentsMargins(0, 0, 0, 0)        self.ui.w_orbit.setLayout(layout)        layout.addWidget(win, 0, 0)        self.plot_y.setAutoVisible(y=True)        self.plot_y.addLegend()        color = QtGui.QColor(0, 255, 255)        pen = pg.mkPen(color, width=3)        self.orb_y = pg.PlotCurveItem(x=[], y=[], pen=pen, name='Y calc', antialias=True)        self.plot_y.addItem(self.orb_y)        color = QtGui.QColor(255, 0, 0)        pen = pg.mkPen(color, width=4)        self.orb_y_ref = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', name='Y', antialias=True)        self.plot_y.addItem(self.orb_y_ref)        color = QtGui.QColor(255,165,0)        pen = pg.mkPen(color, width=3)        self.orb_y_golden = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush=(255, 165, 0), name='Y golden', antialias=True)        color = QtGui.QColor(0, 255, 0)        pen = pg.mkPen(color, width=2)        self.orb_y_live = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush="g", name='Y live')        self.plot_x.addLegend()        color = QtGui.QColor(0, 255, 255)        pen = pg.mkPen(color, width=3)        self.orb_x = pg.PlotCurveItem(x=[], y=[], pen=pen,  name='X calc', antialias=True)        self.plot_x.addItem(self.orb_x)        color = QtGui.QColor(255, 0, 0)        pen = pg.mkPen(color, width=4, symbolPen='o')        self.orb_x_ref = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', name='X', antialias=True)        self.plot_x.addItem(self.orb_x_ref)        color = QtGui.QColor(0, 255, 0)        pen = pg.mkPen(color, width=2)        self.orb_x_live = pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush="g", name='X live')        color = QtGui.QColor(255,165,0)        pen = pg.mkPen(color, width=3)        self.orb_x_golden= pg.PlotDataItem(x=[], y=[], pen=pen, symbol='o', symbolBrush=(255, 165, 0), name='X golden', antialias=True)        #self.plot_cor.sigRangeChanged.connect(self.zoom_signal)        #self.plot_cor.setYRange(-3, 3)        self.plot_x.sigRangeChanged.connect(self.zoom_signal)        self.plot_x.setYRange(-2, 2)        self.plot_y.setYRange(-2, 2)    def zoom_signal(self):        if len(self.corrs) == 0:            return        s_up = self.plot_y.viewRange()[0][0]        s_down = self.plot_y.viewRange()[0][1]        s_pos = np.array([q.s for q in self.corrs]) + self.parent.lat_zi        s_up = s_up if s_up <= s_pos[-1] else s_pos[-1]        s_down = s_down if s_down >= s_pos[0] else s_pos[0]        s_bpm_pos = np.array([q.s for q in self.bpms]) + self.parent.lat_zi        s_bpm_up = s_up if s_up <= s_bpm_pos[-1] else s_bpm_pos[-1]        s_bpm_down = s_down if s_down >= s_bpm_pos[0] else s_bpm_pos[0]        indexes = np.arange(np.argwhere(s_pos >= s_up)[0][0], np.argwhere(s_pos <= s_down)[-1][0] + 1)        mask = np.ones(len(self.corrs), np.bool)        mask[indexes] = 0        self.corrs = np.array(self.corrs)        [q.ui.set_hide(hide=False) for q in self.corrs[indexes]]        [q.ui.set_hide(hide=True) for q in self.corrs[mask]]        #[q.ui.check() for q in self.corrs[indexes]]        #[q.ui.uncheck() for q in self.corrs[mask]]        s_bpm_pos = np.array([q.s for q in self.bpms]) + self.parent.lat_zi        s_bpm_up = s_bpm_up if s_bpm_up <= s_bpm_pos[-1] else s_bpm_pos[-1]        s_bpm_down = s_bpm_down if s_bpm_down >= s_bpm_pos[0] else s_bpm_pos[0]        indexes_bpm = np.arange(np.argwhere(s_bpm_pos >= s_bpm_up)[0][0], np.argwhere(s_bpm_pos <= s_bpm_down)[-1][0] + 1)        mask_bpm = np.ones(len(self.bpms), np.bool)        mask_bpm[indexes_bpm] = 0        self.bpms = np.array(self.bpms)        [q.ui.set_hide(hide=False) for q in self.bpms[indexes_bpm]]        [q.ui.set_hide(hide=True) for q in self.bpms[mask_bpm]]    def start_stop_live_orbit(self):        if self.ui.pb_online_orbit.text() == "Live Orbit Off":            self.parent.timer_live.stop()            self.stop_live_streamer()            self.ui.pb_online_orbit.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_online_orbit.setText("Live Orbit On")            self.plot_x.removeItem(self.orb_x_live)            self.plot_y.removeItem(self.orb_y_live)            self.plot_x.legend.removeItem(self.orb_x_live.name())            self.plot_y.legend.removeItem(self.orb_y_live.name())        else:            if self.live_streamer is None:                self.live_streamer = acquire_streamer(self.mi_orbit)            self.parent.timer_live.start(200)            self.ui.pb_online_orbit.setText("Live Orbit Off")            self.ui.pb_online_orbit.setStyleSheet("color: rgb(85, 255, 127);")            self.plot_x.addItem(self.orb_x_live)            self.plot_y.addItem(self.orb_y_live)    def start_stop_calc_orbit(self):        if self.ui.pb_calc_orb.text() == "Calc Orb Off":            self.plot_x.removeItem(self.orb_x)            self.plot_y.removeItem(self.orb_y)            self.plot_x.legend.removeItem(self.orb_x.name())            self.plot_y.legend.removeItem(self.orb_y.name())            self.ui.pb_calc_orb.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_calc_orb.setText("Calc Orb On")        else:            self.ui.pb_calc_orb.setText("Calc Orb Off")            self.ui.pb_calc_orb.setStyleSheet("color: rgb(255, 0, 0);")                        self.plot_x.addItem(self.orb_x)            self.plot_y.addItem(self.orb_y)            self.update_plot()                def start_stop_ref_orbit(self):        if self.ui.pb_ref_orb.text() == "Ref Orb Off":            self.plot_x.removeItem(self.orb_x_ref)            self.plot_y.removeItem(self.orb_y_ref)            self.plot_x.legend.removeItem(self.orb_x_ref.name())            self.plot_y.legend.removeItem(self.orb_y_ref.name())            self.ui.pb_ref_orb.setStyleSheet("color: rgb(85, 255, 255);")            self.ui.pb_ref_orb.setText("Ref Orb On")        else:            self.ui.pb_ref_orb.setText("Ref Orb Off")            self.ui.pb_ref_orb.setStyleSheet("color: rgb(255, 0, 0);")                        self.plot_x.addItem(self.orb_x_ref)            self.plot_y.addItem(self.orb_y_ref)            self.update_plot()     def stop_live_streamer(self):        if self.live_streamer is not None:            release_streamer(self.live_streamer)            self.live_streamer = None    def live_orbit(self):        """        Plots the latest orbit of the OrbitStreamer, the control system is not read here        """        if self.live_streamer is None:            return        snapshot = self.live_streamer.latest()        if snapshot is None:            return        bpms = self.get_dev_from_cb_state(self.bpms)        #print(self.xfel_mps.is_beam_on())        if self.xfel_mps.is_beam_on() != 1 and not self.dev_mode:            logger.info("live_orbit: beam off. return ")            return        indx, found = snapshot_indices(snapshot, [elem.id for elem in bpms])        bpms = [elem for elem, ok in zip(bpms, found) if ok]        indx = indx[found]        s_bpm = np.array([elem.s for elem in bpms]) + self.parent.lat_zi        x_bpm = snapshot.x[indx] - np.array([elem.x_ref for elem in bpms])*1000        y_bpm = snapshot.y[indx] - np.array([elem.y_ref for elem in bpms])*1000        self.orb_x_live.setData(x=s_bpm, y=x_bpm)        self.orb_y_live.setData(x=s_bpm, y=y_bpm)        self.orb_y.update()        self.orb_x.update()    def update_plot(self):        #start = time.time()        start = time.time()        s, x, y = self.track_trajectory()        print("update plot: traj calculation ", time.time() - start)        #print("3 = ", start - time.time())        x = x*1000        y = y*1000        s = s + self.parent.lat_zi        bpms = self.get_dev_from_cb_state(self.bpms)        s_bpm = np.array([bpm.s for bpm in bpms]) + self.parent.lat_zi        x_bpm = np.array([bpm.x - bpm.x_ref for bpm in bpms])*1000        y_bpm = np.array([bpm.y - bpm.y_ref for bpm in bpms])*1000        indx = np.searchsorted(s, s_bpm)        x_bpms_track = x[indx]        y_bpms_track = y[indx]        # Line        self.orb_x_ref.setData(x=s_bpm, y=x_bpm)        self.orb_y_ref.setData(x=s_bpm, y=y_bpm)        if self.parent.show_correction_result: #otherwise "changes"            self.orb_x.setData(x=s_bpm, y=x_bpm + x_bpms_track)            self.orb_y.setData(x=s_bpm, y=y_bpm + y_bpms_track)        else:            self.orb_x.setData(x=s, y=x)            self.orb_y.setData(x=s, y=y)        #self.orb_y.setData(x=s, y=y)        #self.plot_cor.update()        self.orb_y.update()        self.orb_x.update()    def uncheckBoxes(self):        """ Method to unchecked all active boxes """        for cor in self.corrs:            cor.ui.uncheck()    def getRows(self, state, widget):        """        Method to set the UI checkbox state from slected rows.        Loops though the rows and gets the selected state from the 'Active" column.        If highlighted, check box is set the the 'state' input arg.        Args:                state (bool): Bool of whether the boxes should be checked or unchecked.        """        rows=[]        for idx in widget.selectedIndexes():            rows.append(idx.row())            item = widget.item(idx.row(), 3)            if item.flags() == QtCore.Qt.NoItemFlags:                print("item disabled")                continue            item.setCheckState(state)
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+Orbit Keeper cycle of the FeedbackEngine worker.
+
+Reading of the correctors and the BPMs, the solve, the limits check and the write run in the worker thread on
+an OrbitState and arrays. The solve is orbit_math.correction_angles(): the same combination of ORM, DRM and kick
+penalty as Orbit.correction() of the GUI, without touching the elements or the lattice.
+The GUI thread only provides the settings of a cycle (KeeperSettings, one engine.gui.call() with a timeout)
+and gets the finished cycle (KeeperResult) through FeedbackEngine.signals.cycle_done.
+"""
+import numpy as np
+import logging
+from collections import namedtuple
+from orbit_state import OrbitState
+from orbit_math import extract_matrix, correction_angles, matrix_fingerprint, SolverCache, CachedOrbitSVD, CachedMICADO
+
+logger = logging.getLogger(__name__)
+
+GUI_TIMEOUT = 5.        # [sec], waiting for the settings from the GUI thread
+CHARGE_THRESH = 0.005   # [nC], beam is off if the charge on a BPM is below
+
+
+KeeperSettings = namedtuple("KeeperSettings", ["bpms", "corrs", "all_corrs", "x_ref", "y_ref", "weights",
+                                               "dispersion", "rm", "drm", "solver_name", "epsilon_x", "epsilon_y",
+                                               "epsilon_ksi", "alpha", "beta", "gain", "close_orbit",
+                                               "co_nlast_bpms", "bunch_charge", "charge_tol", "star", "dev_mode"])
+KeeperSettings.__doc__ = """
+Settings of one Orbit Keeper cycle, collected in the GUI thread (OrbitInterface.keeper_settings())
+
+:param bpms: checked BPMs (elements are only read in the worker: id, mi)
+:param corrs: checked correctors
+:param all_corrs: all correctors of the table, their kicks are read for the table
+:param x_ref: array of the golden orbit of bpms [m]
+:param y_ref: array [m]
+:param weights: array of BPM weights
+:param dispersion: array (2*nbpms) Dx - Dx_des, Dy - Dy_des or None if alpha == 0
+:param rm: (matrix, cor_names, bpm_names) of the ORM
+:param drm: (matrix, cor_names, bpm_names) of the DRM or None
+:param solver_name: "SVD" or "MICADO"
+:param alpha: trade off between orbit and dispersion correction
+:param beta: weight for suppression of large kicks
+:param gain: fraction of the correction which is applied
+:param close_orbit: if True, the golden orbit of the last co_nlast_bpms BPMs is the measured orbit
+:param star: if True, the orbit is read with one wildcard request
+:param dev_mode: if True, hardware faults of the correctors are ignored
+"""
+
+KeeperResult = namedtuple("KeeperResult", ["bpm_ids", "x", "y", "charge", "unchecked_bpms", "all_cor_ids",
+                                           "kicks_read", "faults", "cor_ids", "kicks", "exceeded", "ok", "report"])
+KeeperResult.__doc__ = """
+Finished Orbit Keeper cycle for the GUI thread (OrbitInterface.apply_keeper_result())
+
+:param bpm_ids: ids of the read BPMs
+:param x: array of x [m]
+:param y: array of y [m]
+:param charge: array of charges [nC]
+:param unchecked_bpms: ids of BPMs without valid reading (NaN, missing or low charge)
+:param all_cor_ids: ids of all correctors
+:param kicks_read: array of the read kicks of all correctors [mrad]
+:param faults: ids of correctors with hardware fault
+:param cor_ids: ids of the corrected correctors (empty if there was no correction)
+:param kicks: array of new kicks [mrad] or None
+:param exceeded: ids of correctors with kicks out of the limits, nothing is written then
+:param ok: result of the write or None if nothing was written
+:param report: report of MachineInterface.set_devices_transaction() or None
+"""
+
+
+class OrbitKeeper:
+    """
+    Worker part of the Orbit Keeper. The OrbitInterface is only used for machine I/O and for the settings.
+
+    :param interface: OrbitInterface
+    """
+    def __init__(self, interface):
+        self.interface = interface
+        # the solver cache of the GUI is not shared with the worker
+        self.solver_cache = SolverCache()
+        self.matrices = None
+        self.matrices_fingerprint = None
+
+    def create_solver(self, settings):
+        if settings.solver_name == "SVD":
+            return CachedOrbitSVD(epsilon_x=settings.epsilon_x, epsilon_y=settings.epsilon_y, cache=self.solver_cache)
+        return CachedMICADO(epsilon_x=settings.epsilon_x, epsilon_y=settings.epsilon_y,
+                            epsilon_ksi=settings.epsilon_ksi, cache=self.solver_cache)
+
+    def matrix_key(self, settings):
+        """
+        Key of the RM and DRM of the settings for the solver cache. The GUI passes the same arrays until the
+        response matrices are loaded again, the matrices are only hashed when other arrays come.
+
+        :param settings: KeeperSettings
+        :return: tuple
+        """
+        matrices = (settings.rm[0], None if settings.drm is None else settings.drm[0])
+        if self.matrices is None or any(a is not b for a, b in zip(matrices, self.matrices)):
+            self.matrices = matrices
+            self.matrices_fingerprint = matrix_fingerprint(*matrices)
+        drm_names = None if settings.drm is None else (tuple(settings.drm[1]), tuple(settings.drm[2]))
+        return self.matrices_fingerprint, tuple(settings.rm[1]), tuple(settings.rm[2]), drm_names
+
+    def read_correctors(self, settings):
+        """
+        :return: kicks of all correctors [mrad], ids of the checked correctors with hardware fault
+        """
+        kicks = self.interface.fetch_corrector_kicks(settings.all_corrs)
+        faults = []
+        if not settings.dev_mode:
+            status = self.interface.read_corrector_bank("get_status", settings.corrs, lambda dev: dev.is_ok())
+            for cor, (is_ok, exc) in zip(settings.corrs, status):
+                if exc is not None:
+                    logger.warning(" OrbitKeeper: could not read status: " + cor.id + " " + str(exc))
+                if exc is not None or not is_ok:
+                    faults.append(cor.id)
+        return kicks, faults
+
+    def read_orbit(self, settings, state):
+        """
+        Method reads the orbit of settings.bpms into the state
+        """
+        if settings.star:
+            mi_orbit = self.interface.mi_orbit
+            mi_orbit.read_and_average(nreadings=1, take_last_n=1)
+            state.set_orbit(mi_orbit.bpm_names, mi_orbit.mean_x, mi_orbit.mean_y, mi_orbit.mean_charge)
+            return
+        readings = self.interface.parent.mi.bulk_call(lambda bpm: (bpm.mi.get_pos(), bpm.mi.get_charge()),
+                                                       [(bpm,) for bpm in settings.bpms])
+        nbpms = len(settings.bpms)
+        x, y, charge = np.full(nbpms, np.nan), np.full(nbpms, np.nan), np.full(nbpms, np.nan)
+        for i, (bpm, (reading, exc)) in enumerate(zip(settings.bpms, readings)):
+            if exc is not None:
+                logger.error(" OrbitKeeper: read bpm: " + bpm.id + " Error: " + str(exc))
+                continue
+            (x[i], y[i]), charge[i] = reading
+        state.set_orbit([bpm.id for bpm in settings.bpms], x, y, charge)
+
+    def solve(self, settings, state, use, faults):
+        """
+        :param settings: KeeperSettings
+        :param state: OrbitState with the orbit and the read kicks
+        :param use: mask of BPMs with valid reading
+        :param faults: ids of correctors which are not used
+        :return: corrs, new kicks [mrad]
+        """
+        bpm_ids = [bpm.id for bpm, valid in zip(settings.bpms, use) if valid]
+        corrs = [cor for cor in settings.corrs if cor.id not in faults]
+        # columns of the RM: horizontal and then vertical correctors
+        corrs = [cor for cor in corrs if cor.__class__.__name__ == "Hcor"] + \
+                [cor for cor in corrs if cor.__class__.__name__ != "Hcor"]
+        if len(bpm_ids) == 0 or len(corrs) == 0:
+            raise ValueError("no BPMs or correctors for the correction")
+        cor_ids = [cor.id for cor in corrs]
+
+        x_ref = np.array(settings.x_ref, dtype=float)
+        y_ref = np.array(settings.y_ref, dtype=float)
+        if settings.close_orbit:
+            last = np.flatnonzero(use)[-settings.co_nlast_bpms:]
+            x_ref[last] = state.x[last]
+            y_ref[last] = state.y[last]
+        orbit = np.append(state.x[use] - x_ref[use], state.y[use] - y_ref[use])
+
+        rm = extract_matrix(*settings.rm, cor_list=cor_ids, bpm_list=bpm_ids)
+        drm = None
+        dispersion = None
+        if settings.alpha != 0:
+            if settings.drm is not None:
+                drm = extract_matrix(*settings.drm, cor_list=cor_ids, bpm_list=bpm_ids)
+            nbpms = len(settings.bpms)
+            dispersion = np.append(settings.dispersion[:nbpms][use], settings.dispersion[nbpms:][use])
+
+        solver = self.create_solver(settings)
+        solver.set_devices([bpm for bpm, valid in zip(settings.bpms, use) if valid], corrs)
+        solver.set_matrix_key(self.matrix_key(settings))
+        angles = correction_angles(rm, orbit, solver, alpha=settings.alpha, beta=settings.beta, drm=drm,
+                                   dispersion=dispersion, weights=np.asarray(settings.weights)[use])
+        kicks_init = state.kick_init[[state.cor_index[cor_id] for cor_id in cor_ids]]
+        kicks = kicks_init + np.array([cor.mi.phys2hw(angle) for cor, angle in zip(corrs, angles)]) * settings.gain
+        return corrs, kicks_init, kicks
+
+    def cycle(self, engine):
+        """
+        One cycle of the Orbit Keeper (FeedbackEngine worker thread)
+
+        :param engine: FeedbackEngine
+        :return: KeeperResult or None
+        """
+        budget = engine.budget
+        try:
+            settings = engine.gui.call(self.interface.keeper_settings, timeout=GUI_TIMEOUT)
+        except TimeoutError:
+            engine.stop("GUI thread does not respond")
+            return None
+        if settings is None:
+            engine.stop("no devices or response matrix for the correction")
+            return None
+
+        state = OrbitState(bpms=settings.bpms, corrs=settings.all_corrs)
+        with budget.stage("read"):
+            kicks_read, faults = self.read_correctors(settings)
+            state.set_kicks(kicks_read, init=True)
+            self.read_orbit(settings, state)
+
+        with budget.stage("estimate"):
+            found = state.active.copy()
+            invalid = ~found | np.isnan(state.x) | np.isnan(state.y)
+            invalid |= state.low_charge(settings.bunch_charge, settings.charge_tol)
+            beam_on = not np.any(state.charge[found] < CHARGE_THRESH)
+        result = KeeperResult(bpm_ids=tuple(state.bpm_names), x=state.x.copy(), y=state.y.copy(),
+                              charge=state.charge.copy(),
+                              unchecked_bpms=tuple(np.array(state.bpm_names)[invalid]),
+                              all_cor_ids=tuple(state.cor_names), kicks_read=state.kick_init.copy(),
+                              faults=tuple(faults), cor_ids=(), kicks=None, exceeded=(), ok=None, report=None)
+        if not beam_on:
+            logger.info(" OrbitKeeper: no beam")
+            engine.sleep(min(1., max(0., budget.remaining())))
+            return result
+
+        with budget.stage("solve"):
+            try:
+                corrs, kicks_init, kicks = self.solve(settings, state, ~invalid, faults)
+            except ValueError as e:
+                engine.stop(str(e))
+                return result
+            exceeded = tuple(cor.id for cor, kick in zip(corrs, kicks) if not (cor.lims[0] <= kick <= cor.lims[1]))
+        result = result._replace(cor_ids=tuple(cor.id for cor in corrs), kicks=kicks, exceeded=exceeded)
+        if len(exceeded) > 0:
+            engine.stop("kick exceeds limits")
+            return result
+
+        with budget.stage("write"):
+            ok, report = self.interface.write_kicks(corrs, kicks, list(kicks_init))
+        # settling of the magnets
+        with budget.stage("settle"):
+            engine.sleep(0.5)
+        return result._replace(ok=ok, report=report)
@@ -3,7 +3,11 @@ S.Tomin, 2018, DESY/XFEL. Prototype of a class with all orbit correction math
 """
 import numpy as np
 from threading import Thread, Event
+from collections import OrderedDict
+import hashlib
 import logging
+from scipy.linalg import qr, qr_insert, qr_delete, block_diag
+from ocelot.cpbd.orbit_correction import OrbitSVD, MICADO
 
 
 logger = logging.getLogger(__name__)
@@ -77,3 +81,693 @@ class OrbitReader(Thread):
         self.read_correctors(corrs)
         beam_on = self.read_bpms(bpms)
         self.update_plot()
+
+
+def element_rmatrices(sequence, energy):
+    """
+    First order transfer matrices of all elements of the sequence
+
+    :param sequence: list of ocelot elements with transfer maps (MagneticLattice.sequence)
+    :param energy: beam energy at the sequence entrance [GeV]
+    :return: R - array (n_elem, 6, 6), E - array of energies at element exits, s - array of element exit positions
+    """
+    n = len(sequence)
+    R = np.zeros((n, 6, 6))
+    E = np.zeros(n)
+    s = np.zeros(n)
+    L = 0.
+    for i, elem in enumerate(sequence):
+        tm = elem.transfer_map
+        R[i] = tm.R(energy)
+        energy += tm.delta_e
+        L += elem.l
+        E[i] = energy
+        s[i] = L
+    return R, E, s
+
+
+def prefix_matmul(M):
+    """
+    Cumulative products C[i] = M[i] @ ... @ M[0] as a parallel prefix scan: log2(n) batched matmuls
+    instead of n single products
+
+    :param M: array (n, k, k)
+    :return: array (n, k, k)
+    """
+    C = np.array(M, dtype=float)
+    step = 1
+    while step < len(C):
+        # C[i] holds the product of M[i - step + 1 .. i], the right hand side is evaluated before assignment
+        C[step:] = np.matmul(C[step:], C[:-step])
+        step *= 2
+    return C
+
+
+def cumulative_rmatrices(R):
+    """
+    Cumulative products R_cum[i] = R[i] @ ... @ R[0] - map from the sequence entrance to the exit of element i
+
+    :param R: array (n_elem, 6, 6)
+    :return: array (n_elem, 6, 6)
+    """
+    return prefix_matmul(R)
+
+
+def is_linear_sequence(sequence):
+    """
+    Check if the first order trajectory of the sequence is the response to the corrector kicks only:
+    no coupler kicks of cavities, no element offsets and no tilted correctors
+
+    :param sequence: list of elements
+    :return: True/False
+    """
+    for elem in sequence:
+        if getattr(elem, "coupler_kick", False):
+            return False
+        if getattr(elem, "dx", 0.) != 0. or getattr(elem, "dy", 0.) != 0.:
+            return False
+        if elem.__class__.__name__ in ("Hcor", "Vcor") and getattr(elem, "tilt", 0.) != 0.:
+            return False
+    return True
+
+
+def linear_trajectory(sequence, R_cum, X0=None):
+    """
+    First order trajectory with corrector kicks, vectorized: kicks are transformed back to the sequence entrance,
+    summed up and transported to every point with one batched product
+
+    :param sequence: list of elements, correctors with attribute "angle" [rad]
+    :param R_cum: array (n_elem + 1, 6, 6) of maps from the entrance to the entrance (R_cum[0]) and element exits
+    :param X0: initial coordinates (x, px, y, py, tau, p) or None
+    :return: array (n_elem + 1, 6) of coordinates at the sequence entrance and element exits
+    """
+    W = np.zeros((len(R_cum), 6))
+    if X0 is not None:
+        W[0] = X0
+    for i, elem in enumerate(sequence):
+        name = elem.__class__.__name__
+        angle = getattr(elem, "angle", 0.)
+        if name not in ("Hcor", "Vcor") or angle == 0.:
+            continue
+        plane = 2 if name == "Vcor" else 0
+        # thick corrector: at the exit offset angle*l/2 and angle
+        W[i + 1, plane] = angle * elem.l / 2.
+        W[i + 1, plane + 1] = angle
+    kicked = np.flatnonzero(np.any(W[1:] != 0., axis=1)) + 1
+    if len(kicked) > 0:
+        W[kicked] = np.linalg.solve(R_cum[kicked], W[kicked][:, :, np.newaxis])[:, :, 0]
+    return np.matmul(R_cum, np.cumsum(W, axis=0)[:, :, np.newaxis])[:, :, 0]
+
+
+class TrajectoryResponse:
+    """
+    Incremental trajectory calculation. The cumulative first order transfer maps are calculated once
+    per optics change (update_optics()), afterwards a kick change of one corrector is a rank-1 update
+    of the trajectory: delta_angle * column of R12/R34 from the corrector to every downstream point.
+
+    Points of the trajectory are the sequence entrance and element exits (the same grid as lattice_track()).
+    """
+    def __init__(self, lat=None, energy=None):
+        self.s = np.array([])
+        self.x = np.array([])
+        self.y = np.array([])
+        self.columns = {}
+        self.elem_index = {}
+        if lat is not None:
+            self.update_optics(lat, energy)
+
+    def update_optics(self, lat, energy):
+        """
+        Method caches cumulative maps. Must be called after lat.update_transfer_maps() if quads/cavities changed.
+
+        :param lat: MagneticLattice
+        :param energy: energy at the lattice entrance [GeV]
+        :return:
+        """
+        self.sequence = lat.sequence
+        R, E, s = element_rmatrices(self.sequence, energy)
+        self.E = np.append(energy, E)
+        self.s = np.append(0., s)
+        self.R_cum = np.append(np.eye(6)[np.newaxis], cumulative_rmatrices(R), axis=0)
+        self.elem_index = {id(elem): i + 1 for i, elem in enumerate(self.sequence)}
+        self.columns = {}
+        self.x = np.zeros(len(self.s))
+        self.y = np.zeros(len(self.s))
+        logger.debug(" TrajectoryResponse: update_optics: n points = " + str(len(self.s)))
+
+    def set_trajectory(self, x, y):
+        """
+        Method sets the reference trajectory (e.g. after full tracking with lattice_track)
+
+        :param x: array of x at the sequence entrance and element exits [m]
+        :param y: array of y at the sequence entrance and element exits [m]
+        :return:
+        """
+        self.x = np.array(x, dtype=float)
+        self.y = np.array(y, dtype=float)
+
+    def track(self, X0=None):
+        """
+        Method sets the reference trajectory from the cached maps and the corrector angles, replaces lattice_track()
+        for first order maps of a linear sequence (see is_linear_sequence())
+
+        :param X0: initial coordinates (x, px, y, py, tau, p) or None
+        :return: x, y
+        """
+        X = linear_trajectory(self.sequence, self.R_cum, X0)
+        self.set_trajectory(X[:, 0], X[:, 2])
+        return self.x, self.y
+
+    def column(self, cor):
+        """
+        Response of the trajectory to 1 rad kick of the corrector (cached).
+
+        :param cor: Hcor or Vcor element from the lattice sequence
+        :return: (k, response) - k is the trajectory point at the corrector exit and response is array
+                 for points k..n
+        """
+        key = id(cor)
+        if key in self.columns:
+            return self.columns[key]
+        k = self.elem_index[key]
+        plane = 2 if cor.__class__.__name__ == "Vcor" else 0
+        # thick corrector: at the exit offset l/2 and angle 1 rad
+        v = np.zeros(6)
+        v[plane] = cor.l / 2.
+        v[plane + 1] = 1.
+        # map from the corrector exit to every downstream point, only the row of the plane is needed
+        rows = np.dot(self.R_cum[k:, plane, :], np.linalg.inv(self.R_cum[k]))
+        response = np.dot(rows, v)
+        self.columns[key] = (k, response)
+        return k, response
+
+    def apply_kick(self, cor, delta_angle):
+        """
+        Rank-1 update of the trajectory
+
+        :param cor: Hcor or Vcor element
+        :param delta_angle: change of the kick [rad]
+        :return: x, y
+        """
+        k, response = self.column(cor)
+        if cor.__class__.__name__ == "Vcor":
+            self.y[k:] += delta_angle * response
+        else:
+            self.x[k:] += delta_angle * response
+        return self.x, self.y
+
+    def at_elements(self, elements):
+        """
+        Trajectory at the exits of given elements (e.g. BPMs)
+
+        :param elements: list of elements from the lattice sequence
+        :return: x, y arrays
+        """
+        indx = np.array([self.elem_index[id(elem)] for elem in elements], dtype=int)
+        return self.x[indx], self.y[indx]
+
+
+def matrix_fingerprint(*arrays):
+    """
+    Hash of the content of arrays (None is skipped)
+
+    :param arrays: numpy arrays
+    :return: hex string
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        if a is None:
+            h.update(b"None")
+            continue
+        a = np.ascontiguousarray(a, dtype=float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def weighted_rows(matrix, weights):
+    """
+    :param matrix: 2D array
+    :param weights: weights matrix, array of row weights or None
+    :return: np.dot(weights, matrix) (without the diagonal matrix for row weights)
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    if weights is None:
+        return matrix
+    if np.ndim(weights) == 1:
+        return np.asarray(weights, dtype=float)[:, np.newaxis] * matrix
+    return np.dot(weights, matrix)
+
+
+def extract_matrix(matrix, cor_names, bpm_names, cor_list, bpm_list):
+    """
+    Part of a response matrix for the given devices, in the order of cor_list and bpm_list
+    (ResponseMatrix.extract() keeps the order of the matrix)
+
+    :param matrix: array (2*len(bpm_names), len(cor_names)), rows are x of all BPMs and then y of all BPMs
+    :param cor_names: column names of matrix
+    :param bpm_names: BPM names of matrix
+    :param cor_list: list of corrector ids
+    :param bpm_list: list of BPM ids
+    :return: array (2*len(bpm_list), len(cor_list))
+    :raise ValueError: if a device is not in the matrix
+    """
+    cor_pos = {name: i for i, name in enumerate(cor_names)}
+    bpm_pos = {name: i for i, name in enumerate(bpm_names)}
+    missing = [name for name in cor_list if name not in cor_pos] + [name for name in bpm_list if name not in bpm_pos]
+    if len(missing) > 0:
+        raise ValueError("devices are not in the response matrix: " + str(missing))
+    rows = np.array([bpm_pos[name] for name in bpm_list], dtype=int)
+    cols = np.array([cor_pos[name] for name in cor_list], dtype=int)
+    rows = np.append(rows, rows + len(bpm_names))
+    return np.asarray(matrix, dtype=float)[np.ix_(rows, cols)]
+
+
+def correction_angles(rm, orbit, solver, alpha=0., beta=0., drm=None, dispersion=None, weights=None):
+    """
+    Corrector angles with the same combination of ORM, DRM and kick penalty as
+    ocelot.cpbd.orbit_correction.Orbit.correction(), but on arrays: no elements are changed and no transfer maps
+    are updated, so it can run in a worker thread or in the feedback daemon.
+    With the cached solvers and alpha = beta = 0 the zero DRM and kick penalty blocks are not built, the solver
+    works on the RM (apply_orbit()). The cached solvers get the BPM weights as a vector, not as a diagonal matrix.
+
+    :param rm: ORM of the devices (rows x of all BPMs and then y of all BPMs, columns hcors + vcors)
+    :param orbit: array (2*nbpms) of the orbit relative to the golden orbit (x - x_ref, y - y_ref) [m]
+    :param solver: OrbitSVD, MICADO or their cached versions
+    :param alpha: 0 - 1, trade off between orbit and dispersion correction, 0 - only orbit
+    :param beta: weight for suppression of large kicks
+    :param drm: DRM of the same devices or None
+    :param dispersion: array (2*nbpms) Dx - Dx_des, Dy - Dy_des, only used if alpha != 0
+    :param weights: array (nbpms) of BPM weights or None
+    :return: array of angles [rad], equal to cor.angle after Orbit.correction() started with cor.angle = 0
+    """
+    rm = np.asarray(rm, dtype=float)
+    ncor = np.shape(rm)[1]
+    nbpms = np.shape(rm)[0] // 2
+    w = np.ones(nbpms) if weights is None else np.asarray(weights, dtype=float)
+    cached = isinstance(solver, CachedSolverMixin)
+    if alpha == 0 and beta == 0 and cached:
+        # the DRM and the kick penalty blocks are zero, the cached solvers solve on the (2*nbpms, ncor) RM
+        return -solver.apply_orbit(rm, np.asarray(orbit, dtype=float), np.tile(w, 2))
+    target = (1 - alpha) * np.asarray(orbit, dtype=float)
+    RM = (1 - alpha) * rm
+    if alpha != 0:
+        disp = alpha * np.asarray(dispersion, dtype=float)
+    else:
+        disp = np.zeros_like(target)
+    DRM = alpha * np.asarray(drm, dtype=float) if drm is not None else np.zeros_like(RM)
+    b_mat = beta * np.eye(np.shape(DRM)[0])
+    rmatrix = block_diag(RM, DRM, b_mat)
+    target = np.concatenate((target, disp, np.zeros(np.shape(DRM)[0])))
+    if cached:
+        angle = solver.apply(resp_matrix=rmatrix, orbit=target, weights=np.tile(w, 6),
+                             system=(alpha, beta, drm is None))
+    else:
+        angle = solver.apply(resp_matrix=rmatrix, orbit=target, weights=np.diag(np.tile(w, 6)))
+    return -((1 - alpha) * angle[:ncor] + alpha * angle[ncor:2 * ncor])
+
+
+class SolverCache:
+    """
+    LRU storage of solver states (pseudo-inverse for SVD, Gram matrix for MICADO).
+    One instance is shared by all Orbit objects created by OrbitInterface.create_Orbit_obj().
+
+    :param max_entries: number of stored device sets
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.factorization = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.factorization = None
+
+
+class IncrementalQR:
+    """
+    QR factorization of the (weighted) response matrix with row ids (BPM, plane) and column ids (correctors).
+    When devices are checked/unchecked, rows and columns are removed/added with qr_delete/qr_insert
+    instead of a new factorization. The result is checked against the new matrix and
+    update() returns False if too many devices changed or the accuracy is worse than tol,
+    the caller has to do the full factorization then.
+
+    :param matrix: 2D array
+    :param row_ids: list of row ids
+    :param col_ids: list of column ids
+    :param epsilon: singular values below epsilon*max(s) are ignored in pinv() (the same rule as in OrbitSVD)
+    :param max_changes: maximum number of added/removed rows and columns in one update
+    :param max_updates: number of added/removed rows and columns after which the matrix is factorized again
+    :param tol: relative accuracy of the factorization
+    """
+    def __init__(self, matrix, row_ids, col_ids, epsilon, max_changes=6, max_updates=50, tol=1e-9):
+        self.matrix = np.array(matrix, dtype=float)
+        self.row_ids = list(row_ids)
+        self.col_ids = list(col_ids)
+        self.epsilon = epsilon
+        self.max_changes = max_changes
+        self.max_updates = max_updates
+        self.tol = tol
+        self.Q = None
+        self.R = None
+        self.nupdates = 0
+
+    def factorize(self):
+        self.Q, self.R = qr(self.matrix)
+        self.nupdates = 0
+
+    def is_accurate(self, matrix, Q, R):
+        x = np.random.RandomState(0).randn(np.shape(matrix)[1])
+        y = np.dot(matrix, x)
+        norm = np.linalg.norm(y)
+        if norm == 0:
+            return False
+        return np.linalg.norm(y - np.dot(Q, np.dot(R, x))) / norm < self.tol
+
+    def update(self, matrix, row_ids, col_ids):
+        """
+        Method updates the factorization to a new matrix
+
+        :param matrix: new matrix, rows and columns are in the order of row_ids and col_ids
+        :param row_ids: list of row ids
+        :param col_ids: list of column ids
+        :return: True if the factorization was updated, False if the full factorization is needed
+        """
+        old_rows = set(self.row_ids)
+        old_cols = set(self.col_ids)
+        new_rows = set(row_ids)
+        new_cols = set(col_ids)
+        del_rows = [i for i, r in enumerate(self.row_ids) if r not in new_rows]
+        del_cols = [i for i, c in enumerate(self.col_ids) if c not in new_cols]
+        ins_rows = [r for r in row_ids if r not in old_rows]
+        ins_cols = [c for c in col_ids if c not in old_cols]
+        nchanges = len(del_rows) + len(del_cols) + len(ins_rows) + len(ins_cols)
+        if nchanges > self.max_changes or self.nupdates + nchanges > self.max_updates:
+            return False
+        if self.Q is None:
+            self.factorize()
+
+        row_pos = {r: i for i, r in enumerate(row_ids)}
+        col_pos = {c: i for i, c in enumerate(col_ids)}
+        Q, R = self.Q, self.R
+        rows = list(self.row_ids)
+        cols = list(self.col_ids)
+        try:
+            for i in sorted(del_cols, reverse=True):
+                Q, R = qr_delete(Q, R, i, which="col")
+                del cols[i]
+            for i in sorted(del_rows, reverse=True):
+                Q, R = qr_delete(Q, R, i, which="row")
+                del rows[i]
+            rows_indx = [row_pos[r] for r in rows]
+            for c in ins_cols:
+                Q, R = qr_insert(Q, R, matrix[rows_indx, col_pos[c]], len(cols), which="col")
+                cols.append(c)
+            cols_indx = [col_pos[c] for c in cols]
+            for r in ins_rows:
+                Q, R = qr_insert(Q, R, matrix[row_pos[r], cols_indx], len(rows), which="row")
+                rows.append(r)
+        except Exception as e:
+            logger.debug(" IncrementalQR: update failed: " + str(e))
+            return False
+
+        M = np.asarray(matrix, dtype=float)[np.ix_([row_pos[r] for r in rows], [col_pos[c] for c in cols])]
+        if not self.is_accurate(M, Q, R):
+            logger.debug(" IncrementalQR: accuracy is lost. Full factorization")
+            return False
+        self.Q, self.R = Q, R
+        self.matrix = M
+        self.row_ids = rows
+        self.col_ids = cols
+        self.nupdates += nchanges
+        return True
+
+    def pinv(self, row_ids=None, col_ids=None):
+        """
+        Truncated pseudo-inverse from the SVD of the triangular factor
+
+        :param row_ids: order of the rows or None (order of self.row_ids)
+        :param col_ids: order of the columns or None (order of self.col_ids)
+        :return: array (ncols, nrows)
+        """
+        if self.Q is None:
+            self.factorize()
+        k = min(np.shape(self.R))
+        U, s, Vt = np.linalg.svd(self.R[:k, :], full_matrices=False)
+        s_inv = np.zeros(len(s))
+        if len(s) > 0 and np.max(s) > 0:
+            mask = s >= np.max(s) * self.epsilon
+            s_inv[mask] = 1. / s[mask]
+        A = np.dot(Vt.T * s_inv, np.dot(U.T, self.Q[:, :k].T))
+        if row_ids is not None:
+            row_pos = {r: i for i, r in enumerate(self.row_ids)}
+            A = A[:, [row_pos[r] for r in row_ids]]
+        if col_ids is not None:
+            col_pos = {c: i for i, c in enumerate(self.col_ids)}
+            A = A[[col_pos[c] for c in col_ids], :]
+        return A
+
+
+class CachedSolverMixin:
+    """
+    Common part of CachedOrbitSVD and CachedMICADO.
+    Key of the cache: solver name, active BPM ids, active corrector ids, epsilons and
+    fingerprint of the (weighted) response matrix which Orbit.correction() passes to apply().
+    The fingerprint covers the RM itself and the DRM part scaled with beta.
+    correction_angles() passes the system (alpha, beta) to apply(), with a matrix key (set_matrix_key()) the
+    fingerprint is the matrix key, the system and the weights, the matrix is not hashed in every call then.
+    """
+    solver_name = ""
+
+    def init_cache(self, cache):
+        self.cache = cache if cache is not None else SolverCache()
+        self.bpm_ids = ()
+        self.cor_ids = ()
+        self.matrix_key = None
+
+    def set_matrix_key(self, matrix_key):
+        """
+        :param matrix_key: key of the RM and DRM from which the matrices of correction_angles() are extracted
+            with the device ids, e.g. matrix_fingerprint() computed once per job or when the matrices change.
+            None - the matrix is hashed in every call.
+        :return:
+        """
+        self.matrix_key = matrix_key
+
+    def set_devices(self, bpms, corrs):
+        """
+        :param bpms: active BPMs (rows of RM)
+        :param corrs: active correctors in the order of RM columns (hcors + vcors)
+        :return:
+        """
+        self.set_device_ids([bpm.id for bpm in bpms], [cor.id for cor in corrs])
+
+    def set_device_ids(self, bpm_ids, cor_ids):
+        """
+        set_devices() with ids, e.g. in the feedback daemon which has no ocelot elements
+        """
+        self.bpm_ids = tuple(bpm_ids)
+        self.cor_ids = tuple(cor_ids)
+
+    def matrix_ids(self, resp_matrix):
+        """
+        Row and column ids of the response matrix: rows are x of all BPMs and then y of all BPMs.
+        None if the shape does not correspond to the devices (e.g. DRM rows are added with beta != 0)
+        """
+        if np.shape(resp_matrix) != (2 * len(self.bpm_ids), len(self.cor_ids)):
+            return None
+        row_ids = [(bpm_id, "x") for bpm_id in self.bpm_ids] + [(bpm_id, "y") for bpm_id in self.bpm_ids]
+        return row_ids, list(self.cor_ids)
+
+    def solver_key(self, resp_matrix, weights, system=None):
+        if self.matrix_key is not None and system is not None:
+            fingerprint = (self.matrix_key, system, np.shape(resp_matrix), matrix_fingerprint(weights))
+        else:
+            fingerprint = matrix_fingerprint(resp_matrix, weights)
+        return (self.solver_name, self.bpm_ids, self.cor_ids, self.epsilon_x, self.epsilon_y,
+                getattr(self, "epsilon_ksi", None), fingerprint)
+
+
+class CachedOrbitSVD(CachedSolverMixin, OrbitSVD):
+    """
+    OrbitSVD which keeps the pseudo-inverse of the response matrix.
+    At steady state (same devices, RM and epsilons) a correction is one matrix-vector product.
+    """
+    solver_name = "SVD"
+
+    def __init__(self, epsilon_x=0.001, epsilon_y=0.001, cache=None):
+        OrbitSVD.__init__(self, epsilon_x=epsilon_x, epsilon_y=epsilon_y)
+        self.init_cache(cache)
+
+    def apply(self, resp_matrix, orbit, weights=None, system=None):
+        """
+        :param resp_matrix: response matrix
+        :param orbit: array
+        :param weights: weights matrix, array of row weights or None
+        :param system: parameters of correction_angles() which build resp_matrix (see solver_key()) or None
+        :return: angles
+        """
+        key = self.solver_key(resp_matrix, weights, system)
+        A = self.cache.get(key)
+        if A is None:
+            A = self.update_pseudo_inverse(resp_matrix, weights)
+            self.cache.put(key, A)
+        return np.dot(A, orbit)
+
+    def apply_orbit(self, rm, orbit, weights):
+        """
+        correction_angles() with alpha = 0 and beta = 0: the block system of Orbit.correction() has zero DRM and
+        kick penalty blocks, its first ncor angles are the solution on the RM
+
+        :param rm: array (2*nbpms, ncor)
+        :param orbit: array (2*nbpms)
+        :param weights: array (2*nbpms) of row weights
+        :return: angles of the RM columns
+        """
+        return self.apply(rm, orbit, weights=weights, system=(0., 0.))
+
+    def update_pseudo_inverse(self, resp_matrix, weights):
+        """
+        Pseudo-inverse for a new key. The (2*nbpms, ncor) RM of the devices is factorized with IncrementalQR:
+        if only a few BPMs/correctors were checked or unchecked since the last factorization, the QR factorization
+        is updated, otherwise it is started again from this matrix. All singular values are cut with epsilon_x,
+        as in the block system of Orbit.correction() where the nonzero ones are in the first half.
+        Other matrices (with DRM and kick penalty blocks) get the full SVD of OrbitSVD.
+
+        :param resp_matrix: response matrix
+        :param weights: weights matrix, array of row weights or None
+        :return: linear map from the orbit to the kicks
+        """
+        ids = self.matrix_ids(resp_matrix)
+        Rw = weighted_rows(resp_matrix, weights)
+        if ids is not None:
+            fact = self.cache.factorization
+            if fact is not None and fact.epsilon == self.epsilon_x and fact.update(Rw, *ids):
+                logger.debug(" CachedOrbitSVD: pseudo-inverse from updated QR")
+            else:
+                fact = IncrementalQR(Rw, ids[0], ids[1], epsilon=self.epsilon_x)
+                self.cache.factorization = fact
+                logger.debug(" CachedOrbitSVD: new QR factorization")
+            A = fact.pinv(row_ids=ids[0], col_ids=ids[1])
+        else:
+            # the SVD solution is linear in the orbit, the columns of the map are solutions for unit orbits
+            A = np.asarray(OrbitSVD.apply(self, Rw, np.eye(np.shape(Rw)[0])))
+            logger.debug(" CachedOrbitSVD: new pseudo-inverse, shape = " + str(np.shape(A)))
+        # pinv(W R) W
+        if weights is None:
+            return A
+        return A * np.asarray(weights, dtype=float) if np.ndim(weights) == 1 else np.dot(A, weights)
+
+
+class CachedMICADO(CachedSolverMixin, MICADO):
+    """
+    MICADO which keeps the Gram matrix R^T R of the response matrix.
+    The greedy selection of MICADO.apply() is run for every orbit, but the residual of each candidate is
+    updated from the Gram matrix (Gram-Schmidt of the selected columns) instead of one lstsq per candidate.
+    The selected correctors, the stop on epsilon_ksi and the returned angles are the same as in MICADO.apply().
+    A candidate which is (almost) a linear combination of the selected columns (relative norm of the
+    orthogonal part below epsilon_x) does not reduce the residual, as with the rcond of lstsq.
+    """
+    solver_name = "MICADO"
+
+    def __init__(self, epsilon_x=0.001, epsilon_y=0.001, epsilon_ksi=1e-5, cache=None):
+        MICADO.__init__(self, epsilon_x=epsilon_x, epsilon_y=epsilon_y, epsilon_ksi=epsilon_ksi)
+        self.init_cache(cache)
+
+    def apply(self, resp_matrix, orbit, weights=None, system=None):
+        # as in MICADO.apply() weights are not used
+        resp_matrix = np.asarray(resp_matrix, dtype=float)
+        return self.select(resp_matrix, orbit, self.solver_key(resp_matrix, None, system))
+
+    def apply_orbit(self, rm, orbit, weights):
+        """
+        correction_angles() with alpha = 0 and beta = 0: the block system of Orbit.correction() is the RM with
+        zero rows and zero columns (DRM and kick penalty). Zero rows do not change the selection, the zero columns
+        are taken into account without building them (order of the candidates, last tested candidate).
+
+        :param rm: array (2*nbpms, ncor)
+        :param orbit: array (2*nbpms)
+        :param weights: not used
+        :return: angles of the RM columns
+        """
+        rm = np.asarray(rm, dtype=float)
+        nrows, ncols = np.shape(rm)
+        angle = self.select(rm, orbit, self.solver_key(rm, None, (0., 0.)), zero_columns=ncols + nrows)
+        return angle[:ncols]
+
+    def select(self, resp_matrix, orbit, key, zero_columns=0):
+        """
+        Greedy selection of MICADO.apply()
+
+        :param resp_matrix: array
+        :param orbit: array
+        :param key: key of the Gram matrix in the cache
+        :param zero_columns: number of zero columns after the columns of resp_matrix
+        :return: angles of the columns of resp_matrix and of the zero columns
+        """
+        orbit = np.asarray(orbit, dtype=float)
+        G = self.cache.get(key)
+        if G is None:
+            G = np.dot(resp_matrix.T, resp_matrix)
+            self.cache.put(key, G)
+        nreal = np.shape(resp_matrix)[1]
+        ncols = nreal + zero_columns
+        norm2 = np.append(np.diag(G), np.zeros(zero_columns))
+        # projections of the columns and of the orbit on the orthonormal basis of the selected columns,
+        # the last row is the projection of a zero column
+        A = np.zeros((nreal + 1, ncols))
+        c = np.append(np.dot(resp_matrix.T, orbit), np.zeros(zero_columns))
+        orbit2 = np.dot(orbit, orbit)
+        proj2 = 0.
+        b = np.zeros(ncols)
+        mask = np.arange(ncols)
+        angle = np.zeros(ncols)
+        self.orb_residual = []
+        for n in range(ncols):
+            cand = mask[n:]
+            rows = np.minimum(cand, nreal)
+            w = norm2[cand] - np.sum(A[rows, :n]**2, axis=1)
+            z = c[cand] - np.dot(A[rows, :n], b[:n])
+            gain = np.zeros(len(cand))
+            indep = w > (self.epsilon_x**2) * norm2[cand]
+            gain[indep] = z[indep]**2 / w[indep]
+            residual = np.sqrt(np.maximum(orbit2 - proj2 - gain, 0.))
+            index = np.argmin(residual) + n
+            self.orb_residual.append(residual[index - n])
+            # MICADO keeps the lstsq solution of the last tested candidate
+            last = mask[-1]
+            mask[[n, index]] = mask[[index, n]]
+            if len(self.orb_residual) > 1 and self.orb_residual[-2] - self.orb_residual[-1] < self.epsilon_ksi:
+                cols = np.append(mask[:n], last)
+                real = cols < nreal
+                # lstsq gives zero angles to zero columns
+                angles_part = np.zeros(len(cols))
+                if np.any(real):
+                    angles_part[real] = self.solver_lstsq(resp_matrix[:, cols[real]], orbit, None)
+                angle[:len(angles_part)] = angles_part
+                logger.debug(" CachedMICADO: number of correctors " + str(n))
+                break
+            if indep[index - n]:
+                sel = mask[n]
+                w_sel = np.sqrt(w[index - n])
+                A[:nreal, n] = (G[:, sel] - np.dot(A[:nreal, :n], A[sel, :n])) / w_sel
+                b[n] = z[index - n] / w_sel
+                proj2 += b[n]**2
+        return angle[np.argsort(mask)]
@@ -0,0 +1,200 @@
+"""
+Columnar storage of BPM readings and corrector kicks for the currently loaded lattice section.
+Orbit readout, golden orbit and adaptive feedback work on the arrays in bulk, and the ocelot
+elements (Monitor, Hcor, Vcor) are only synchronized when ocelot itself needs them.
+"""
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class OrbitState:
+    """
+    Arrays for s, x, y, x_ref, y_ref, charge and active mask of BPMs plus kicks of correctors.
+    All positions are in [m], kicks in [mrad], charge in [nC].
+    The name -> index dictionaries are built once per lattice load (see load()).
+    """
+    def __init__(self, bpms=None, corrs=None):
+        self._gather_names = None
+        self._gather_indx = None
+        self._gather_mask = None
+        self.load(bpms if bpms is not None else [], corrs if corrs is not None else [])
+
+    def load(self, bpms, corrs):
+        """
+        Method allocates arrays for a new set of BPMs and correctors and builds name -> index maps.
+        The maps belong to this state only (the elements are shared with other states), see rows().
+
+        :param bpms: list of Monitor elements
+        :param corrs: list of Hcor/Vcor elements
+        :return:
+        """
+        self.bpms = list(bpms)
+        self.corrs = list(corrs)
+
+        self.bpm_names = [bpm.id for bpm in self.bpms]
+        self.bpm_index = {name: i for i, name in enumerate(self.bpm_names)}
+        nbpms = len(self.bpms)
+        self.s = np.array([getattr(bpm, "s", 0.) for bpm in self.bpms], dtype=float)
+        self.x = np.zeros(nbpms)
+        self.y = np.zeros(nbpms)
+        self.x_ref = np.zeros(nbpms)
+        self.y_ref = np.zeros(nbpms)
+        self.charge = np.zeros(nbpms)
+        # False until a charge was read, push_to_elements() does not overwrite bpm.charge with zeros
+        self.charge_read = False
+        self.active = np.ones(nbpms, dtype=bool)
+
+        self.cor_names = [cor.id for cor in self.corrs]
+        self.cor_index = {name: i for i, name in enumerate(self.cor_names)}
+        ncorrs = len(self.corrs)
+        self.cor_s = np.array([getattr(cor, "s", 0.) for cor in self.corrs], dtype=float)
+        self.kick_mrad = np.zeros(ncorrs)
+        self.kick_init = np.zeros(ncorrs)
+        self.cor_active = np.ones(ncorrs, dtype=bool)
+
+        self._gather_names = None
+        logger.debug(" OrbitState: load: nbpms = " + str(nbpms) + " ncorrs = " + str(ncorrs))
+
+    def rows(self, bpms):
+        """
+        Rows of the BPMs in the state arrays
+
+        :param bpms: list of Monitor elements of this state
+        :return: array of indices, e.g. state.x[state.rows(bpms)]
+        :raise ValueError: if a BPM is not in the state
+        """
+        try:
+            return np.array([self.bpm_index[bpm.id] for bpm in bpms], dtype=int)
+        except KeyError as e:
+            raise ValueError("BPM " + str(e) + " is not in the orbit state")
+
+    def gather_indices(self, names):
+        """
+        Method returns positions of the state BPMs in an external name vector (e.g. DOOCS wildcard reply).
+        The permutation is cached and reused while the name vector is unchanged.
+
+        :param names: list of BPM names in the order of the external arrays
+        :return: (indx, mask) - indx[i] is the position of self.bpms[i] in names, mask[i] is False if BPM is missing
+        """
+        if self._gather_names is not None and len(names) == len(self._gather_names) and \
+                all(a == b for a, b in zip(names, self._gather_names)):
+            return self._gather_indx, self._gather_mask
+        ext_index = {name: i for i, name in enumerate(names)}
+        indx = np.array([ext_index.get(name, -1) for name in self.bpm_names], dtype=int)
+        mask = indx >= 0
+        indx[~mask] = 0
+        self._gather_names = list(names)
+        self._gather_indx = indx
+        self._gather_mask = mask
+        return indx, mask
+
+    def set_orbit(self, names, x_mm, y_mm, charge=None):
+        """
+        Method writes a full orbit reading into the state arrays with one vectorized gather.
+        BPMs which are not in names are deactivated.
+
+        :param names: list of BPM names
+        :param x_mm: array of horizontal positions in [mm]
+        :param y_mm: array of vertical positions in [mm]
+        :param charge: array of charges in [nC] or None
+        :return: mask of BPMs found in names
+        """
+        indx, mask = self.gather_indices(names)
+        if len(indx) == 0:
+            return mask
+        self.x[:] = np.asarray(x_mm, dtype=float)[indx] / 1000.
+        self.y[:] = np.asarray(y_mm, dtype=float)[indx] / 1000.
+        if charge is not None:
+            self.charge[:] = np.asarray(charge, dtype=float)[indx]
+            self.charge_read = True
+        self.x[~mask] = np.nan
+        self.y[~mask] = np.nan
+        self.active &= mask
+        return mask
+
+    def set_reference(self, orbit_dict):
+        """
+        Method sets the reference (golden) orbit from dictionary {bpm_id: [x, y]} in [m]
+
+        :param orbit_dict: dictionary
+        :return:
+        """
+        for name, (x, y) in orbit_dict.items():
+            i = self.bpm_index.get(name)
+            if i is not None:
+                self.x_ref[i] = x
+                self.y_ref[i] = y
+
+    def reference_dict(self):
+        return {name: [x, y] for name, x, y in zip(self.bpm_names, self.x_ref, self.y_ref)}
+
+    def orbit_dict(self):
+        return {name: [x, y] for name, x, y in zip(self.bpm_names, self.x, self.y)}
+
+    def deviation(self):
+        """
+        Orbit deviation from the reference orbit for the active BPMs
+
+        :return: dx, dy in [m]
+        """
+        return self.x[self.active] - self.x_ref[self.active], self.y[self.active] - self.y_ref[self.active]
+
+    def low_charge(self, bunch_charge, charge_tol):
+        """
+        Mask of BPMs with charge below charge_tol [%] of bunch_charge
+
+        :param bunch_charge: reference bunch charge in [nC]
+        :param charge_tol: tolerance in [%]
+        :return: bool array
+        """
+        if bunch_charge == 0:
+            return np.zeros(len(self.charge), dtype=bool)
+        return np.abs(self.charge / bunch_charge) < charge_tol / 100.
+
+    def set_kicks(self, kick_mrad, init=False):
+        self.kick_mrad[:] = kick_mrad
+        if init:
+            self.kick_init[:] = kick_mrad
+
+    def delta_kicks(self):
+        """
+        Kick changes relative to the initial (read) values for the active correctors
+
+        :return: array in [mrad]
+        """
+        return np.where(self.cor_active, self.kick_mrad - self.kick_init, 0.)
+
+    def push_to_elements(self, bpms=True, corrs=True):
+        """
+        Method copies the arrays into the ocelot elements (bpm.x, bpm.y, bpm.charge, cor.kick_mrad, cor.angle_read)
+        for code which still works on element attributes, e.g. ocelot.cpbd.orbit_correction.Orbit.
+
+        :param bpms: if True update BPMs
+        :param corrs: if True update correctors
+        :return:
+        """
+        if bpms:
+            for bpm, x, y in zip(self.bpms, self.x, self.y):
+                bpm.x = x
+                bpm.y = y
+            if self.charge_read:
+                for bpm, charge in zip(self.bpms, self.charge):
+                    bpm.charge = charge
+        if corrs:
+            for cor, kick in zip(self.corrs, self.kick_mrad):
+                cor.kick_mrad = kick
+                cor.angle_read = kick * 1e-3
+
+    def pull_from_elements(self):
+        """
+        Method copies element attributes into the arrays (the opposite of push_to_elements())
+
+        :return:
+        """
+        self.x[:] = [getattr(bpm, "x", 0.) for bpm in self.bpms]
+        self.y[:] = [getattr(bpm, "y", 0.) for bpm in self.bpms]
+        self.charge[:] = [getattr(bpm, "charge", 0.) for bpm in self.bpms]
+        self.charge_read = all(hasattr(bpm, "charge") for bpm in self.bpms)
+        self.kick_mrad[:] = [getattr(cor, "kick_mrad", 0.) for cor in self.corrs]
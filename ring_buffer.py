@@ -0,0 +1,208 @@
+"""
+Preallocated circular buffers for the adaptive feedback statistics.
+Appending a reading, the moving averages and the filtered objective are O(n_bpms) and do not allocate memory.
+"""
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """
+    Circular buffer of rows with shape (size, width) and running sums over the last "window" rows.
+    NaN values are counted separately, so one NaN reading does not spoil the sums after it leaves the window.
+    """
+    def __init__(self, size, width=1, window=1, resum_period=1000):
+        """
+        :param size: maximum number of rows
+        :param width: length of a row
+        :param window: number of last rows for window_mean()
+        :param resum_period: sums are recalculated from scratch every resum_period appends (round-off errors)
+        """
+        self.size = int(size)
+        self.width = int(width)
+        self.data = np.zeros((self.size, self.width))
+        self.resum_period = resum_period
+        self._sum = np.zeros(self.width)
+        self._nan_count = np.zeros(self.width, dtype=int)
+        self._mean = np.zeros(self.width)
+        self._finite = np.zeros(self.width)
+        self._nan = np.zeros(self.width, dtype=bool)
+        self._ordered = np.zeros((self.size, self.width))
+        self.window = max(1, min(int(window), self.size))
+        self.clear()
+
+    def clear(self):
+        self.head = 0       # index of the next row
+        self.count = 0
+        self.n_appends = 0
+        self._sum[:] = 0.
+        self._nan_count[:] = 0
+
+    def __len__(self):
+        return self.count
+
+    def index(self, k):
+        """
+        Physical row index of the k-th row counted from the oldest one (negative k counts from the newest)
+
+        :param k: chronological index
+        :return: row index in self.data
+        """
+        if k < 0:
+            k += self.count
+        return (self.head - self.count + k) % self.size
+
+    def last(self):
+        """
+        Newest row (view)
+        """
+        return self.data[(self.head - 1) % self.size]
+
+    def _add(self, row, sign):
+        np.isnan(row, out=self._nan)
+        np.copyto(self._finite, row)
+        self._finite[self._nan] = 0.
+        self._sum += sign * self._finite
+        self._nan_count += sign * self._nan
+
+    def append(self, row):
+        """
+        Method copies row into the buffer and updates the running sums
+
+        :param row: array with length width (or scalar for width = 1)
+        :return:
+        """
+        in_window = min(self.count, self.window)
+        if in_window == self.window:
+            # row which leaves the window (it is still in the buffer if count == size and window == size)
+            self._add(self.data[self.index(self.count - self.window)], -1)
+        self.data[self.head] = row
+        self._add(self.data[self.head], 1)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.n_appends += 1
+        if self.n_appends % self.resum_period == 0:
+            self.resum()
+
+    def set_window(self, window):
+        """
+        Method changes the number of rows for window_mean(). Sums are recalculated only if the window is changed.
+
+        :param window: number of rows
+        :return:
+        """
+        window = max(1, min(int(window), self.size))
+        if window != self.window:
+            self.window = window
+            self.resum()
+
+    def resum(self):
+        self._sum[:] = 0.
+        self._nan_count[:] = 0
+        for k in range(max(0, self.count - self.window), self.count):
+            self._add(self.data[self.index(k)], 1)
+
+    def window_mean(self):
+        """
+        Mean of the last min(window, count) rows. Columns with NaN in the window are NaN.
+        Returns the same preallocated array every call, copy it if it has to be kept.
+
+        :return: array with length width
+        """
+        n = min(self.count, self.window)
+        if n == 0:
+            self._mean[:] = np.nan
+            return self._mean
+        np.divide(self._sum, n, out=self._mean)
+        self._mean[self._nan_count > 0] = np.nan
+        return self._mean
+
+    def ordered(self):
+        """
+        Rows from the oldest to the newest. Returns a view of a preallocated array.
+
+        :return: array (count, width)
+        """
+        start = self.index(0)
+        n_tail = min(self.count, self.size - start)
+        self._ordered[:n_tail] = self.data[start:start + n_tail]
+        self._ordered[n_tail:self.count] = self.data[:self.count - n_tail]
+        return self._ordered[:self.count]
+
+    def valid(self):
+        """
+        Rows which are filled (in physical order, the order is not chronological when the buffer wrapped around)
+
+        :return: view of self.data
+        """
+        return self.data[:self.count]
+
+
+class OrbitHistory:
+    """
+    Orbits (x, y) and objective function of the adaptive feedback in ring buffers
+    """
+    def __init__(self, nreadings, nbpms, nring=30):
+        """
+        :param nreadings: length of the history
+        :param nbpms: number of BPMs
+        :param nring: number of readings for the filtered objective function
+        """
+        self.nreadings = int(nreadings)
+        self.nbpms = int(nbpms)
+        self.orbits_x = RingBuffer(nreadings, nbpms)
+        self.orbits_y = RingBuffer(nreadings, nbpms)
+        self.targets = RingBuffer(nreadings, 1, window=nring)
+        self.targets_filtered = RingBuffer(nreadings, 1)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def append(self, orbit_x, orbit_y, target):
+        """
+        Method adds a reading and the moving average of the objective function over the last nring readings
+
+        :param orbit_x: array of horizontal positions
+        :param orbit_y: array of vertical positions
+        :param target: value of objective function
+        :return: filtered value of objective function
+        """
+        self.orbits_x.append(orbit_x)
+        self.orbits_y.append(orbit_y)
+        self.targets.append(target)
+        filtered = self.targets.window_mean()[0]
+        self.targets_filtered.append(filtered)
+        return filtered
+
+    def ref_orbit(self, nlast_readings):
+        """
+        Mean orbit of the last nlast_readings readings.
+        Returns preallocated arrays, copy them if they have to be kept.
+
+        :param nlast_readings: number of readings
+        :return: aver_x, aver_y
+        """
+        self.orbits_x.set_window(nlast_readings)
+        self.orbits_y.set_window(nlast_readings)
+        return self.orbits_x.window_mean(), self.orbits_y.window_mean()
+
+    def best_orbits(self, fraction):
+        """
+        Mean orbit of readings with the largest objective function. The best readings are selected with
+        np.argpartition (O(n) instead of sorting the whole history).
+
+        :param fraction: fraction of the readings [0, 1], at least one reading is taken
+        :return: aver_x, aver_y
+        """
+        n = len(self.targets)
+        num_good = max(1, int(n * fraction))
+        targets = self.targets.valid()[:, 0]
+        if num_good >= n:
+            indx = np.arange(n)
+        else:
+            indx = np.argpartition(targets, n - num_good)[n - num_good:]
+        aver_x = np.mean(self.orbits_x.valid()[indx], axis=0)
+        aver_y = np.mean(self.orbits_y.valid()[indx], axis=0)
+        return aver_x, aver_y
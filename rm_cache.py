@@ -0,0 +1,183 @@
+"""
+Persistent on-disk cache of orbit (RM) and dispersion (DRM) response matrices.
+Entries are addressed by a fingerprint of the optics: section element ids and lengths, the focusing parameters
+of OPTICS_ATTRS, energy and initial Twiss. A matrix computed once is reused until the optics change.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+BEND_ATTRS = ("angle", "k1", "e1", "e2", "tilt")
+# element attributes which change the first order maps. Cavities: coupler kick is a focusing term as well
+OPTICS_ATTRS = {"Quadrupole": ("k1", "tilt"),
+                "Bend": BEND_ATTRS,
+                "SBend": BEND_ATTRS,
+                "RBend": BEND_ATTRS,
+                "Solenoid": ("k",),
+                "Cavity": ("v", "phi", "freq", "coupler_kick", "vx_up", "vy_up", "vxx_up", "vxy_up",
+                           "vx_down", "vy_down", "vxx_down", "vxy_down")}
+
+
+def attr_repr(value):
+    """
+    :param value: number (also complex or bool) or None
+    :return: str, floats are rounded to 12 digits
+    """
+    if isinstance(value, complex):
+        return repr(complex(round(value.real, 12), round(value.imag, 12)))
+    if isinstance(value, float):
+        return repr(round(value, 12))
+    return repr(value)
+
+
+def optics_fingerprint(sequence, tws0=None, energy=None, extra=None):
+    """
+    Hash of everything the response matrix depends on
+
+    :param sequence: list of ocelot elements of the section
+    :param tws0: initial Twiss or None
+    :param energy: beam energy [GeV] or None (taken from tws0)
+    :param extra: any additional string, e.g. the RM method name
+    :return: hex string
+    """
+    h = hashlib.sha1()
+    for elem in sequence:
+        name = elem.__class__.__name__
+        h.update((name + ":" + str(elem.id) + ":" + repr(round(elem.l, 9))).encode())
+        for attr in OPTICS_ATTRS.get(name, ()):
+            h.update((":" + attr_repr(getattr(elem, attr, None))).encode())
+    if tws0 is not None:
+        for attr in ["beta_x", "beta_y", "alpha_x", "alpha_y", "Dx", "Dy", "Dxp", "Dyp", "E"]:
+            h.update(repr(round(getattr(tws0, attr, 0.), 9)).encode())
+        if energy is None:
+            energy = tws0.E
+    if energy is not None:
+        h.update(repr(round(energy, 9)).encode())
+    if extra is not None:
+        h.update(str(extra).encode())
+    return h.hexdigest()
+
+
+class ResponseMatrixCache:
+    """
+    Content addressed store of response matrices with an index file and LRU eviction.
+    Matrices are saved as .npy, corrector/BPM names are saved next to them. get() reads the whole matrix
+    into memory (no memory mapping): the caller gets an own copy and may change it.
+    The index is shared by the GUI and the RM calculator thread and is guarded by a lock. It is written on put()
+    and eviction only, the last use of get() is kept in memory until then.
+
+    :param cache_dir: folder of the cache
+    :param max_entries: maximum number of matrices on disk, the least recently used are removed
+    """
+    index_name = "index.json"
+
+    def __init__(self, cache_dir, max_entries=50):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.index = {}
+        self.lock = threading.RLock()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.load_index()
+
+    def load_index(self):
+        filename = os.path.join(self.cache_dir, self.index_name)
+        if not os.path.isfile(filename):
+            self.index = {}
+            return
+        try:
+            with open(filename, 'r') as f:
+                self.index = json.load(f)
+        except Exception as e:
+            logger.warning(" ResponseMatrixCache: index is broken and will be rebuilt: " + str(e))
+            self.index = {}
+
+    def save_index(self):
+        filename = os.path.join(self.cache_dir, self.index_name)
+        tmp_name = filename + ".tmp"
+        with self.lock:
+            with open(tmp_name, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_name, filename)
+
+    def entry_name(self, key, kind):
+        return kind + "_" + key
+
+    def __contains__(self, item):
+        key, kind = item
+        with self.lock:
+            return self.entry_name(key, kind) in self.index
+
+    def get(self, key, kind="RM", cor_names=None, bpm_names=None):
+        """
+        :param key: optics fingerprint
+        :param kind: "RM" or "DRM"
+        :param cor_names: list of corrector ids or None. If given, the entry must contain all of them
+        :param bpm_names: list of BPM ids or None. If given, the entry must contain all of them
+        :return: (matrix, cor_names, bpm_names) or None if there is no entry. matrix is an own (writable) copy
+        """
+        name = self.entry_name(key, kind)
+        with self.lock:
+            if name not in self.index:
+                return None
+            path = os.path.join(self.cache_dir, name)
+            try:
+                matrix = np.load(path + ".npy")
+                with open(path + ".json", 'r') as f:
+                    names = json.load(f)
+            except Exception as e:
+                logger.warning(" ResponseMatrixCache: get: entry " + name + " is broken: " + str(e))
+                self.remove(name)
+                self.save_index()
+                return None
+            if cor_names is not None and not set(cor_names).issubset(names["cor_names"]):
+                return None
+            if bpm_names is not None and not set(bpm_names).issubset(names["bpm_names"]):
+                return None
+            self.index[name]["last_used"] = time.time()
+        logger.debug(" ResponseMatrixCache: hit " + name)
+        return matrix, names["cor_names"], names["bpm_names"]
+
+    def put(self, key, matrix, cor_names, bpm_names, kind="RM", section=""):
+        """
+        :param key: optics fingerprint
+        :param matrix: 2D array
+        :param cor_names: list of corrector ids (columns)
+        :param bpm_names: list of BPM ids (rows)
+        :param kind: "RM" or "DRM"
+        :param section: name of the section, only for information
+        :return:
+        """
+        name = self.entry_name(key, kind)
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            np.save(path + ".npy", np.asarray(matrix))
+            with open(path + ".json", 'w') as f:
+                json.dump({"cor_names": list(cor_names), "bpm_names": list(bpm_names)}, f)
+            self.index[name] = {"kind": kind, "section": section, "shape": list(np.shape(matrix)),
+                                "last_used": time.time()}
+            self.evict()
+            self.save_index()
+
+    def remove(self, name):
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            for ext in [".npy", ".json"]:
+                if os.path.isfile(path + ext):
+                    os.remove(path + ext)
+            self.index.pop(name, None)
+
+    def evict(self):
+        with self.lock:
+            if len(self.index) <= self.max_entries:
+                return
+            names = sorted(self.index.keys(), key=lambda name: self.index[name]["last_used"])
+            for name in names[:len(self.index) - self.max_entries]:
+                logger.debug(" ResponseMatrixCache: evict " + name)
+                self.remove(name)
@@ -0,0 +1,276 @@
+"""
+Calculation of response matrices (ORM and DRM) for the RM calculator thread.
+The R-matrix ORM (LinacRmatrixRM) is calculated in-process on arrays: one prefix scan of the element maps and
+one batched product for all corrector columns. The result is the same as rm.calculate(tw_init), which loops over
+the correctors and multiplies the maps from every corrector to the end of the lattice.
+The tracking DRM (LinacDisperseSimRM) is sharded by corrector columns over a pool of spawned processes.
+Elements with Qt/DOOCS objects can not be pickled, the workers get a recipe of the lattice (constructor parameters
+and plain attributes of every element) and rebuild it. Spawned processes do not copy the locks of the other threads
+of the GUI (as a fork from the RM calculator thread would do). If the pool is not available or the lattice can not
+be rebuilt, the columns are calculated in the calling thread. Progress is reported per finished column (per finished
+chunk of columns in the pool).
+Other methods (e.g. RingRM) are calculated with rm.calculate() in the calling thread.
+"""
+import os
+import importlib
+import multiprocessing
+import numpy as np
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ocelot import MagneticLattice
+from ocelot.cpbd.response_matrix import LinacDisperseSimRM
+from orbit_math import element_rmatrices, cumulative_rmatrices
+from lattices.lattice_compiler import constructor_args, simple_attrs
+
+logger = logging.getLogger(__name__)
+
+VECTORIZED_METHODS = ("LinacRmatrixRM",)
+SHARDED_METHODS = ("LinacDisperseSimRM",)
+DRM_KICK = 0.0005           # [rad], corrector kick of LinacDisperseSimRM
+MIN_PARALLEL_COLUMNS = 16   # below, the start of the workers costs more than the calculation
+CHUNKS_PER_WORKER = 8       # columns are sent in chunks, every chunk rebuilds the lattice once
+
+
+def set_matrix(rm, matrix, cor_names, bpm_names):
+    """
+    Method sets the matrix of a ResponseMatrix. ResponseMatrix.extract() works on the DataFrame rm.df,
+    it is built from the matrix as in ResponseMatrix.load()
+
+    :param rm: ResponseMatrix
+    :param matrix: array (2*len(bpm_names), len(cor_names))
+    :param cor_names: list of corrector ids
+    :param bpm_names: list of BPM ids
+    :return:
+    """
+    rm.matrix = matrix
+    rm.cor_names = list(cor_names)
+    rm.bpm_names = list(bpm_names)
+    if hasattr(rm, "data2df"):
+        rm.df = rm.data2df(matrix=matrix, bpm_names=rm.bpm_names, cor_names=rm.cor_names)
+
+
+def linear_response_matrix(lat, hcors, vcors, bpms, energy):
+    """
+    Orbit response matrix from the first order maps, column j is the response of the BPMs to 1 rad kick at
+    the entrance of corrector j (as LinacRmatrixRM). BPMs upstream of a corrector have zero response.
+
+    :param lat: MagneticLattice with up to date transfer maps
+    :param hcors: list of horizontal correctors from lat.sequence
+    :param vcors: list of vertical correctors from lat.sequence
+    :param bpms: list of BPMs from lat.sequence
+    :param energy: beam energy at the lattice entrance [GeV]
+    :return: array (2*len(bpms), len(hcors) + len(vcors)), rows are x of all BPMs and then y of all BPMs
+    """
+    R, E, s = element_rmatrices(lat.sequence, energy)
+    R_cum = np.append(np.eye(6)[np.newaxis], cumulative_rmatrices(R), axis=0)
+    index = {id(elem): i for i, elem in enumerate(lat.sequence)}
+    # trajectory points: 0 - lattice entrance, i + 1 - exit of element i
+    bpm_pnt = np.array([index[id(bpm)] + 1 for bpm in bpms], dtype=int)
+    nbpms = len(bpms)
+    matrix = np.zeros((2 * nbpms, len(hcors) + len(vcors)))
+    col0 = 0
+    for cors, row, col in ((hcors, 0, 1), (vcors, 2, 3)):
+        if len(cors) == 0:
+            continue
+        cor_pnt = np.array([index[id(cor)] for cor in cors], dtype=int)
+        # map from the corrector entrance: R_cum[bpm] @ inv(R_cum[cor]), only one row and one column are needed
+        kick = np.linalg.inv(R_cum[cor_pnt])[:, :, col]
+        resp = np.dot(R_cum[bpm_pnt, row, :], kick.T)
+        resp[bpm_pnt[:, np.newaxis] <= cor_pnt[np.newaxis, :]] = 0.
+        rows = slice(0, nbpms) if row == 0 else slice(nbpms, 2 * nbpms)
+        matrix[rows, col0:col0 + len(cors)] = resp
+        col0 += len(cors)
+    return matrix
+
+
+def dispersion_columns(method, columns, energy, progress=None):
+    """
+    Columns of the dispersion response matrix as in LinacDisperseSimRM.calculate(): the change of the
+    tracked dispersion at the BPMs per DRM_KICK of the corrector. The corrector angle is restored after each column.
+
+    :param method: LinacDisperseSimRM (lattice, correctors and BPMs)
+    :param columns: indices of the correctors in hcors + vcors
+    :param energy: beam energy at the lattice entrance [GeV]
+    :param progress: function() which is called after every column or None
+    :return: array (2*nbpms, len(columns))
+    """
+    cors = list(method.hcors) + list(method.vcors)
+    Dx0, Dy0 = method.read_virtual_dispersion(E0=energy)
+    D0 = np.append(Dx0, Dy0)
+    resp = np.zeros((len(D0), len(columns)))
+    try:
+        for i, j in enumerate(columns):
+            cor = cors[j]
+            angle = cor.angle
+            cor.angle = DRM_KICK
+            try:
+                # the map of the previous corrector is restored in the same update
+                method.lat.update_transfer_maps()
+                Dx1, Dy1 = method.read_virtual_dispersion(E0=energy)
+            finally:
+                cor.angle = angle
+            resp[:, i] = (np.append(Dx1, Dy1) - D0) / DRM_KICK
+            if progress is not None:
+                progress()
+    finally:
+        method.lat.update_transfer_maps()
+    return resp
+
+
+def element_state(elem):
+    """
+    Plain public attributes of an element (private ones are caches of the transfer maps). Newer ocelot keeps
+    the physics parameters in the wrapped atom (elem.element), they are taken from there as well.
+
+    :param elem: element
+    :return: dictionary
+    """
+    attrs = simple_attrs(elem)
+    atom = vars(elem).get("element")
+    if atom is not None:
+        attrs.update(simple_attrs(atom))
+    return {attr: val for attr, val in attrs.items() if not attr.startswith("_")}
+
+
+def lattice_recipe(sequence):
+    """
+    Picklable description of a sequence: class, constructor parameters and plain attributes of every element.
+    An element which appears several times in the sequence is described once and referenced by its position.
+
+    :param sequence: list of elements
+    :return: list of (module, class name, kwargs, attrs) or int (position of the first appearance)
+    """
+    first = {}
+    recipe = []
+    for i, elem in enumerate(sequence):
+        if id(elem) in first:
+            recipe.append(first[id(elem)])
+            continue
+        first[id(elem)] = i
+        attrs = element_state(elem)
+        kwargs = {}
+        for name in constructor_args(elem.__class__):
+            attr = "id" if name == "eid" else name
+            if attr in attrs:
+                kwargs[name] = attrs[attr]
+        recipe.append((elem.__class__.__module__, elem.__class__.__name__, kwargs, attrs))
+    return recipe
+
+
+def rebuild_sequence(recipe):
+    """
+    :param recipe: lattice_recipe()
+    :return: list of elements
+    :raise ValueError: if an element does not get the plain attributes of the original one
+    """
+    seq = []
+    for item in recipe:
+        if isinstance(item, int):
+            seq.append(seq[item])
+            continue
+        module, name, kwargs, attrs = item
+        elem = getattr(importlib.import_module(module), name)(**kwargs)
+        for attr, val in attrs.items():
+            if getattr(elem, attr, None) != val:
+                setattr(elem, attr, val)
+        if element_state(elem) != attrs:
+            raise ValueError("rebuild_sequence: " + str(attrs.get("id")) + " differs from the original element")
+        seq.append(elem)
+    return seq
+
+
+def dispersion_worker(recipe, lat_method, cor_pos, nhcors, bpm_pos, columns, energy):
+    """
+    Process pool task: rebuilds the lattice and calculates the DRM columns
+
+    :return: columns, array (2*nbpms, len(columns))
+    """
+    seq = rebuild_sequence(recipe)
+    lat = MagneticLattice(seq, method=lat_method)
+    cors = [seq[i] for i in cor_pos]
+    method = LinacDisperseSimRM(lat, cors[:nhcors], cors[nhcors:], [seq[i] for i in bpm_pos])
+    return columns, dispersion_columns(method, columns, energy)
+
+
+def dispersion_response_matrix(method, energy, progress=None, max_workers=None):
+    """
+    Dispersion response matrix of LinacDisperseSimRM with the columns sharded over a process pool
+
+    :param method: LinacDisperseSimRM
+    :param energy: beam energy at the lattice entrance [GeV]
+    :param progress: function(fraction) or None
+    :param max_workers: number of processes, None - number of CPUs
+    :return: array (2*nbpms, ncors)
+    """
+    ncols = len(method.hcors) + len(method.vcors)
+    done = [0]
+
+    def column_done(n=1):
+        done[0] += n
+        if progress is not None:
+            progress(done[0] / float(ncols))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if ncols >= MIN_PARALLEL_COLUMNS and max_workers > 1:
+        try:
+            return sharded_dispersion(method, energy, max_workers, column_done)
+        except Exception as e:
+            logger.warning("dispersion_response_matrix: process pool failed, columns are calculated in-process: " +
+                           str(e))
+            done[0] = 0
+    return dispersion_columns(method, list(range(ncols)), energy, progress=column_done)
+
+
+def sharded_dispersion(method, energy, max_workers, column_done):
+    seq = method.lat.sequence
+    index = {}
+    for i, elem in enumerate(seq):
+        index.setdefault(id(elem), i)
+    cors = list(method.hcors) + list(method.vcors)
+    cor_pos = [index[id(cor)] for cor in cors]
+    bpm_pos = [index[id(bpm)] for bpm in method.bpms]
+    recipe = lattice_recipe(seq)
+    ncols = len(cors)
+    chunk = max(1, ncols // (max_workers * CHUNKS_PER_WORKER))
+    resp = np.zeros((2 * len(method.bpms), ncols))
+    # spawn: a fork from the RM calculator thread would copy the locks of the GUI and DOOCS threads
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(dispersion_worker, recipe, method.lat.method, cor_pos, len(method.hcors), bpm_pos,
+                               list(range(start, min(start + chunk, ncols))), energy)
+                   for start in range(0, ncols, chunk)]
+        for future in as_completed(futures):
+            columns, part = future.result()
+            resp[:, columns] = part
+            column_done(len(columns))
+    logger.debug("sharded_dispersion: " + str(ncols) + " columns, " + str(len(futures)) + " chunks, " +
+                 str(max_workers) + " workers")
+    return resp
+
+
+def calculate_rm(rm, tw_init=None, progress=None):
+    """
+    Function calculates response matrix (ocelot ResponseMatrix). Result is the same as rm.calculate(tw_init):
+    rm.matrix, rm.cor_names, rm.bpm_names.
+
+    :param rm: ResponseMatrix with method created by Orbit.setup_response_matrix() (or setup_disp_response_matrix())
+    :param tw_init: initial Twiss
+    :param progress: function(fraction) which is called during the calculation
+    :return:
+    """
+    method = rm.method
+    name = method.__class__.__name__
+    cor_names = np.append([cor.id for cor in method.hcors], [cor.id for cor in method.vcors])
+    bpm_names = [bpm.id for bpm in method.bpms]
+    if name in VECTORIZED_METHODS:
+        # LinacRmatrixRM assumes zero energy without initial Twiss
+        energy = 0. if tw_init is None else tw_init.E
+        set_matrix(rm, linear_response_matrix(method.lat, method.hcors, method.vcors, method.bpms, energy),
+                   cor_names, bpm_names)
+        logger.debug("calculate_rm: vectorized " + name + " shape = " + str(np.shape(rm.matrix)))
+    elif name in SHARDED_METHODS and tw_init is not None:
+        set_matrix(rm, dispersion_response_matrix(method, tw_init.E, progress=progress), cor_names, bpm_names)
+        logger.debug("calculate_rm: sharded " + name + " shape = " + str(np.shape(rm.matrix)))
+    else:
+        rm.calculate(tw_init=tw_init)
+    if progress is not None:
+        progress(1.)